@@ -0,0 +1,174 @@
+""" Benchmarks of the MockSet hot paths.
+
+Run from the repo root, optionally saving the results and comparing them with a baseline:
+
+    python -m benchmarks.mockset --sizes 1000,10000 --output results.json
+    python -m benchmarks.mockset --sizes 1000,10000 --baseline results.json --threshold 1.25
+
+Results are the best time in seconds of `--repeat` runs, by `case[size]`. With a
+baseline, cases that got slower than `threshold` times their baseline time are
+reported and the exit status is 1.
+"""
+import argparse
+import json
+import platform
+import sys
+import timeit
+
+import django
+
+from django_mock_queries.mocks import mock_django_setup
+
+mock_django_setup('tests.mock_settings')
+
+from django.db.models import Avg, Count, Max, Q, Sum  # noqa: E402
+
+from django_mock_queries.constants import COMPARISON_OVERLAP, COMPARISONS  # noqa: E402
+from django_mock_queries.mocks import mocked_relations  # noqa: E402
+from django_mock_queries.query import MockModel, MockSet  # noqa: E402
+from tests.mock_models import Car, CarVariation, Manufacturer, Passenger  # noqa: E402
+
+DEFAULT_SIZES = (1000, 10000)
+
+COMPARISON_VALUES = {
+    'exact': 'model 5',
+    'iexact': 'MODEL 5',
+    'contains': 'del 5',
+    'icontains': 'DEL 5',
+    'gt': 500,
+    'gte': 500,
+    'lt': 500,
+    'lte': 500,
+    'in': [1, 5, 50, 500],
+    'startswith': 'model 1',
+    'istartswith': 'MODEL 1',
+    'endswith': '5',
+    'iendswith': '5',
+    'isnull': True,
+    'regex': r'^model \d5$',
+    'iregex': r'^MODEL \d5$',
+    'range': (100, 200),
+}
+
+NUMERIC_COMPARISONS = ('gt', 'gte', 'lt', 'lte', 'in', 'range')
+
+
+def make_cars(size):
+    makes = [Manufacturer(id=i, name='make {}'.format(i)) for i in range(10)]
+    return [
+        Car(id=i, make=makes[i % 10], model='model {}'.format(i % 100), speed=i % 1000)
+        for i in range(size)
+    ]
+
+
+def filter_case(comparison):
+    field = 'speed' if comparison in NUMERIC_COMPARISONS else 'model'
+    lookup = {'{}__{}'.format(field, comparison): COMPARISON_VALUES[comparison]}
+    return lambda cars, rows: list(cars.filter(**lookup))
+
+
+def get_or_create(cars, rows):
+    cars.get_or_create(id=1, defaults={'speed': 1})
+    # Created in a derived set, so the shared rows don't grow
+    cars.filter(speed__lt=0).get_or_create(id=-1, defaults={'speed': -1})
+
+
+def patch_relations(cars, rows):
+    with mocked_relations(Manufacturer, Car, CarVariation, Passenger):
+        pass
+
+
+CASES = dict(
+    [('filter[{}]'.format(comparison), filter_case(comparison))
+     for comparison in COMPARISONS if comparison != COMPARISON_OVERLAP],
+    **{
+        'filter[q_tree]': lambda cars, rows: list(cars.filter(
+            (Q(speed__gt=100) & ~Q(model='model 5')) | Q(speed__lt=10, model__startswith='model 1')
+        )),
+        'exclude': lambda cars, rows: list(cars.exclude(speed__gte=500)),
+        'order_by': lambda cars, rows: list(cars.order_by('-speed', 'model')),
+        'values_list': lambda cars, rows: list(cars.values_list('id', 'speed')),
+        'aggregate': lambda cars, rows: cars.aggregate(Sum('speed'), Avg('speed'), Max('speed'), Count('id')),
+        'distinct': lambda cars, rows: list(cars.values_list('model', flat=True).distinct()),
+        'delete': lambda cars, rows: MockSet(*rows, model=Car).filter(speed__lt=500).delete(),
+        'get': lambda cars, rows: cars.get(id=1),
+        'get_or_create': get_or_create,
+        'mock_model': lambda cars, rows: [MockModel(id=i, speed=i) for i in range(len(rows) // 10)],
+        'from_records': lambda cars, rows: MockSet.from_records(
+            ({'id': row.id, 'make_id': row.make_id, 'model': row.model, 'speed': row.speed} for row in rows), model=Car
+        ),
+        'mocked_relations': patch_relations,
+    }
+)
+
+
+def run(sizes=DEFAULT_SIZES, repeat=3, cases=None):
+    """ The best time of each case and size, by `case[size]`. """
+    results = {}
+
+    for size in sizes:
+        rows = make_cars(size)
+        cars = MockSet(*rows, model=Car)
+
+        for name, case in CASES.items():
+            if cases and name not in cases:
+                continue
+
+            timer = timeit.Timer(lambda: case(cars, rows))
+            results['{}[{}]'.format(name, size)] = min(timer.repeat(repeat=repeat, number=1))
+
+    return results
+
+
+def compare(results, baseline, threshold):
+    """ The cases that take more than `threshold` times their baseline time, with the ratio. """
+    return {
+        name: seconds / baseline[name]
+        for name, seconds in results.items()
+        if baseline.get(name) and seconds / baseline[name] > threshold
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the MockSet hot paths.')
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help='comma separated row counts, like 1000,10000,100000,1000000')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', default='', help='comma separated case names, all by default')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', help='JSON file of earlier results to compare with')
+    parser.add_argument('--threshold', type=float, default=1.25)
+    args = parser.parse_args(argv)
+
+    results = run(
+        sizes=[int(size) for size in args.sizes.split(',')],
+        repeat=args.repeat,
+        cases=[case for case in args.cases.split(',') if case],
+    )
+    document = {
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'results': results,
+    }
+
+    for name, seconds in results.items():
+        print('{:<32} {:>12.6f}s'.format(name, seconds))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(document, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline)['results'], args.threshold)
+
+        for name, ratio in sorted(regressions.items()):
+            print('REGRESSION {}: {:.2f}x the baseline time'.format(name, ratio))
+
+        return 1 if regressions else 0
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+from collections import OrderedDict, namedtuple
+
+from django.utils.hashable import make_hashable
+
+from .constants import *
+from .utils import is_subquery
+
+import django_mock_queries.query
+
+# The rows of a MockSet result and how it was derived, which a new set is made of on every read of it
+CachedSet = namedtuple('CachedSet', ('cls', 'rows', 'clone', 'plan', 'access'))
+
+
+class ResultCache:
+    """ Results of the read-only operations of a root MockSet, by operation, arguments and version of its rows.
+
+    The version goes up on every write to the rows through the set and the
+    sets derived from it, so a repeated read of unchanged rows is a dictionary
+    lookup. Sets are cached as their rows, and every read gets a new set of
+    them. Lookups that read other sets, like subqueries or `__in` another
+    MockSet, are not cached. Attributes set directly on a row don't fire an
+    event and aren't seen by the cache.
+
+    cars = MockSet(*rows, model=Car, cache=ResultCache(maxsize=256))
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.owner = None
+        self.version = 0
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def bind(self, owner):
+        assert self.owner is None, 'A ResultCache belongs to one MockSet.'
+        self.owner = owner
+
+    def fork(self, owner):
+        """ An empty cache of the same size for `owner`, a fork of the set that owns this one. """
+        copied = type(self)(self.maxsize)
+        copied.bind(owner)
+        return copied
+
+    def _cacheable(self, value):
+        if isinstance(value, DjangoQ):
+            return all(self._cacheable(child[1] if isinstance(child, tuple) else child) for child in value.children)
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            return all(self._cacheable(item) for item in value)
+        elif isinstance(value, dict):
+            return all(self._cacheable(item) for item in value.values())
+
+        return not isinstance(value, django_mock_queries.query.MockSet) and not is_subquery(value) \
+            and not isinstance(value, DjangoOuterRef)
+
+    def key(self, operation, args, kwargs):
+        """ The key of an operation on the current rows, or None if its result can't be cached. """
+        if not self._cacheable(args) or not self._cacheable(kwargs):
+            return None
+
+        try:
+            key = (self.version, operation, make_hashable(args), make_hashable(kwargs))
+            hash(key)
+        except TypeError:
+            return None
+
+        return key
+
+    def get(self, key):
+        self.results.move_to_end(key)
+        self.hits += 1
+        result = self.results[key]
+
+        # Every caller gets its own set or dict, which it can change without changing the cache or another caller's
+        if isinstance(result, CachedSet):
+            found = result.cls(*result.rows, clone=result.clone)
+            found._plan, found._access = result.plan, result.access
+            return found
+
+        return dict(result) if isinstance(result, dict) else result
+
+    def put(self, key, result):
+        self.misses += 1
+
+        if isinstance(result, django_mock_queries.query.MockSet):
+            self.results[key] = CachedSet(type(result), tuple(result.items), result.clone, result._plan, result._access)
+        else:
+            self.results[key] = dict(result) if isinstance(result, dict) else result
+
+        while len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+        return result
+
+    def __contains__(self, key):
+        return key in self.results
+
+    def notify(self, source, row, events):
+        """ Start a new version on a write to the rows of the owner or of any set derived from it. """
+        if source.EVENT_UPDATED in events or source.EVENT_DELETED in events:
+            self.version += 1
+        elif source.EVENT_ADDED in events and source is self.owner:
+            self.version += 1
+
+    def replace(self, row, copied):
+        # Cached results hold the row, which the owner copied before writing it
+        self.version += 1
+
+    def undelete(self, row, sequence):
+        self.version += 1
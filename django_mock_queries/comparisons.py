@@ -1,12 +1,44 @@
 import re
 
+# Comparison functions receive the filter value (`second`) already prepared by
+# the matching `prepare_*_operand` function, so work that only depends on the
+# filter value is done once per query instead of once per row.
+
+
+def prepare_lower_operand(second):
+    return second.lower()
+
+
+def prepare_regex_operand(second):
+    return re.compile(second)
+
+
+def prepare_iregex_operand(second):
+    return re.compile(second, flags=re.I)
+
+
+def prepare_in_operand(second):
+    if isinstance(second, str) or not hasattr(second, '__iter__'):
+        return second
+
+    values = tuple(second)
+    try:
+        return frozenset(values)
+    except TypeError:
+        # Unhashable members, fall back to linear membership checks
+        return values
+
+
+def prepare_overlap_operand(second):
+    return frozenset(second)
+
 
 def exact_comparison(first, second):
     return first == second
 
 
 def iexact_comparison(first, second):
-    return first.lower() == second.lower()
+    return first.lower() == second
 
 
 def contains_comparison(first, second):
@@ -17,7 +49,7 @@ def contains_comparison(first, second):
 
 
 def icontains_comparison(first, second):
-    return second.lower() in first.lower()
+    return second in first.lower()
 
 
 def gt_comparison(first, second):
@@ -38,9 +70,16 @@ def lte_comparison(first, second):
 
 def in_comparison(first, second):
     if isinstance(first, list):
-        return bool(set(first).intersection(set(second)))
+        return any(x in second for x in first)
+
+    if first is None:
+        return False
 
-    return first in second if first is not None else False
+    try:
+        return first in second
+    except TypeError:
+        # Unhashable row value checked against a hashed operand
+        return any(first == x for x in second)
 
 
 def startswith_comparison(first, second):
@@ -48,7 +87,7 @@ def startswith_comparison(first, second):
 
 
 def istartswith_comparison(first, second):
-    return first.lower().startswith(second.lower())
+    return first.lower().startswith(second)
 
 
 def endswith_comparison(first, second):
@@ -56,7 +95,7 @@ def endswith_comparison(first, second):
 
 
 def iendswith_comparison(first, second):
-    return first.lower().endswith(second.lower())
+    return first.lower().endswith(second)
 
 
 def isnull_comparison(first, second):
@@ -64,11 +103,11 @@ def isnull_comparison(first, second):
 
 
 def regex_comparison(first, second):
-    return re.search(second, first) is not None
+    return second.search(first) is not None
 
 
 def iregex_comparison(first, second):
-    return re.search(second, first, flags=re.I) is not None
+    return second.search(first) is not None
 
 
 def range_comparison(first, second):
@@ -76,4 +115,4 @@ def range_comparison(first, second):
 
 
 def overlap_comparison(first, second):
-    return bool(set(first).intersection(set(second)))
+    return not second.isdisjoint(first)
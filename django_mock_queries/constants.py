@@ -20,7 +20,12 @@ COMPARISON_DATE = 'date'
 COMPARISON_YEAR = 'year'
 COMPARISON_MONTH = 'month'
 COMPARISON_DAY = 'day'
+COMPARISON_WEEK = 'week'
 COMPARISON_WEEK_DAY = 'week_day'
+COMPARISON_ISO_WEEK_DAY = 'iso_week_day'
+COMPARISON_QUARTER = 'quarter'
+COMPARISON_ISO_YEAR = 'iso_year'
+COMPARISON_TIME = 'time'
 COMPARISON_HOUR = 'hour'
 COMPARISON_MINUTE = 'minute'
 COMPARISON_SECOND = 'second'
@@ -49,22 +54,60 @@ COMPARISONS = (
 DATE_COMPARISONS = (
     COMPARISON_DATE,
     COMPARISON_YEAR,
+    COMPARISON_ISO_YEAR,
+    COMPARISON_QUARTER,
     COMPARISON_MONTH,
+    COMPARISON_WEEK,
     COMPARISON_DAY,
     COMPARISON_WEEK_DAY,
+    COMPARISON_ISO_WEEK_DAY,
 )
 DATETIME_COMPARISONS = (
     COMPARISON_DATE,
     COMPARISON_YEAR,
+    COMPARISON_ISO_YEAR,
+    COMPARISON_QUARTER,
     COMPARISON_MONTH,
+    COMPARISON_WEEK,
     COMPARISON_DAY,
     COMPARISON_WEEK_DAY,
+    COMPARISON_ISO_WEEK_DAY,
+    COMPARISON_TIME,
     COMPARISON_HOUR,
     COMPARISON_MINUTE,
     COMPARISON_SECOND,
 )
 
+# Relative cost of checking one row, for ordering the lookups of a filter
+COMPARISON_COSTS = {
+    COMPARISON_EXACT: 1,
+    COMPARISON_ISNULL: 1,
+    COMPARISON_IN: 1,
+    COMPARISON_GT: 1,
+    COMPARISON_GTE: 1,
+    COMPARISON_LT: 1,
+    COMPARISON_LTE: 1,
+    COMPARISON_RANGE: 1.5,
+    COMPARISON_IEXACT: 2,
+    COMPARISON_CONTAINS: 2,
+    COMPARISON_STARTSWITH: 2,
+    COMPARISON_ENDSWITH: 2,
+    COMPARISON_ICONTAINS: 3,
+    COMPARISON_ISTARTSWITH: 3,
+    COMPARISON_IENDSWITH: 3,
+    COMPARISON_OVERLAP: 3,
+    COMPARISON_REGEX: 6,
+    COMPARISON_IREGEX: 8,
+}
+DATETIME_COMPARISON_COST = 2
+RELATION_HOP_COST = 4
+PREDICATE_SAMPLE_SIZE = 32
+# Characters read at a time from a fixture file
+FIXTURE_CHUNK_SIZE = 65536
+
+QUARTER_BOUNDS = (1, 4)
 MONTH_BOUNDS = (1, 12)
+WEEK_BOUNDS = (1, 53)
 DAY_BOUNDS = (1, 31)
 WEEK_DAY_BOUNDS = (1, 7)
 HOUR_BOUNDS = (0, 23)
@@ -95,6 +138,12 @@ AGGREGATES = (
 
 DjangoQ = locate('django.db.models.Q')
 DjangoQuerySet = locate('django.db.models.QuerySet')
+DjangoModel = locate('django.db.models.Model')
+DjangoSubquery = locate('django.db.models.Subquery')
+DjangoExists = locate('django.db.models.Exists')
+DjangoOuterRef = locate('django.db.models.OuterRef')
+DjangoPrefetch = locate('django.db.models.Prefetch')
+DjangoNegatedExpression = locate('django.db.models.expressions.NegatedExpression')
 DjangoDbRouter = locate('django.db.router')
 DjangoModelDeletionCollector = locate('django.db.models.deletion.Collector')
 ObjectDoesNotExist = locate('django.core.exceptions.ObjectDoesNotExist')
@@ -0,0 +1,718 @@
+from collections import defaultdict
+
+from django.core.exceptions import FieldDoesNotExist, FieldError
+from django.db.models import ForeignObjectRel
+
+from .constants import *
+from .instrumentation import record_query
+from .query import MockSet, recorded
+from .transactions import is_journaling, journal
+from .utils import (
+    lookup_comparison, join_key, convert_to_pks, is_list_like_iter, get_accessor_name, get_prefetched,
+    forget_prefetched, first_matches, is_subquery
+)
+
+AutoFieldMixin = locate('django.db.models.fields.AutoFieldMixin')
+
+
+class ForeignKeyIndex:
+    """ Hash index of the rows of a MockTable by the value of one column. """
+
+    def __init__(self, attname):
+        self.attname = attname
+        self.buckets = defaultdict(dict)
+        self.keys = {}
+
+    def add(self, row):
+        key = getattr(row, self.attname, None)
+        self.buckets[key][id(row)] = row
+        self.keys[id(row)] = key
+
+    def remove(self, row):
+        key = self.keys.pop(id(row), None)
+        bucket = self.buckets.get(key, {})
+        bucket.pop(id(row), None)
+
+        if not bucket:
+            self.buckets.pop(key, None)
+
+    def update(self, row):
+        self.remove(row)
+        self.add(row)
+
+    def lookup(self, *keys):
+        rows = []
+        for key in keys:
+            rows.extend(self.buckets.get(key, {}).values())
+        return rows
+
+
+class ThroughTable:
+    """ Links of a many-to-many relation, hash indexed on both foreign key columns.
+
+    Rows are instances of the relation's through model, stored by their
+    `(source key, target key)` pair.
+    """
+
+    def __init__(self, field):
+        self.model = field.remote_field.through
+        self.source_fk = self.model._meta.get_field(field.m2m_field_name())
+        self.target_fk = self.model._meta.get_field(field.m2m_reverse_field_name())
+        self.symmetrical = field.remote_field.symmetrical and field.model == field.related_model
+        self.rows = {}
+        self.indexes = {
+            self.source_fk.attname: ForeignKeyIndex(self.source_fk.attname),
+            self.target_fk.attname: ForeignKeyIndex(self.target_fk.attname),
+        }
+
+    def sides(self, reverse=False):
+        """ The (own, other) foreign keys seen from one side of the relation. """
+        return (self.target_fk, self.source_fk) if reverse else (self.source_fk, self.target_fk)
+
+    def pair(self, instance, obj, reverse=False):
+        own_fk, other_fk = self.sides(reverse)
+        keys = getattr(instance, own_fk.target_field.attname), getattr(obj, other_fk.target_field.attname)
+
+        return tuple(reversed(keys)) if reverse else keys
+
+    def link(self, source_key, target_key, **defaults):
+        if (source_key, target_key) in self.rows:
+            return
+
+        row = self.model(**dict(defaults, **{
+            self.source_fk.attname: source_key,
+            self.target_fk.attname: target_key,
+        }))
+        self._store(row)
+        journal(self.unlink, source_key, target_key)
+
+        if self.symmetrical:
+            self.link(target_key, source_key, **defaults)
+
+    def unlink(self, source_key, target_key):
+        row = self.rows.pop((source_key, target_key), None)
+
+        if row is not None:
+            for index in self.indexes.values():
+                index.remove(row)
+            journal(self._store, row)
+
+        if row is not None and self.symmetrical:
+            self.unlink(target_key, source_key)
+
+    def _store(self, row):
+        self.rows[getattr(row, self.source_fk.attname), getattr(row, self.target_fk.attname)] = row
+
+        for index in self.indexes.values():
+            index.add(row)
+
+    def linked(self, fk, *keys):
+        """ Keys on the other column of the rows whose `fk` column is one of `keys`. """
+        other_fk = self.target_fk if fk is self.source_fk else self.source_fk
+        return [getattr(row, other_fk.attname) for row in self.indexes[fk.attname].lookup(*keys)]
+
+    def discard(self, row):
+        """ Drop every link of a deleted row of either related model. """
+        for fk in (self.source_fk, self.target_fk):
+            if isinstance(row, fk.related_model):
+                key = getattr(row, fk.target_field.attname)
+
+                for link in self.indexes[fk.attname].lookup(key):
+                    self.unlink(getattr(link, self.source_fk.attname), getattr(link, self.target_fk.attname))
+
+
+class MockTable(MockSet):
+    """ Root MockSet of a model in a MockDatabase.
+
+    Rows are indexed by primary key and by every foreign key column, and the
+    indexes are kept up to date on add, update, save and delete. The field
+    values of each row as of its last save are kept, to roll back the fields
+    set on it before the saves made in a transaction.
+    """
+
+    def __init__(self, *initial_items, **kwargs):
+        database = kwargs.pop('database', None)
+        super().__init__(*initial_items, **kwargs)
+
+        self.database = database
+        self.sequence = {}
+        self.next_sequence = 0
+        self.indexes = {}
+        self.saved = {}
+        self.attnames = [field.attname for field in self.model._meta.concrete_fields]
+
+        meta = self.model._meta
+        for field in [meta.pk] + [f for f in meta.concrete_fields if f.many_to_one or f.one_to_one]:
+            self.indexes[field.attname] = ForeignKeyIndex(field.attname)
+            self.indexes.setdefault(field.name, self.indexes[field.attname])
+        self.indexes['pk'] = self.indexes[meta.pk.attname]
+
+        self.on(self.EVENT_UPDATED, self._reindex)
+        self.on(self.EVENT_SAVED, self._remember)
+        self.on(self.EVENT_DELETED, self._untrack)
+
+    def _mockset_class(self):
+        return MockSet
+
+    def tracks(self, row):
+        return id(row) in self.sequence
+
+    def _track(self, row):
+        self.sequence[id(row)] = self.next_sequence
+        self.next_sequence += 1
+
+        for index in set(self.indexes.values()):
+            index.add(row)
+
+    def _untrack(self, row):
+        self.sequence.pop(id(row), None)
+        self.saved.pop(id(row), None)
+
+        for index in set(self.indexes.values()):
+            index.remove(row)
+
+        if self.database is not None:
+            self.database.unlink(row)
+
+    def _remember(self, row):
+        self.saved[id(row)] = tuple(getattr(row, attname) for attname in self.attnames)
+
+    def save_row(self, row):
+        """ Store the fields set on a tracked `row`, like saving it. """
+        if is_journaling() and id(row) in self.saved:
+            journal(self._undo_update, row, dict(zip(self.attnames, self.saved[id(row)])))
+
+        self.fire(row, self.EVENT_UPDATED, self.EVENT_SAVED)
+
+    def _undo_update(self, row, values):
+        super()._undo_update(row, values)
+        self._remember(row)
+
+    def index(self, attname):
+        """ The hash index of a column, built on first use. """
+        if attname not in self.indexes:
+            self.indexes[attname] = ForeignKeyIndex(attname)
+
+            for row in self.items:
+                self.indexes[attname].add(row)
+
+        return self.indexes[attname]
+
+    def _reindex(self, row):
+        if self.tracks(row):
+            for index in set(self.indexes.values()):
+                index.update(row)
+
+    def _prepare_row(self, row):
+        meta = self.model._meta
+
+        for field in meta.concrete_fields:
+            if isinstance(field, AutoFieldMixin) and getattr(row, field.attname) is None:
+                setattr(row, field.attname, self.database.next_pk(field.model))
+            elif isinstance(field, AutoFieldMixin):
+                self.database.seen_pk(field.model, getattr(row, field.attname))
+            elif field.is_relation and field.is_cached(row):
+                # Related instances must be stored before the row, like Model.save() requires
+                related = field.get_cached_value(row)
+                table = self.database.tables.get(type(related))
+
+                if related is not None and table is not None and not table.tracks(related):
+                    table.add(related)
+                if related is not None and getattr(row, field.attname) is None:
+                    setattr(row, field.name, related)
+
+    def add(self, *models):
+        rows = [row for row in models if not self.tracks(row)]
+
+        for row in rows:
+            self._prepare_row(row)
+            self._track(row)
+
+        super().add(*rows)
+
+    def _sequences(self, row):
+        return super()._sequences(row) + [(self, self.sequence.get(id(row)))]
+
+    def undelete(self, row, sequence):
+        """ Track `row` again at `sequence`, when its delete is undone. """
+        if sequence is not None:
+            self._track(row)
+            self._remember(row)
+            self.sequence[id(row)] = sequence
+
+    def _lookup_keys(self, attr, rest, value, related_model):
+        """ Keys of the related rows matched by the part of a lookup after the relation name. """
+        if rest in ([], [COMPARISON_EXACT]):
+            return [join_key(value)]
+        elif rest == [COMPARISON_IN] and isinstance(value, MockSet):
+            return [join_key(x) for x in convert_to_pks(value)]
+        elif rest == [COMPARISON_IN] and is_list_like_iter(value):
+            return [join_key(x) for x in value]
+        elif lookup_comparison(attr) is not None and len(rest) == 1:
+            return None
+
+        # Join through a relation, e.g. `make__name`, using the related table
+        related_table = self.database.tables.get(related_model)
+
+        if related_table is None:
+            return None
+
+        return [row.pk for row in related_table.filter(**{'__'.join(rest): value})]
+
+    def _many_to_many_keys(self, attr, name, rest, value):
+        field = self.model._meta.get_field(name)
+
+        if not field.many_to_many:
+            return None
+
+        through = self.database.through(field.field if isinstance(field, ForeignObjectRel) else field)
+        own_fk, other_fk = through.sides(reverse=isinstance(field, ForeignObjectRel))
+        related_keys = self._lookup_keys(attr, rest, value, other_fk.related_model)
+
+        if related_keys is None:
+            return None
+
+        return self.index(own_fk.target_field.attname), through.linked(other_fk, *set(related_keys))
+
+    def _index_keys(self, attr, value):
+        """ The index and keys that narrow down the rows matching one lookup, if any. """
+        parts = attr.split('__')
+        name, rest = parts[0], parts[1:]
+
+        if value is None:
+            return None
+        elif name not in self.indexes:
+            return self._many_to_many_keys(attr, name, rest, value)
+
+        related_model = getattr(self.model._meta.get_field(name), 'related_model', None) if name != 'pk' else None
+        keys = self._lookup_keys(attr, rest, value, related_model)
+
+        return (self.indexes[name], keys) if keys is not None else None
+
+    def _index_candidates(self, attrs):
+        """ The rows found in the indexes for the lookups that have one, and the names of those lookups. """
+        candidates = None
+        used = []
+
+        for attr, value in attrs.items():
+            try:
+                index_keys = self._index_keys(attr, value)
+            except (TypeError, FieldError, FieldDoesNotExist):
+                index_keys = None
+
+            if index_keys is None:
+                continue
+
+            index, keys = index_keys
+            used.append(attr)
+            rows = {id(row): row for row in index.lookup(*set(keys))}
+            candidates = rows if candidates is None else {k: v for k, v in candidates.items() if k in rows}
+
+        if candidates is None:
+            return None, used
+
+        return sorted(candidates.values(), key=lambda row: self.sequence[id(row)]), used
+
+    def _matching(self, limit, *args, **attrs):
+        candidates, _ = self._index_candidates(attrs) if self.database and self._correlation is None else (None, [])
+
+        if candidates is None or args or any(is_subquery(value) for value in attrs.values()):
+            return super()._matching(limit, *args, **attrs)
+
+        return first_matches(candidates, limit, **attrs)
+
+    @recorded()
+    def filter(self, *args, **attrs):
+        candidates, used = self._index_candidates(attrs) if self.database and self._correlation is None else (None, [])
+
+        if candidates is None:
+            return super().filter(*args, **attrs)
+
+        # Rows found in the indexes are still checked against every lookup
+        found = self._mockset_class()(*candidates, clone=self)
+        found._access = 'index lookup on {}'.format(', '.join(used))
+        return found.filter(*args, **attrs)
+
+
+class RelatedMockSet(MockSet):
+    """ The rows of a MockTable that reference `instance` through `field`. """
+
+    def __init__(self, *initial_items, **kwargs):
+        instance = kwargs.pop('instance', None)
+        field = kwargs.pop('field', None)
+        cache_name = kwargs.pop('cache_name', None)
+        super().__init__(*initial_items, **kwargs)
+
+        self.instance = instance
+        self.field = field
+        self.cache_name = cache_name
+
+    def _mockset_class(self):
+        return MockSet
+
+    def _forget_prefetched(self):
+        # Like Django, changing the relation drops the rows cached by prefetch_related()
+        if self.cache_name is not None:
+            forget_prefetched(self.instance, self.cache_name)
+
+    def _attach(self, obj):
+        setattr(obj, self.field.name, self.instance)
+
+        if self.clone.tracks(obj):
+            self.clone.save_row(obj)
+        else:
+            self.clone.add(obj)
+
+    def add(self, *models):
+        if models:
+            record_query(self.label, 'add')
+            self._forget_prefetched()
+
+        for obj in models:
+            self._attach(obj)
+
+        super().add(*[obj for obj in models if obj not in self.items])
+
+    def create(self, **attrs):
+        self._forget_prefetched()
+        attrs[self.field.name] = self.instance
+        obj = self.clone.create(**attrs)
+        super().add(obj)
+
+        return obj
+
+    def remove(self, *objs, **attrs):
+        self._forget_prefetched()
+
+        if not objs:
+            return super().remove(**attrs)
+
+        record_query(self.label, 'remove')
+
+        for obj in objs:
+            if self.field.null:
+                setattr(obj, self.field.name, None)
+                self.clone.save_row(obj)
+            else:
+                self.clone._delete_recursive(obj)
+
+            if obj in self.items:
+                self.items.remove(obj)
+
+    def set(self, objs, **attrs):
+        objs = list(objs)
+        self.remove(*[obj for obj in self.items if obj not in objs])
+        self.add(*objs)
+
+
+class ManyRelatedMockSet(MockSet):
+    """ The rows of a MockTable linked to `instance` through a ThroughTable. """
+
+    def __init__(self, *initial_items, **kwargs):
+        instance = kwargs.pop('instance', None)
+        through = kwargs.pop('through', None)
+        reverse = kwargs.pop('reverse', False)
+        cache_name = kwargs.pop('cache_name', None)
+        super().__init__(*initial_items, **kwargs)
+
+        self.instance = instance
+        self.through = through
+        self.reverse = reverse
+        self.cache_name = cache_name
+
+    def _mockset_class(self):
+        return MockSet
+
+    def _forget_prefetched(self):
+        if self.cache_name is not None:
+            forget_prefetched(self.instance, self.cache_name)
+
+    def _row(self, obj):
+        if isinstance(obj, self.model):
+            return obj
+
+        # Like Django, related objects can also be given by primary key
+        rows = self.clone.indexes['pk'].lookup(obj)
+        if not rows:
+            self._raise_does_not_exist()
+
+        return rows[0]
+
+    def add(self, *objs, through_defaults=None):
+        if objs:
+            record_query(self.label, 'add')
+            self._forget_prefetched()
+
+        for obj in map(self._row, objs):
+            if not self.clone.tracks(obj):
+                self.clone.add(obj)
+
+            pair = self.through.pair(self.instance, obj, self.reverse)
+            if pair not in self.through.rows:
+                self.through.link(*pair, **(through_defaults or {}))
+                super().add(obj)
+
+    def create(self, through_defaults=None, **attrs):
+        obj = self.clone.create(**attrs)
+        self.add(obj, through_defaults=through_defaults)
+
+        return obj
+
+    def remove(self, *objs):
+        if objs:
+            record_query(self.label, 'remove')
+
+        self._forget_prefetched()
+        removed = set()
+
+        for obj in map(self._row, objs):
+            self.through.unlink(*self.through.pair(self.instance, obj, self.reverse))
+            removed.add(id(obj))
+
+        self.items[:] = [obj for obj in self.items if id(obj) not in removed]
+
+    def clear(self):
+        self.remove(*self.items)
+
+    def set(self, objs, clear=False, through_defaults=None):
+        objs = [self._row(obj) for obj in objs]
+
+        if clear:
+            self.clear()
+        else:
+            kept = {id(obj) for obj in objs}
+            self.remove(*[obj for obj in self.items if id(obj) not in kept])
+
+        self.add(*objs, through_defaults=through_defaults)
+
+
+class MockForwardRelation:
+    def __init__(self, database, original):
+        """ Resolve a foreign key from the related MockTable by primary key. """
+        self.database = database
+        self.original = original
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        field = self.original.field
+        table = self.database.tables.get(field.related_model)
+
+        if table is None or field.is_cached(instance):
+            return self.original.__get__(instance, owner)
+
+        record_query('{}.{}'.format(owner.__name__, field.name), 'get')
+        pk = getattr(instance, field.attname)
+        related = next(iter(table.indexes['pk'].lookup(pk)), None) if pk is not None else None
+
+        if related is None and not field.null:
+            raise self.original.RelatedObjectDoesNotExist(
+                "Mock {} has no {}.".format(owner.__name__, field.name)
+            )
+
+        field.set_cached_value(instance, related)
+        return related
+
+    def __set__(self, instance, value):
+        self.original.__set__(instance, value)
+        self.database.reindex(instance)
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+
+class MockReverseRelation:
+    def __init__(self, database, original):
+        """ Serve a reverse foreign key from the FK index of the related MockTable. """
+        self.database = database
+        self.original = original
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return self.database.related(
+            instance, getattr(self.original, 'related', self.original), get_accessor_name(self.original)
+        )
+
+    def __set__(self, instance, value):
+        self.__get__(instance, type(instance)).set(value)
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+
+class MockReverseOneToOneRelation(MockReverseRelation):
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        related = self.original.related
+        if related.is_cached(instance):
+            related_object = related.get_cached_value(instance)
+        else:
+            record_query('{}.{}'.format(owner.__name__, related.get_accessor_name()), 'get')
+            related_object = next(iter(self.database.related(instance, related).items), None)
+
+        if related_object is None:
+            raise self.original.RelatedObjectDoesNotExist(
+                "Mock {} has no {}.".format(owner.__name__, related.get_accessor_name())
+            )
+
+        return related_object
+
+    def __set__(self, instance, value):
+        self.database.related(instance, self.original.related).set([value])
+        self.original.related.set_cached_value(instance, value)
+
+
+class MockManyToManyRelation:
+    def __init__(self, database, original):
+        """ Serve either side of a many-to-many relation from a ThroughTable. """
+        self.database = database
+        self.original = original
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        return self.database.many_related(
+            instance, self.original.field, self.original.reverse, get_accessor_name(self.original)
+        )
+
+    def __set__(self, instance, value):
+        # Direct assignment is prohibited, let Django raise its error
+        self.original.__set__(instance, value)
+
+    def __getattr__(self, name):
+        return getattr(self.original, name)
+
+
+class MockDatabase:
+    """ In-memory relational store shared by the mocked models.
+
+    Owns one MockTable per model that backs `Model.objects`, `save()`, `delete()`
+    and both directions of foreign key relations, so `car.variations.all()` and
+    `CarVariation.objects.filter(car=car)` see the same rows.
+
+    @mocked_relations(Car, CarVariation, database=MockDatabase())
+    def test_variations(self):
+        car = Car.objects.create(speed=1)
+        car.variations.create(color='red')
+        assert CarVariation.objects.filter(car=car).count() == 1
+    """
+
+    def __init__(self):
+        self.tables = {}
+        self.through_tables = {}
+        self.last_pks = {}
+
+    def table(self, model, **kwargs):
+        if model not in self.tables:
+            self.tables[model] = MockTable(model=model, database=self, **kwargs)
+        return self.tables[model]
+
+    def through(self, field):
+        """ The ThroughTable of a many-to-many field. """
+        model = field.remote_field.through
+        if model not in self.through_tables:
+            self.through_tables[model] = ThroughTable(field)
+        return self.through_tables[model]
+
+    def next_pk(self, model):
+        self.last_pks[model] = self.last_pks.get(model, 0) + 1
+        return self.last_pks[model]
+
+    def seen_pk(self, model, pk):
+        if isinstance(pk, int):
+            self.last_pks[model] = max(self.last_pks.get(model, 0), pk)
+
+    def reindex(self, instance):
+        table = self.tables.get(type(instance))
+        if table is not None and table.tracks(instance):
+            table.fire(instance, table.EVENT_UPDATED)
+
+    def unlink(self, row):
+        for through in self.through_tables.values():
+            through.discard(row)
+
+    def save(self, instance, *_, **__):
+        table = self.table(type(instance))
+        record_query(table.label, 'save')
+
+        if table.tracks(instance):
+            table.save_row(instance)
+        else:
+            table.add(instance)
+
+    def delete(self, instance, *_, **__):
+        table = self.table(type(instance))
+        record_query(table.label, 'delete')
+
+        if instance.pk is None:
+            raise ValueError(
+                "{} object can't be deleted because its {} attribute is set to None.".format(
+                    instance._meta.object_name, instance._meta.pk.attname
+                )
+            )
+
+        return table._delete_recursive(*[row for row in table.items if row is instance])
+
+    def _label(self, instance, cache_name):
+        return '{}.{}'.format(type(instance).__name__, cache_name) if cache_name is not None else None
+
+    def related(self, instance, relation, cache_name=None):
+        """ The rows of the related table that reference `instance` through `relation`.
+
+        Rows cached by prefetch_related() under `cache_name` are used instead of the index.
+        """
+        field = relation.field
+        key = getattr(instance, field.target_field.attname)
+
+        if key is None:
+            raise ValueError(
+                "{!r} instance needs to have a primary key value before this relationship can be used.".format(
+                    type(instance).__name__
+                )
+            )
+
+        table = self.table(field.model)
+        prefetched = get_prefetched(instance, cache_name) if cache_name is not None else None
+        related_objects = RelatedMockSet(
+            clone=table, instance=instance, field=field, cache_name=cache_name,
+            label=self._label(instance, cache_name)
+        )
+        related_objects.items.extend(prefetched if prefetched is not None else table.indexes[field.attname].lookup(key))
+        related_objects._fetched = prefetched is not None
+
+        return related_objects
+
+    def many_related(self, instance, field, reverse=False, cache_name=None):
+        """ The rows of the related table linked to `instance` through a many-to-many `field`. """
+        through = self.through(field)
+        own_fk, other_fk = through.sides(reverse)
+        key = getattr(instance, own_fk.target_field.attname)
+
+        if key is None:
+            raise ValueError(
+                '"{!r}" needs to have a value for field "{}" before this many-to-many relationship can be used.'.format(
+                    instance, own_fk.target_field.attname
+                )
+            )
+
+        table = self.table(other_fk.related_model)
+        prefetched = get_prefetched(instance, cache_name) if cache_name is not None else None
+        related_objects = ManyRelatedMockSet(
+            clone=table, instance=instance, through=through, reverse=reverse, cache_name=cache_name,
+            label=self._label(instance, cache_name)
+        )
+
+        if prefetched is not None:
+            related_objects.items.extend(prefetched)
+            related_objects._fetched = True
+        else:
+            index = table.index(other_fk.target_field.attname)
+            related_objects.items.extend(index.lookup(*through.linked(own_fk, key)))
+
+        return related_objects
@@ -0,0 +1,449 @@
+import operator
+from contextlib import ContextDecorator
+from itertools import chain
+from unittest.mock import MagicMock
+
+from django.apps import apps
+from django.db.models import Model
+from django.db.models.expressions import Ref
+from django.db.models.sql.constants import CURSOR, MULTI, NO_RESULTS, SINGLE
+from django.db.models.sql.datastructures import Join
+from django.db.models.sql.where import AND, OR, NothingNode, WhereNode
+from django.db.utils import NotSupportedError
+
+from .constants import *
+from .instrumentation import record_query
+from .query import MockSet
+from .transactions import is_journaling, journal
+from .utils import DATE_PART_EXTRACTORS, COMPARISON_FUNCTIONS, is_match
+
+AutoFieldMixin = locate('django.db.models.fields.AutoFieldMixin')
+
+REF = 'ref'
+
+EXECUTORS = {
+    'SQLCompiler': '_execute_select',
+    'SQLAggregateCompiler': '_execute_aggregate',
+    'SQLInsertCompiler': '_execute_insert',
+    'SQLUpdateCompiler': '_execute_update',
+    'SQLDeleteCompiler': '_execute_delete',
+}
+
+OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '*': operator.mul,
+    '/': lambda a, b: a // b if isinstance(a, int) and isinstance(b, int) else a / b,
+    '%%': operator.mod,
+    '^': operator.pow,
+}
+
+FUNCTIONS = {
+    'Lower': lambda value: value.lower(),
+    'Upper': lambda value: value.upper(),
+    'Length': len,
+    'Abs': abs,
+}
+
+AGGREGATES = {
+    'Count': len,
+    'Sum': lambda values: sum(values) if values else None,
+    'Avg': lambda values: sum(values) / len(values) if values else None,
+    'Min': lambda values: min(values) if values else None,
+    'Max': lambda values: max(values) if values else None,
+}
+
+_engines = []
+
+
+def active_engine():
+    return _engines[-1] if _engines else None
+
+
+def _unknown(values):
+    return any(value is None for value in values)
+
+
+def _sort_key(value):
+    # SQLite sorts NULL before any other value
+    return (value is not None, value)
+
+
+class QueryEngine(ContextDecorator):
+    """ Run the queries of real QuerySets against in-memory MockSets while active.
+
+    The mocked connection of `monkey_patch_test_db()` or `mock_django_setup()`
+    hands the compiled `Query` of a QuerySet to the engine, which evaluates its
+    where tree, joins, ordering, limits, annotations and aggregates against the
+    rows registered for each model, so `Model.objects` doesn't need patching.
+
+    with QueryEngine({Manufacturer: [vw], Car: [Car(make=vw, speed=1)]}):
+        assert Car.objects.filter(make__name='vw').count() == 1
+
+    Inserts, updates and deletes change the registered MockSets. Grouping,
+    raw SQL, combined queries and correlated subqueries raise NotSupportedError.
+    """
+
+    def __init__(self, tables=None):
+        self.tables = {}
+        # The largest integer primary key stored in each table so far, like the sequence of an auto field
+        self.last_pks = {}
+        self._models = None
+        self._connection = None
+
+        for model, rows in (tables or {}).items():
+            self.register(model, *rows)
+
+    def register(self, model, *rows):
+        """ Store copies of model instances in the table of `model`, assigning missing auto primary keys. """
+        table = self.table(model)
+        meta = table.model._meta
+        attnames = [field.attname for field in meta.local_concrete_fields]
+
+        for row in rows:
+            if isinstance(meta.pk, AutoFieldMixin) and getattr(row, meta.pk.attname) is None:
+                setattr(row, meta.pk.attname, self._next_pk(table))
+
+            for field in meta.local_concrete_fields:
+                # Related instances may have been given their keys after the row was built
+                if field.is_relation and field.is_cached(row) and getattr(row, field.attname) is None:
+                    setattr(row, field.name, field.get_cached_value(row))
+
+            table.add(table.model.from_db(None, attnames, [row.__dict__.get(attname) for attname in attnames]))
+
+        return table
+
+    def table(self, model):
+        """ The MockSet that stores the rows of `model`. """
+        model = model._meta.concrete_model
+        if model not in self.tables:
+            self.tables[model] = MockSet(model=model)
+            self.tables[model].on(MockSet.EVENT_ADDED, self._seen_pk)
+        return self.tables[model]
+
+    def __enter__(self):
+        _engines.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _engines.remove(self)
+        return False
+
+    def _next_pk(self, table):
+        return self.last_pks.get(table.model, 0) + 1
+
+    def _seen_pk(self, row):
+        model, pk = row._meta.concrete_model, row.pk
+        if isinstance(pk, int) and pk > self.last_pks.get(model, 0):
+            self.last_pks[model] = pk
+
+    def _model(self, table_name):
+        if self._models is None:
+            self._models = {
+                model._meta.db_table: model
+                for model in apps.get_models(include_auto_created=True)
+                if not model._meta.proxy
+            }
+        return self._models[table_name]
+
+    def compiler(self, connection, compiler_name, query, using, elide_empty=True):
+        """ A compiler of `connection` whose results come from the engine instead of SQL. """
+        if compiler_name not in EXECUTORS:
+            raise NotSupportedError('Query engine does not support {}.'.format(compiler_name))
+
+        result = connection.ops.compiler(compiler_name)(query, connection, using, elide_empty)
+        execute = getattr(self, EXECUTORS[compiler_name])
+        self._connection = (connection, using)
+
+        result.execute_sql = lambda *args, **kwargs: execute(result, *args, **kwargs)
+        result.results_iter = lambda results=None, tuple_expected=False, **kwargs: map(
+            tuple, chain.from_iterable(results if results is not None else result.execute_sql(MULTI))
+        )
+        return result
+
+    def _execute_select(self, compiler, result_type=MULTI, chunked_fetch=False, chunk_size=None):
+        record_query(compiler.query.model._meta.object_name, 'select', rows=self._scanned(compiler.query))
+        rows = self._select(compiler)
+
+        if result_type == MULTI:
+            return [rows]
+        elif result_type == SINGLE:
+            return rows[0] if rows else None
+        elif result_type == NO_RESULTS:
+            return None
+        elif result_type == CURSOR:
+            return MagicMock(name='mock_connection.cursor()', rowcount=len(rows))
+
+        return len(rows)
+
+    def _execute_aggregate(self, compiler, result_type=SINGLE, **kwargs):
+        query = compiler.query
+        record_query(query.model._meta.object_name, 'aggregate', rows=self._scanned(query.inner_query))
+
+        inner = self.compiler(compiler.connection, 'SQLCompiler', query.inner_query, compiler.using)
+        inner_rows = [
+            {(REF, alias): value for (_, _, alias), value in zip(inner.select, row) if alias is not None}
+            for row in self._select(inner)
+        ]
+        result = tuple(
+            self.evaluate(annotation, inner_rows[0] if inner_rows else {}, inner_rows)
+            for annotation in query.annotation_select.values()
+        )
+
+        return [[result]] if result_type == MULTI else result
+
+    def _execute_insert(self, compiler, returning_fields=None):
+        query = compiler.query
+        meta = query.get_meta()
+        table = self.table(query.model)
+        fields = meta.local_concrete_fields
+        record_query(meta.object_name, 'insert', rows=len(query.objs))
+
+        rows = []
+        for obj in query.objs:
+            values = {field.attname: compiler.pre_save_val(field, obj) for field in query.fields}
+            row = query.model.from_db(compiler.using, [f.attname for f in fields], [
+                values.get(field.attname) for field in fields
+            ])
+            if isinstance(meta.pk, AutoFieldMixin) and getattr(row, meta.pk.attname) is None:
+                setattr(row, meta.pk.attname, self._next_pk(table))
+
+            table.add(row)
+            rows.append(tuple(getattr(row, field.attname) for field in returning_fields or []))
+
+        return rows if returning_fields else []
+
+    def _execute_update(self, compiler, result_type=None):
+        query = compiler.query
+        if query.related_updates:
+            raise NotSupportedError('Query engine does not support updates of inherited fields.')
+
+        table = self.table(query.model)
+        base = query.get_initial_alias()
+        record_query(query.model._meta.object_name, 'update', rows=self._scanned(query))
+
+        rows = self._base_rows(query)
+        for row in rows:
+            if is_journaling():
+                journal(table._undo_update, row, {field.attname: getattr(row, field.attname)
+                                                  for field, _, _ in query.values})
+
+            for field, _, value in query.values:
+                if hasattr(value, 'resolve_expression'):
+                    value = value.resolve_expression(query, allow_joins=False, for_save=True)
+                    value = self.evaluate(value, {base: row})
+                elif hasattr(value, 'prepare_database_save') and field.remote_field:
+                    value = value.prepare_database_save(field)
+                setattr(row, field.attname, value)
+
+            table.fire(row, table.EVENT_UPDATED, table.EVENT_SAVED)
+
+        return len(rows)
+
+    def _execute_delete(self, compiler, result_type=None):
+        query = compiler.query
+        table = self.table(query.model)
+        record_query(query.model._meta.object_name, 'delete', rows=self._scanned(query))
+
+        rows = self._base_rows(query)
+        if rows:
+            # Like any other delete of the set, so it's journaled and seen by forks, indexes and live views
+            table._delete_recursive(*rows)
+
+        if result_type == CURSOR:
+            return MagicMock(name='mock_connection.cursor()', rowcount=len(rows))
+        return len(rows)
+
+    def _scanned(self, query):
+        """ The rows of the tables that a query reads, without the help of any index. """
+        tables = [self._model(join.table_name) for join in query.alias_map.values()] or [query.model]
+        return sum(len(self.table(model).items) for model in tables)
+
+    def _base_rows(self, query):
+        base = query.get_initial_alias()
+        rows = []
+
+        for joined in self._filtered(query):
+            if not any(row is joined[base] for row in rows):
+                rows.append(joined[base])
+
+        return rows
+
+    def _filtered(self, query):
+        """ The combinations of joined rows that satisfy the where clause, like the FROM and WHERE of SQL. """
+        if query.combinator:
+            raise NotSupportedError('Query engine does not support {} of querysets.'.format(query.combinator))
+
+        base = query.get_initial_alias()
+        joins = [
+            join for alias, join in query.alias_map.items()
+            if isinstance(join, Join) and query.alias_refcount[alias]
+        ]
+        results = []
+
+        for row in list(self.table(query.model).items):
+            for joined in self._join(joins, {base: row}):
+                if self.holds(query.where, joined) is True:
+                    results.append(joined)
+
+        return results
+
+    def _join(self, joins, joined):
+        if not joins:
+            yield joined
+            return
+
+        join, rest = joins[0], joins[1:]
+        if join.filtered_relation is not None:
+            raise NotSupportedError('Query engine does not support FilteredRelation.')
+
+        parent = joined.get(join.parent_alias)
+        matched = [] if parent is None else [
+            row for row in self.table(self._model(join.table_name)).items
+            if all(
+                parent.__dict__.get(lhs) == row.__dict__.get(rhs) and parent.__dict__.get(lhs) is not None
+                for lhs, rhs in self._join_attnames(join, type(parent))
+            )
+        ]
+
+        if not matched and join.join_type == 'LEFT OUTER JOIN':
+            matched = [None]
+
+        for row in matched:
+            yield from self._join(rest, dict(joined, **{join.table_alias: row}))
+
+    def _join_attnames(self, join, parent_model):
+        if join.join_fields is not None:
+            return [(lhs.attname, rhs.attname) for lhs, rhs in join.join_fields]
+
+        # Django < 5.0 only knows the columns of a join
+        model = self._model(join.table_name)
+        return [
+            (self._attname(parent_model, lhs), self._attname(model, rhs))
+            for lhs, rhs in join.join_cols
+        ]
+
+    def _attname(self, model, column):
+        return next(field.attname for field in model._meta.concrete_fields if field.column == column)
+
+    def _select(self, compiler):
+        """ The rows of a select query as tuples of its select columns. """
+        query = compiler.query
+        _, order_by, _ = compiler.pre_sql_setup()
+
+        if query.group_by is not None or compiler.having:
+            raise NotSupportedError('Query engine does not support grouping.')
+        if query.distinct_fields:
+            raise NotSupportedError('Query engine does not support DISTINCT ON fields.')
+
+        columns = [column for column, _, _ in compiler.select]
+        groups = self._filtered(query)
+
+        if any(column.contains_aggregate for column in columns):
+            return [tuple(self.evaluate(column, groups[0] if groups else {}, groups) for column in columns)]
+
+        for order, _ in reversed(order_by):
+            groups.sort(key=lambda joined: _sort_key(self.evaluate(order.expression, joined)), reverse=order.descending)
+
+        rows = [tuple(self.evaluate(column, joined) for column in columns) for joined in groups]
+
+        if query.distinct:
+            rows = list(dict.fromkeys(rows))
+
+        return rows[query.low_mark:query.high_mark]
+
+    def subquery(self, query):
+        """ The values of the first column of a subquery, like the operand of `__in`. """
+        compiler = self.compiler(*self._connection[:1], 'SQLCompiler', query, self._connection[1])
+        return [row[0] for row in self._select(compiler)]
+
+    def holds(self, node, joined):
+        """ Evaluate a where clause on a combination of joined rows, with the three-valued logic of SQL. """
+        if isinstance(node, NothingNode):
+            return False
+
+        if isinstance(node, WhereNode):
+            results = [self.holds(child, joined) for child in node.children]
+
+            if node.connector == AND:
+                result = False if False in results else None if None in results else True
+            elif node.connector == OR:
+                result = True if True in results else None if None in results else False
+            else:
+                result = None if None in results else sum(results) % 2 == 1
+
+            return (None if result is None else not result) if node.negated else result
+
+        if not hasattr(node, 'lookup_name'):
+            raise NotSupportedError('Query engine does not support {} filters.'.format(type(node).__name__))
+
+        return self._lookup(node, joined)
+
+    def _lookup(self, lookup, joined):
+        comparison = lookup.lookup_name
+        value = self.evaluate(lookup.lhs, joined)
+        operand = lookup.rhs
+
+        if comparison == COMPARISON_ISNULL:
+            return (value is None) == operand
+        if comparison not in COMPARISON_FUNCTIONS:
+            raise NotSupportedError('Query engine does not support the {} lookup.'.format(comparison))
+
+        if hasattr(operand, 'get_compiler'):
+            operand = self.subquery(operand)
+        elif hasattr(operand, 'resolve_expression'):
+            operand = self.evaluate(operand, joined)
+        elif comparison in (COMPARISON_IN, COMPARISON_RANGE):
+            operand = [self.evaluate(item, joined) if hasattr(item, 'resolve_expression') else item for item in operand]
+
+        if value is None or operand is None:
+            return None
+
+        return is_match(value, operand, comparison)
+
+    def evaluate(self, expression, joined, group=None):
+        """ The value of a resolved expression for a combination of joined rows, or a group of them. """
+        name = type(expression).__name__
+
+        if name == 'Col':
+            row = joined.get(expression.alias)
+            return None if row is None else row.__dict__.get(expression.target.attname)
+        elif name == 'Value':
+            return expression.value
+        elif isinstance(expression, Ref):
+            if (REF, expression.refs) in joined:
+                return joined[REF, expression.refs]
+            return self.evaluate(expression.source, joined, group)
+        elif name in AGGREGATES:
+            return self._aggregate(expression, group or [])
+        elif name == 'CombinedExpression':
+            values = [self.evaluate(source, joined, group) for source in expression.get_source_expressions()]
+            return None if _unknown(values) else OPERATORS[expression.connector](*values)
+        elif name in ('ExpressionWrapper', 'Cast'):
+            return self.evaluate(expression.get_source_expressions()[0], joined, group)
+        elif name == 'Coalesce':
+            values = (self.evaluate(source, joined, group) for source in expression.get_source_expressions())
+            return next((value for value in values if value is not None), None)
+        elif name in FUNCTIONS or getattr(expression, 'lookup_name', None) in DATE_PART_EXTRACTORS:
+            value = self.evaluate(expression.get_source_expressions()[0], joined, group)
+            function = FUNCTIONS.get(name) or DATE_PART_EXTRACTORS[expression.lookup_name]
+            return None if value is None else function(value)
+        elif isinstance(expression, Model):
+            return expression.pk
+
+        raise NotSupportedError('Query engine does not support {} expressions.'.format(name))
+
+    def _aggregate(self, aggregate, group):
+        source = aggregate.get_source_expressions()[0]
+
+        if aggregate.filter is not None:
+            group = [joined for joined in group if self.holds(aggregate.filter, joined) is True]
+        if type(source).__name__ == 'Star':
+            return len(group)
+
+        values = [self.evaluate(source, joined) for joined in group]
+        values = [value for value in values if value is not None]
+        if aggregate.distinct:
+            values = list(dict.fromkeys(values))
+
+        return AGGREGATES[type(aggregate).__name__](values)
@@ -4,3 +4,11 @@ class ModelNotSpecified(Exception):
 
 class ArgumentNotSupported(Exception):
     pass
+
+
+class NPlusOneQueries(AssertionError):
+    pass
+
+
+class TooManyQueries(AssertionError):
+    pass
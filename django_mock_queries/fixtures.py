@@ -0,0 +1,185 @@
+import csv
+import gc
+import json
+import re
+from contextlib import contextmanager
+from itertools import chain
+
+from django.apps import apps
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models.base import ModelState
+
+from .constants import *
+
+# Whitespace and the brackets and commas of a JSON list between the objects of a fixture
+SEPARATORS = re.compile(r'[\s\[\],]*')
+
+
+class RowBuilder:
+    """ Instances of a model made from dicts of field values without Model.__init__, like rows read from a database.
+
+    Fields are given by name or column, e.g. `make` or `make_id`, and missing
+    ones get their default. With `coerce`, values are converted by the
+    to_python() of their field, like strings read from CSV or dates and
+    decimals from JSON. No pre_init or post_init signals are sent.
+
+    builder = RowBuilder(Car, coerce=True)
+    car = builder.build({'id': '1', 'make': '2', 'speed': '100'})
+    """
+
+    def __init__(self, model, coerce=False):
+        meta = model._meta
+        self.model = model
+        self.coerce = coerce
+        self.fields = {}
+        self.defaults = {}
+        self.callable_defaults = []
+        self.many_to_many = {field.name for field in meta.many_to_many}
+        self.plans = {}
+
+        for field in meta.concrete_fields:
+            self.fields[field.name] = self.fields[field.attname] = field
+
+            if field.has_default() and callable(field.default):
+                self.callable_defaults.append(field)
+            else:
+                self.defaults[field.attname] = field.get_default()
+
+    def _plan(self, names):
+        """ What to do with each value of records of `names`: which to drop, rename, coerce or cache as relations. """
+        dropped, renamed, coerced, related = [], [], [], []
+
+        for name in names:
+            field = self.fields.get(name)
+
+            if field is None:
+                # Many-to-many links need a through table, other values are kept like annotations
+                if name in self.many_to_many:
+                    dropped.append(name)
+                continue
+
+            if name != field.attname:
+                renamed.append((name, field.attname))
+            if field.is_relation and name == field.name:
+                related.append(field)
+            if self.coerce:
+                coerced.append(field)
+
+        return dropped, renamed, coerced, related
+
+    def _coerce(self, field, value):
+        if value is None or (value == '' and not field.empty_strings_allowed):
+            return None
+        return field.to_python(value)
+
+    def build(self, values):
+        names = tuple(values)
+        plan = self.plans.get(names)
+        if plan is None:
+            plan = self.plans[names] = self._plan(names)
+        dropped, renamed, coerced, related = plan
+
+        attrs = self.defaults.copy()
+        attrs.update(values)
+
+        for field in self.callable_defaults:
+            if field.attname not in attrs:
+                attrs[field.attname] = field.get_default()
+        for name in dropped:
+            del attrs[name]
+
+        instances = [(field, attrs[field.name]) for field in related if isinstance(attrs[field.name], DjangoModel)]
+        for field, instance in instances:
+            attrs[field.name] = instance.pk
+        for name, attname in renamed:
+            attrs[attname] = attrs.pop(name)
+        for field in coerced:
+            attrs[field.attname] = self._coerce(field, attrs[field.attname])
+
+        attrs['_state'] = state = ModelState()
+        state.adding = False
+        state.db = DEFAULT_DB_ALIAS
+
+        row = self.model.__new__(self.model)
+        row.__dict__ = attrs
+
+        for field, instance in instances:
+            field.set_cached_value(row, instance)
+
+        return row
+
+
+@contextmanager
+def collection_paused():
+    """ No garbage collection while many rows are made, which would walk all the rows made so far again and again. """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def build_rows(records, model, coerce=False):
+    """ Instances of `model` made from dicts of field values by a RowBuilder. """
+    build = RowBuilder(model, coerce).build
+    return [build(values) for values in records]
+
+
+def read_fixture(path):
+    """ The objects of a `dumpdata` fixture in JSON or JSON lines, decoded one at a time while the file is read. """
+    decoder = json.JSONDecoder()
+    buffer, position = '', 0
+
+    with open(path, encoding='utf-8') as stream:
+        while True:
+            chunk = stream.read(FIXTURE_CHUNK_SIZE)
+            buffer, position = buffer[position:] + chunk, 0
+
+            while True:
+                position = SEPARATORS.match(buffer, position).end()
+                if position == len(buffer):
+                    break
+
+                try:
+                    obj, position = decoder.raw_decode(buffer, position)
+                except json.JSONDecodeError:
+                    if not chunk:
+                        raise
+                    # The object continues in the next chunk
+                    break
+
+                yield obj
+
+            if not chunk:
+                return
+
+
+def fixture_records(path, model=None):
+    """ The model of a fixture and the field values of its objects of that model, which is the model of its first
+    object unless given. """
+    objects = read_fixture(path)
+
+    if model is None:
+        first = next(objects, None)
+        if first is None:
+            return None, iter(())
+
+        model = apps.get_model(first['model'])
+        objects = chain([first], objects)
+
+    label, pk = model._meta.label_lower, model._meta.pk.attname
+
+    def records():
+        for obj in objects:
+            if obj['model'].lower() == label:
+                yield dict(obj['fields'], **({pk: obj['pk']} if 'pk' in obj else {}))
+
+    return model, records()
+
+
+def csv_records(path, delimiter=','):
+    """ The rows of a CSV file with a header of field names, as dicts of strings read while the file is read. """
+    with open(path, newline='', encoding='utf-8') as stream:
+        yield from csv.DictReader(stream, delimiter=delimiter)
@@ -0,0 +1,558 @@
+import copy
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from itertools import count
+
+from django.core.exceptions import FieldDoesNotExist
+from django.db import IntegrityError
+
+from .constants import *
+from .utils import get_attribute, is_subquery, join_key
+
+import django_mock_queries.query
+
+HASH_COMPARISONS = (COMPARISON_EXACT, COMPARISON_IN)
+SORTED_COMPARISONS = (COMPARISON_GT, COMPARISON_GTE, COMPARISON_LT, COMPARISON_LTE, COMPARISON_RANGE)
+
+
+class HashIndex:
+    """ Rows by the value of one field, for `exact` and `in` lookups. """
+    kind = 'hash'
+
+    def __init__(self, field):
+        self.field = field
+        self.buckets = defaultdict(dict)
+        self.keys = {}
+        self.reads = 0
+        self.writes = 0
+        self.last_used = 0
+        self.shared = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, row, key):
+        self._own()
+        self.buckets[key][id(row)] = row
+        self.keys[id(row)] = key
+
+    def remove(self, row):
+        self._own()
+        key = self.keys.pop(id(row))
+        bucket = self.buckets[key]
+        bucket.pop(id(row))
+
+        if not bucket:
+            del self.buckets[key]
+
+    def copy(self):
+        """ A copy that shares the rows of this index until either of them writes one. """
+        copied = copy.copy(self)
+        self.shared = copied.shared = True
+        return copied
+
+    def _own(self):
+        if self.shared:
+            self.buckets = defaultdict(dict, {key: dict(bucket) for key, bucket in self.buckets.items()})
+            self.keys = dict(self.keys)
+            self.shared = False
+
+    def lookup(self, comparison, value):
+        keys = value if comparison == COMPARISON_IN else [value]
+        return [row for key in set(keys) for row in self.buckets.get(key, {}).values()]
+
+
+class SortedIndex:
+    """ Rows ordered by the value of one field, for range lookups. Rows without a value are left out. """
+    kind = 'sorted'
+
+    def __init__(self, field):
+        self.field = field
+        self.values = []
+        self.rows = []
+        self.keys = {}
+        self.reads = 0
+        self.writes = 0
+        self.last_used = 0
+        self.shared = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, row, key):
+        if key is None:
+            return
+
+        self._own()
+        position = bisect_right(self.values, key)
+        self.values.insert(position, key)
+        self.rows.insert(position, row)
+        self.keys[id(row)] = key
+
+    def remove(self, row):
+        if id(row) not in self.keys:
+            return
+
+        self._own()
+        key = self.keys.pop(id(row))
+        position = bisect_left(self.values, key)
+        while self.rows[position] is not row:
+            position += 1
+
+        del self.values[position]
+        del self.rows[position]
+
+    def copy(self):
+        """ A copy that shares the rows of this index until either of them writes one. """
+        copied = copy.copy(self)
+        self.shared = copied.shared = True
+        return copied
+
+    def _own(self):
+        if self.shared:
+            self.values, self.rows, self.keys = list(self.values), list(self.rows), dict(self.keys)
+            self.shared = False
+
+    def lookup(self, comparison, value):
+        low, high = 0, len(self.values)
+
+        if comparison == COMPARISON_GT:
+            low = bisect_right(self.values, value)
+        elif comparison == COMPARISON_GTE:
+            low = bisect_left(self.values, value)
+        elif comparison == COMPARISON_LT:
+            high = bisect_left(self.values, value)
+        elif comparison == COMPARISON_LTE:
+            high = bisect_right(self.values, value)
+        else:
+            low, high = bisect_left(self.values, value[0]), bisect_right(self.values, value[1])
+
+        return self.rows[low:high]
+
+
+class AutoIndex:
+    """ Indexes that a root MockSet builds for itself on the fields it keeps scanning.
+
+    After `after` full scans for `exact`/`in` or range lookups on the same field,
+    a hash or sorted index of that field is built and then kept up to date by the
+    writes made through the set and the sets derived from it. An index is
+    dropped again when its writes outnumber its reads `drop_ratio` times, and
+    the least used indexes are evicted to keep the indexed rows under `max_entries`.
+    Attributes set directly on a row don't fire an event: the rows found are still
+    checked against the lookups, but a row that now matches them isn't found until
+    it is saved or updated through the set, or `fire(row, EVENT_UPDATED)` is called.
+
+    cars = MockSet(*rows, model=Car, auto_index=AutoIndex(after=2))
+    """
+
+    def __init__(self, after=3, max_entries=1000000, drop_ratio=4.0):
+        self.after = after
+        self.max_entries = max_entries
+        self.drop_ratio = drop_ratio
+        self.owner = None
+        self.indexes = {}
+        self.scans = defaultdict(int)
+        self.unindexable = set()
+        self.sequence = {}
+        self.shared_sequence = False
+        self.counter = count()
+        self.clock = count(1)
+
+    def bind(self, owner):
+        assert self.owner is None, 'An AutoIndex belongs to one MockSet.'
+        self.owner = owner
+
+    def fork(self, owner):
+        """ A copy of the indexes for `owner`, a fork of the set that owns them, which shares their rows with
+        these indexes until either of them writes one. """
+        copied = type(self)(self.after, self.max_entries, self.drop_ratio)
+        copied.bind(owner)
+        copied.indexes = {name: index.copy() for name, index in self.indexes.items()}
+        copied.scans = defaultdict(int, self.scans)
+        copied.unindexable = set(self.unindexable)
+        copied.sequence = self.sequence
+        self.shared_sequence = copied.shared_sequence = True
+        copied.counter = count(next(self.counter))
+        copied.clock = count(next(self.clock))
+        return copied
+
+    def _own_sequence(self):
+        if self.shared_sequence:
+            self.sequence = dict(self.sequence)
+            self.shared_sequence = False
+        return self.sequence
+
+    def _value(self, row, field):
+        value, _ = get_attribute(row, field)
+
+        if isinstance(value, (list, django_mock_queries.query.MockSet)):
+            raise TypeError('{} has many values.'.format(field))
+        return value
+
+    def _eligible(self, attr, value):
+        parts = attr.split('__')
+        if len(parts) == 1:
+            parts.append(COMPARISON_EXACT)
+        if len(parts) != 2 or parts[1] not in HASH_COMPARISONS + SORTED_COMPARISONS:
+            return None
+        if value is None or isinstance(value, django_mock_queries.query.MockSet) or is_subquery(value) \
+                or hasattr(value, 'resolve_expression'):
+            return None
+        if parts[1] == COMPARISON_IN and (isinstance(value, str) or not hasattr(value, '__iter__')):
+            return None
+
+        return parts[0], parts[1], HashIndex if parts[1] in HASH_COMPARISONS else SortedIndex
+
+    def _build(self, field, index_class):
+        index = index_class(field)
+
+        try:
+            for row in self.owner.items:
+                index.add(row, self._value(row, field))
+        except TypeError:
+            # Unhashable, incomparable or multi-valued, like reverse relations
+            self.unindexable.add((field, index.kind))
+            return None
+
+        if len(index) > self.max_entries:
+            return None
+
+        while sum(len(other) for other in self.indexes.values()) + len(index) > self.max_entries:
+            least_used = min(self.indexes, key=lambda name: (self.indexes[name].reads, self.indexes[name].last_used))
+            self._drop(least_used)
+
+        self.indexes[field, index.kind] = index
+        return index
+
+    def _drop(self, name):
+        del self.indexes[name]
+        self.scans[name] = 0
+
+    def candidates(self, attrs):
+        """ The rows found in the indexes for the lookups that have one, in set order, and those lookups. """
+        candidates = None
+        used = []
+
+        for attr, value in attrs.items():
+            eligible = self._eligible(attr, value)
+            if eligible is None:
+                continue
+
+            field, comparison, index_class = eligible
+            name = (field, index_class.kind)
+            index = self.indexes.get(name)
+
+            if index is None and name not in self.unindexable:
+                self.scans[name] += 1
+                if self.scans[name] >= self.after:
+                    index = self._build(field, index_class)
+            if index is None:
+                continue
+
+            try:
+                rows = index.lookup(comparison, value)
+            except TypeError:
+                continue
+
+            index.reads += 1
+            index.last_used = next(self.clock)
+            used.append(attr)
+            found = {id(row): row for row in rows}
+            candidates = found if candidates is None else {k: v for k, v in candidates.items() if k in found}
+
+        if candidates is None:
+            return None, used
+
+        return sorted(candidates.values(), key=lambda row: self.sequence[id(row)]), used
+
+    def notify(self, source, row, events):
+        """ Keep the indexes up to date with an event fired by the owner or a set derived from it. """
+        tracked = id(row) in self.sequence
+
+        if source is self.owner and source.EVENT_ADDED in events and not tracked:
+            self._own_sequence()[id(row)] = next(self.counter)
+            self._write(row, add=True)
+        elif tracked and source.EVENT_DELETED in events:
+            self._write(row, remove=True)
+            del self._own_sequence()[id(row)]
+        elif tracked and source.EVENT_UPDATED in events:
+            self._write(row, remove=True, add=True)
+
+    def undelete(self, row, sequence):
+        """ Index `row` again at `sequence`, the place it had in the owner, when its delete is undone. """
+        if sequence is not None:
+            self._own_sequence()[id(row)] = sequence
+            self._write(row, add=True)
+
+    def replace(self, row, copied):
+        """ Index `copied` instead of `row`, which the owner copied before writing it. """
+        if id(row) not in self.sequence:
+            return
+
+        sequence = self._own_sequence()
+        sequence[id(copied)] = sequence.pop(id(row))
+        for index in self.indexes.values():
+            if id(row) in index.keys:
+                key = index.keys[id(row)]
+                index.remove(row)
+                index.add(copied, key)
+
+    def _write(self, row, add=False, remove=False):
+        for name, index in list(self.indexes.items()):
+            try:
+                if remove:
+                    index.remove(row)
+                if add:
+                    index.add(row, self._value(row, index.field))
+            except (TypeError, KeyError):
+                self.unindexable.add(name)
+                self._drop(name)
+                continue
+
+            index.writes += 1
+            if index.writes > self.drop_ratio * max(index.reads, 1) + self.after:
+                # Maintaining the index costs more than the scans it saves
+                self._drop(name)
+
+
+class CompositeIndex:
+    """ Rows by the values of several fields, for lookups with `exact` on all of them.
+
+    A unique index rejects rows that would share a key with another one. Like
+    SQL, keys with a NULL value never conflict, unless `nulls_distinct` is False.
+
+    cars = MockSet(model=Car, indexes=[CompositeIndex('make_id', 'model', unique=True)])
+    """
+    kind = 'composite'
+
+    def __init__(self, *fields, unique=False, name=None, nulls_distinct=True):
+        self.fields = fields
+        self.unique = unique
+        self.name = name or '_'.join(fields)
+        self.nulls_distinct = nulls_distinct
+        self.buckets = defaultdict(dict)
+        self.keys = {}
+        self.shared = False
+
+    def __len__(self):
+        return len(self.keys)
+
+    def key(self, row, **values):
+        """ The values of the fields of `row`, or of `values` instead, or None if one of them is NULL and NULLs are
+        distinct. """
+        key = tuple(join_key(values[field] if field in values else getattr(row, field, None)) for field in self.fields)
+        return None if self.nulls_distinct and None in key else key
+
+    def add(self, row):
+        key = self.key(row)
+
+        if key is not None:
+            self._own()
+            self.buckets[key][id(row)] = row
+            self.keys[id(row)] = key
+
+    def remove(self, row):
+        if id(row) not in self.keys:
+            return
+
+        self._own()
+        key = self.keys.pop(id(row))
+        bucket = self.buckets.get(key, {})
+        bucket.pop(id(row), None)
+
+        if not bucket:
+            self.buckets.pop(key, None)
+
+    def copy(self):
+        """ A copy that shares the rows of this index until either of them writes one. """
+        copied = copy.copy(self)
+        self.shared = copied.shared = True
+        return copied
+
+    def _own(self):
+        if self.shared:
+            self.buckets = defaultdict(dict, {key: dict(bucket) for key, bucket in self.buckets.items()})
+            self.keys = dict(self.keys)
+            self.shared = False
+
+    def lookup(self, key):
+        return list(self.buckets.get(key, {}).values())
+
+
+def unique_indexes(model):
+    """ The unique CompositeIndexes of the `unique_together` and unconditional UniqueConstraints of a model. """
+    meta = getattr(model, '_meta', None)
+    indexes = [CompositeIndex(*fields, unique=True) for fields in getattr(meta, 'unique_together', ())]
+
+    for constraint in getattr(meta, 'constraints', ()):
+        if getattr(constraint, 'fields', None) and not getattr(constraint, 'expressions', None) \
+                and getattr(constraint, 'condition', None) is None:
+            indexes.append(CompositeIndex(
+                *constraint.fields, unique=True, name=constraint.name,
+                nulls_distinct=getattr(constraint, 'nulls_distinct', None) is not False
+            ))
+
+    return indexes
+
+
+class CompositeIndexes:
+    """ The CompositeIndexes of a root MockSet, kept up to date like an AutoIndex. """
+
+    def __init__(self, indexes=(), model=None, constraints=False):
+        self.owner = None
+        self.aliases = {}
+        self.indexes = [
+            index if isinstance(index, CompositeIndex) else CompositeIndex(*index) for index in indexes
+        ] + (unique_indexes(model) if constraints else [])
+        self.sequence = {}
+        self.shared_sequence = False
+        self.counter = count()
+
+        meta = getattr(model, '_meta', None)
+        for index in self.indexes:
+            # Relations are stored and looked up by their column, e.g. `make_id` for `make`
+            index.fields = tuple(self._attname(meta, field) for field in index.fields)
+
+    def _attname(self, meta, name):
+        try:
+            field = meta.pk if name == 'pk' else meta.get_field(name)
+        except (AttributeError, FieldDoesNotExist):
+            return name
+
+        attname = getattr(field, 'attname', name)
+        self.aliases.update({name: attname, attname: attname})
+        return attname
+
+    def bind(self, owner):
+        assert self.owner is None, 'CompositeIndexes belong to one MockSet.'
+        self.owner = owner
+
+    def fork(self, owner):
+        """ A copy of the indexes for `owner`, a fork of the set that owns them, which shares their rows with
+        these indexes until either of them writes one. """
+        copied = copy.copy(self)
+        copied.owner = None
+        copied.bind(owner)
+        copied.indexes = [index.copy() for index in self.indexes]
+        copied.sequence = self.sequence
+        self.shared_sequence = copied.shared_sequence = True
+        copied.counter = count(next(self.counter))
+        return copied
+
+    def _own_sequence(self):
+        if self.shared_sequence:
+            self.sequence = dict(self.sequence)
+            self.shared_sequence = False
+        return self.sequence
+
+    def check(self, rows):
+        """ Raise IntegrityError if adding `rows` would duplicate the key of a unique index. """
+        for index in self.indexes:
+            if not index.unique:
+                continue
+
+            pending = set()
+            for row in rows:
+                key = index.key(row)
+                if key is None or id(row) in self.sequence:
+                    continue
+
+                if key in pending or index.buckets.get(key):
+                    raise IntegrityError('UNIQUE constraint {} failed for key {}.'.format(index.name, key))
+                pending.add(key)
+
+    def check_update(self, rows, attrs):
+        """ Raise IntegrityError if setting `attrs` on `rows` would duplicate the key of a unique index. """
+        values = {self.aliases.get(attr, attr): value for attr, value in attrs.items()}
+        updated = {id(row) for row in rows if id(row) in self.sequence}
+
+        for index in self.indexes:
+            if not index.unique or not any(field in values for field in index.fields):
+                continue
+
+            pending = set()
+            for row in rows:
+                key = index.key(row, **values)
+                if key is None or id(row) not in updated:
+                    continue
+
+                # The other updated rows move away from their keys, so only the rows left there conflict
+                if key in pending or any(other not in updated for other in index.buckets.get(key, ())):
+                    raise IntegrityError('UNIQUE constraint {} failed for key {}.'.format(index.name, key))
+                pending.add(key)
+
+    def without_conflicts(self, rows):
+        """ `rows` without the ones that would duplicate a unique key, like INSERT ... ON CONFLICT DO NOTHING. """
+        pending = defaultdict(set)
+        kept = []
+
+        for row in rows:
+            keys = [(index, index.key(row)) for index in self.indexes if index.unique and id(row) not in self.sequence]
+            keys = [(index, key) for index, key in keys if key is not None]
+
+            if any(key in pending[index] or index.buckets.get(key) for index, key in keys):
+                continue
+
+            for index, key in keys:
+                pending[index].add(key)
+            kept.append(row)
+
+        return kept
+
+    def candidates(self, attrs):
+        """ The rows of the first index whose fields all have an `exact` lookup, in set order, and that index. """
+        keys = {}
+
+        for attr, value in attrs.items():
+            name = attr[:-len('__' + COMPARISON_EXACT)] if attr.endswith('__' + COMPARISON_EXACT) else attr
+
+            if '__' not in name and value is not None and not is_subquery(value) \
+                    and not isinstance(value, django_mock_queries.query.MockSet) \
+                    and not hasattr(value, 'resolve_expression'):
+                keys[self.aliases.get(name, name)] = join_key(value)
+
+        for index in self.indexes:
+            if all(field in keys for field in index.fields):
+                try:
+                    rows = index.lookup(tuple(keys[field] for field in index.fields))
+                except TypeError:
+                    continue
+
+                return sorted(rows, key=lambda row: self.sequence[id(row)]), index
+
+        return None, None
+
+    def notify(self, source, row, events):
+        """ Keep the indexes up to date with an event fired by the owner or a set derived from it. """
+        tracked = id(row) in self.sequence
+
+        if source is self.owner and source.EVENT_ADDED in events and not tracked:
+            self._own_sequence()[id(row)] = next(self.counter)
+            for index in self.indexes:
+                index.add(row)
+        elif tracked and source.EVENT_DELETED in events:
+            del self._own_sequence()[id(row)]
+            for index in self.indexes:
+                index.remove(row)
+        elif tracked and source.EVENT_UPDATED in events:
+            for index in self.indexes:
+                index.remove(row)
+                index.add(row)
+
+    def replace(self, row, copied):
+        """ Index `copied` instead of `row`, which the owner copied before writing it. """
+        if id(row) not in self.sequence:
+            return
+
+        sequence = self._own_sequence()
+        sequence[id(copied)] = sequence.pop(id(row))
+        for index in self.indexes:
+            index.remove(row)
+            index.add(copied)
+
+    def undelete(self, row, sequence):
+        """ Index `row` again at `sequence`, the place it had in the owner, when its delete is undone. """
+        if sequence is not None:
+            self._own_sequence()[id(row)] = sequence
+            for index in self.indexes:
+                index.add(row)
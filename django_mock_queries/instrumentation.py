@@ -0,0 +1,228 @@
+import os
+import sys
+import time
+import unittest.mock
+from collections import namedtuple, defaultdict
+from contextlib import ContextDecorator
+
+from .exceptions import NPlusOneQueries, TooManyQueries
+
+# Frames of these files are skipped when looking for the code that made a query
+IGNORED_DIRS = (
+    os.path.dirname(os.path.abspath(__file__)),
+    os.path.abspath(unittest.mock.__file__),
+)
+
+CallSite = namedtuple('CallSite', 'filename lineno function')
+QueryRecord = namedtuple('QueryRecord', 'label operation call_site rows', defaults=(0,))
+NPlusOne = namedtuple('NPlusOne', 'label call_site count')
+
+_recorders = []
+
+
+class query_boundary:
+    """ Nesting of mocked query calls, only calls made outside of any other one are queries of their own. """
+    depth = 0
+
+    def __enter__(self):
+        query_boundary.depth += 1
+
+    def __exit__(self, *_):
+        query_boundary.depth -= 1
+
+
+def is_recording():
+    return len(_recorders) > 0
+
+
+def call_site():
+    """ The first frame outside of this package and the mock module. """
+    frame = sys._getframe(1)
+
+    while frame is not None and os.path.abspath(frame.f_code.co_filename).startswith(IGNORED_DIRS):
+        frame = frame.f_back
+
+    if frame is None:
+        return None
+
+    return CallSite(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+
+
+def record_query(label, operation, internal=False, rows=0):
+    """ Record a would-be query that scans `rows` rows on all active recorders.
+
+    Queries made while another mocked query runs, like the relation sets that a
+    filter walks through, are part of that query and are skipped unless `internal`.
+    """
+    if not _recorders or (query_boundary.depth and not internal):
+        return
+
+    query = QueryRecord(label, operation, call_site(), rows)
+
+    for recorder in list(_recorders):
+        recorder.record(query)
+
+
+class QueryRecorder(ContextDecorator):
+    """ Record the would-be queries of mocked querysets and relations while active.
+
+    with QueryRecorder() as recorder:
+        list(Car.objects.filter(speed__gt=100))
+
+    assert [q.operation for q in recorder.queries] == ['iterate']
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __enter__(self):
+        self.queries = []
+        _recorders.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _recorders.remove(self)
+        return False
+
+    def record(self, query):
+        self.queries.append(query)
+
+    def report(self):
+        return '\n'.join(
+            '{}. {} {} at {}:{} in {}()'.format(i, query.label, query.operation, *query.call_site)
+            if query.call_site is not None else '{}. {} {}'.format(i, query.label, query.operation)
+            for i, query in enumerate(self.queries, start=1)
+        )
+
+
+class NPlusOneDetector(QueryRecorder):
+    """ Fail when the same relation or manager is queried repeatedly from one line of code.
+
+    That's the pattern of an N+1 bug: a loop over parent rows that queries a
+    relation once per row, instead of loading it for all rows with
+    select_related() or prefetch_related().
+
+    @detect_n_plus_one()
+    def test_list_cars(self):
+        render_cars(Manufacturer.objects.all())
+    """
+
+    def __init__(self, threshold=2, raise_errors=True):
+        super().__init__()
+        self.threshold = threshold
+        self.raise_errors = raise_errors
+
+    @property
+    def patterns(self):
+        counts = defaultdict(int)
+
+        for query in self.queries:
+            if query.label is not None and query.call_site is not None:
+                counts[query.label, query.call_site] += 1
+
+        return [
+            NPlusOne(label, site, count)
+            for (label, site), count in counts.items()
+            if count >= self.threshold
+        ]
+
+    def report(self):
+        return '\n'.join(
+            '{} queried {} times from {}:{} in {}()'.format(
+                pattern.label, pattern.count, *pattern.call_site
+            )
+            for pattern in self.patterns
+        )
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+
+        if exc_type is None and self.raise_errors and self.patterns:
+            raise NPlusOneQueries('Possible N+1 queries:\n' + self.report())
+
+        return False
+
+
+def detect_n_plus_one(threshold=2, raise_errors=True):
+    return NPlusOneDetector(threshold=threshold, raise_errors=raise_errors)
+
+
+class QueryBudget(QueryRecorder):
+    """ Fail when more than `max_queries` would-be queries are made, like assertNumQueries() of Django.
+
+    Queries are counted where a QuerySet would hit the database: evaluating a
+    set (iteration, len(), bool()) fills its result cache, after which
+    count(), exists(), first(), last() and indexing are answered from it, while
+    get(), aggregate(), create(), update() and delete() always query. Sets
+    returned by managers and related managers, like `Car.objects` or
+    `make.car_set`, query again on every evaluation. Chained methods like
+    filter() return new sets that query on their first evaluation.
+    """
+
+    def __init__(self, max_queries):
+        super().__init__()
+        self.max_queries = max_queries
+
+    def __exit__(self, exc_type, *exc):
+        super().__exit__(exc_type, *exc)
+
+        if exc_type is None and len(self.queries) > self.max_queries:
+            raise TooManyQueries('{} queries executed, at most {} expected.\nCaptured queries were:\n{}'.format(
+                len(self.queries), self.max_queries, self.report()
+            ))
+
+        return False
+
+
+def assert_max_queries(max_queries):
+    return QueryBudget(max_queries)
+
+
+class SimulatedLatency(QueryRecorder):
+    """ Estimate the time that the would-be queries would spend in a real database.
+
+    Every query costs `per_query` seconds, or the cost of its operation in
+    `per_operation`, plus `per_row` seconds for each row it scans. With `sleep`
+    the time is really spent, to load test code paths, otherwise it's only added up.
+
+    with SimulatedLatency(per_query=0.002, per_row=0.00001) as latency:
+        render_car_list(Car.objects.all())
+
+    print(latency.report())
+    """
+
+    def __init__(self, per_query=0.0, per_row=0.0, per_operation=None, sleep=False):
+        super().__init__()
+        self.per_query = per_query
+        self.per_row = per_row
+        self.per_operation = per_operation or {}
+        self.sleep = sleep
+
+    def cost(self, query):
+        return self.per_operation.get(query.operation, self.per_query) + self.per_row * query.rows
+
+    def record(self, query):
+        super().record(query)
+
+        if self.sleep:
+            time.sleep(self.cost(query))
+
+    @property
+    def total(self):
+        return sum(self.cost(query) for query in self.queries)
+
+    def report(self):
+        costs = defaultdict(list)
+        for query in self.queries:
+            costs[query.label].append(self.cost(query))
+
+        return '\n'.join(
+            ['Estimated database time: {:.2f} ms for {} queries'.format(self.total * 1000, len(self.queries))] + [
+                '  {}: {:.2f} ms for {} queries'.format(label, sum(times) * 1000, len(times))
+                for label, times in sorted(costs.items(), key=lambda item: -sum(item[1]))
+            ]
+        )
+
+
+def simulate_latency(per_query=0.0, per_row=0.0, per_operation=None, sleep=False):
+    return SimulatedLatency(per_query=per_query, per_row=per_row, per_operation=per_operation, sleep=sleep)
@@ -0,0 +1,262 @@
+import weakref
+from functools import cmp_to_key
+from itertools import count
+
+from .constants import *
+from .exceptions import *
+from .query import MockSet, aggregate_aliases
+from .utils import filter_rows, get_attribute, is_list_like_iter, is_subquery, prepare_operand
+
+RUNNING_AGGREGATES = (AGGREGATES_COUNT, AGGREGATES_SUM, AGGREGATES_AVG)
+
+
+class ViewObserver:
+    """ Passes the writes of the sets of a root to a LiveView, without keeping the view alive.
+
+    Once the view is gone it ignores them, until the next view of the root
+    drops it from the observers.
+    """
+
+    def __init__(self, view):
+        self.view = weakref.ref(view)
+
+    @property
+    def sequence(self):
+        view = self.view()
+        return view.sequence if view is not None else {}
+
+    def notify(self, source, row, events):
+        view = self.view()
+        if view is not None:
+            view.notify(source, row, events)
+
+    def replace(self, row, copied):
+        view = self.view()
+        if view is not None:
+            view.replace(row, copied)
+
+    def undelete(self, row, sequence):
+        view = self.view()
+        if view is not None:
+            view.undelete(row, sequence)
+
+    def reload(self):
+        view = self.view()
+        if view is not None:
+            view.reload()
+
+
+class LiveView(MockSet):
+    """ The rows of a MockSet that match a filter, kept up to date as rows are added, updated and deleted.
+
+    Unlike a filtered set, which is a copy of the rows that matched when it was
+    made, a live view follows the writes made through its parent set and the
+    sets derived from the same root, and keeps its rows in the order of the
+    parent set, or of order_by(). Count, Sum and Avg aggregates are kept as
+    running totals once they are asked for. Writes must go through the sets,
+    like update() or save() on a mocked model; attributes set directly on a row
+    are only seen on its next event. A view follows the writes until it is
+    closed or garbage collected.
+
+    open_issues = live_view(Issue.objects, status='open').order_by('-priority')
+    Issue.objects.filter(pk=1).update(status='open')
+    assert open_issues.aggregate(Count('id')) == {'id__count': 1}
+    """
+
+    def __init__(self, *initial_items, **kwargs):
+        args, attrs = kwargs.pop('lookups', ((), {}))
+        ordering = kwargs.pop('ordering', ())
+        super().__init__(*initial_items, **kwargs)
+
+        if self.clone._correlation is not None or any(isinstance(v, DjangoOuterRef) for v in attrs.values()):
+            raise ArgumentNotSupported()
+        if '?' in ordering:
+            raise ArgumentNotSupported()
+
+        self.lookups = args, attrs
+        # Operands are prepared once, instead of on every write
+        self.prepared = {k: v if is_subquery(v) else prepare_operand(k, v) for k, v in attrs.items()}
+        self.ordering = [(field.lstrip('-'), field.startswith('-')) for field in ordering]
+        self.reload()
+
+        self._observers[:] = [
+            observer for observer in self._observers
+            if not isinstance(observer, ViewObserver) or observer.view() is not None
+        ]
+        self._following = ViewObserver(self)
+        self._observers.append(self._following)
+
+    def reload(self):
+        """ Read the rows of the parent set again, like when the view was made. """
+        self.sequence = {id(row): position for position, row in enumerate(self.clone.items)}
+        self.counter = count(len(self.sequence))
+        self.keys = {}
+        self.running = {}
+
+        rows = filter_rows(self.clone.items, self.lookups[0], self.prepared)
+        for row in rows:
+            self.keys[id(row)] = self._key(row)
+        self.items = sorted(rows, key=cmp_to_key(lambda a, b: self._compare(self.keys[id(a)], self.keys[id(b)])))
+
+    def _mockset_class(self):
+        return MockSet
+
+    def add(self, *models):
+        # Rows are added to the parent set, and join the view if they match
+        self.clone.add(*models)
+
+    def _delete_recursive(self, *items_to_remove, **attrs):
+        # Rows leave the view when the parent set fires their delete events
+        return self.clone._delete_recursive(*items_to_remove, **attrs)
+
+    def _key(self, row):
+        """ The values of the ordering fields of `row` and its position in the parent set. """
+        return tuple(get_attribute(row, field)[0] for field, _ in self.ordering) + (self.sequence[id(row)],)
+
+    def _compare(self, first, second):
+        for (_, is_reversed), a, b in zip(self.ordering, first, second):
+            if a != b:
+                return (1 if a > b else -1) * (-1 if is_reversed else 1)
+
+        return first[-1] - second[-1]
+
+    def _position(self, key):
+        low, high = 0, len(self.items)
+
+        while low < high:
+            middle = (low + high) // 2
+            if self._compare(self.keys[id(self.items[middle])], key) < 0:
+                low = middle + 1
+            else:
+                high = middle
+
+        return low
+
+    def _accepts(self, row):
+        return len(filter_rows([row], self.lookups[0], self.prepared)) > 0
+
+    def _insert(self, row):
+        key = self._key(row)
+        self.items.insert(self._position(key), row)
+        self.keys[id(row)] = key
+
+        for field, totals in self.running.items():
+            self._count(totals, row, field)
+
+    def _remove(self, row):
+        position = self._position(self.keys[id(row)])
+
+        del self.items[position]
+        del self.keys[id(row)]
+
+        for totals in self.running.values():
+            self._uncount(totals, row)
+
+    def notify(self, source, row, events):
+        """ Keep the rows up to date with an event fired by the parent set or another set of the same root. """
+        if source is self.clone and source.EVENT_ADDED in events and id(row) not in self.sequence:
+            self.sequence[id(row)] = next(self.counter)
+            if self._accepts(row):
+                self._insert(row)
+        elif id(row) in self.sequence and source.EVENT_DELETED in events:
+            if id(row) in self.keys:
+                self._remove(row)
+            del self.sequence[id(row)]
+        elif id(row) in self.sequence and source.EVENT_UPDATED in events:
+            if id(row) in self.keys:
+                self._remove(row)
+            if self._accepts(row):
+                self._insert(row)
+
+    def replace(self, row, copied):
+        """ Hold `copied` instead of `row`, which the root set copied before writing it. """
+        if id(row) not in self.sequence:
+            return
+
+        self.sequence[id(copied)] = self.sequence.pop(id(row))
+        if id(row) in self.keys:
+            self.items[self._position(self.keys[id(row)])] = copied
+            self.keys[id(copied)] = self.keys.pop(id(row))
+
+        for totals in self.running.values():
+            if id(row) in totals[2]:
+                totals[2][id(copied)] = totals[2].pop(id(row))
+
+    def undelete(self, row, sequence):
+        """ Take `row` back at `sequence`, its place in the parent set, when its delete is undone. """
+        if sequence is not None:
+            self.sequence[id(row)] = sequence
+            if self._accepts(row):
+                self._insert(row)
+
+    def close(self):
+        """ Stop following the writes of the parent set. """
+        if self._following in self._observers:
+            self._observers.remove(self._following)
+
+    def order_by(self, *fields):
+        """ A live view of the same rows, kept in the order of `fields`. """
+        # Not of type(self), the class Mock made for this view alone, whose magic methods would keep it alive
+        view_class = type(self).__bases__[0]
+        return view_class(clone=self.clone, lookups=self.lookups, ordering=fields)
+
+    def _values(self, row, field):
+        value = get_attribute(row, field)[0]
+
+        if value is None:
+            return []
+        return value if is_list_like_iter(value) else [value]
+
+    def _count(self, totals, row, field):
+        values = self._values(row, field)
+
+        try:
+            total = sum(values)
+        except TypeError:
+            # Not numbers, only Count can be kept
+            total = None
+
+        # What the row added is kept, as its values may have changed by the time it is removed
+        totals[2][id(row)] = len(values), total
+        totals[0] += len(values)
+        totals[1] = None if totals[1] is None or total is None else totals[1] + total
+
+    def _uncount(self, totals, row):
+        values, total = totals[2].pop(id(row))
+        totals[0] -= values
+        totals[1] = None if totals[1] is None or total is None else totals[1] - total
+
+    def aggregate(self, *args, **kwargs):
+        """ Like MockSet.aggregate(), with Count, Sum and Avg read from running totals of their field. """
+        result = {}
+
+        for alias, expr in aggregate_aliases(args, kwargs).items():
+            field = expr.source_expressions[0].name
+
+            if expr.function not in RUNNING_AGGREGATES or getattr(expr, 'distinct', False) \
+                    or getattr(expr, 'filter', None) is not None:
+                result.update(super().aggregate(**{alias: expr}))
+                continue
+
+            if field not in self.running:
+                self.running[field] = [0, 0, {}]
+                for row in self.items:
+                    self._count(self.running[field], row, field)
+
+            values, total, _ = self.running[field]
+
+            if expr.function == AGGREGATES_COUNT:
+                result[alias] = values
+            elif total is None:
+                result.update(super().aggregate(**{alias: expr}))
+            elif expr.function == AGGREGATES_SUM:
+                result[alias] = total if values else None
+            else:
+                result[alias] = total / values if values else None
+
+        return result
+
+
+def live_view(mock_set, *args, **attrs):
+    """ A LiveView of the rows of `mock_set` that match the Q objects and lookups of a filter() call. """
+    return LiveView(clone=mock_set, lookups=(args, attrs))
@@ -5,15 +5,23 @@ import weakref
 from django.apps import apps
 from django.db import connections
 from django.db.backends.base import creation
+from django.core.exceptions import EmptyResultSet
 from django.db.models import Model
+from django.db.models.sql.constants import CURSOR, MULTI, NO_RESULTS, SINGLE
 from django.db.utils import ConnectionHandler, NotSupportedError
+from contextlib import ContextDecorator
 from functools import partial
 from itertools import chain
 from unittest.mock import Mock, MagicMock, patch, PropertyMock
 
 from types import MethodType
 
+from .instrumentation import record_query
+from .engine import active_engine
+from .database import MockForwardRelation, MockManyToManyRelation, MockReverseRelation, MockReverseOneToOneRelation
 from .query import MockSet
+from .transactions import MockTransactions, is_journaling, journal
+from .utils import get_accessor_name, get_prefetched
 
 # noinspection PyUnresolvedReferences
 patch_object = patch.object
@@ -87,22 +95,126 @@ def mock_django_connection(disabled_features=None):
     mock_ops = mock_connection.ops
 
     # noinspection PyUnusedLocal
-    def compiler(queryset, using=None, connection=None, elide_empty=True, **kwargs):
+    def compiler(compiler_name, query, connection=None, using=None, elide_empty=True, **kwargs):
+        engine = active_engine()
+        if engine is not None:
+            return engine.compiler(sql_connection(), compiler_name, query, using, elide_empty)
+        if _sql_captures:
+            return _capturing_compiler(compiler_name, query, using, elide_empty)
+
         result = MagicMock(name='mock_connection.ops.compiler()')
         # noinspection PyProtectedMember
         result.execute_sql.side_effect = NotSupportedError(
             "Mock database tried to execute SQL for {} model.".format(
-                queryset.model._meta.object_name))
+                query.model._meta.object_name))
         result.has_results.side_effect = result.execute_sql.side_effect
         return result
 
-    mock_ops.compiler.return_value.side_effect = compiler
+    mock_ops.compiler.side_effect = lambda compiler_name: partial(compiler, compiler_name)
     mock_ops.integer_field_range.return_value = (-sys.maxsize - 1, sys.maxsize)
     mock_ops.max_name_length.return_value = sys.maxsize
+    mock_ops.bulk_batch_size.return_value = sys.maxsize
+    # transaction.atomic() and savepoints roll back the writes made to mocked sets
+    MockTransactions().bind(mock_connection)
 
     Model.refresh_from_db = Mock()  # Make this into a noop.
 
 
+_sql_captures = []
+_sql_connection = []
+
+
+def sql_connection():
+    """ A local SQLite connection, which compiles the SQL that the mocked connection doesn't run. """
+    if not _sql_connection:
+        handler = ConnectionHandler({'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}})
+        _sql_connection.append(handler.create_connection('default'))
+
+    return _sql_connection[0]
+
+
+def _empty_result(result_type):
+    if result_type == MULTI:
+        return iter([])
+    elif result_type == CURSOR:
+        return MagicMock(name='mock_connection.cursor()', rowcount=0)
+    elif result_type in (SINGLE, NO_RESULTS):
+        return None
+
+    return 0
+
+
+def _capturing_compiler(compiler_name, query, using, elide_empty):
+    connection = sql_connection()
+    result = connection.ops.compiler(compiler_name)(query, connection, using, elide_empty)
+    model_name = query.model._meta.object_name
+
+    def execute_sql(*args, **kwargs):
+        result_type = kwargs.get('result_type', args[0] if args else MULTI)
+
+        try:
+            statements = result.as_sql()
+        except EmptyResultSet:
+            # Django answers this without a query as well
+            return [] if compiler_name == 'SQLInsertCompiler' else _empty_result(result_type)
+
+        statements = statements if isinstance(statements, list) else [statements]
+        for capture in _sql_captures:
+            capture.add(model_name, statements)
+
+        if not all(capture.empty_results for capture in _sql_captures):
+            raise NotSupportedError("Mock database tried to execute SQL for {} model: {}".format(
+                model_name, '; '.join(sql for sql, _ in statements)
+            ))
+
+        return [] if compiler_name == 'SQLInsertCompiler' else _empty_result(result_type)
+
+    result.execute_sql = execute_sql
+    return result
+
+
+class SqlCapture(ContextDecorator):
+    """ Record the SQL that Django would run on the mocked connection while active.
+
+    The SQL is compiled for SQLite, then the mocked connection raises the usual
+    NotSupportedError, or returns empty results with `empty_results`.
+
+    with capture_sql(empty_results=True) as captured:
+        assert Car.objects.count() == 0
+
+    assert len(captured) == 1
+    assert captured[0]['sql'].startswith('SELECT COUNT(*)')
+    """
+
+    def __init__(self, empty_results=False):
+        self.empty_results = empty_results
+        self.captured_queries = []
+
+    def add(self, model_name, statements):
+        for sql, params in statements:
+            self.captured_queries.append({'model': model_name, 'sql': sql, 'params': params})
+            record_query(model_name, 'sql')
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+    def __getitem__(self, index):
+        return self.captured_queries[index]
+
+    def __enter__(self):
+        self.captured_queries = []
+        _sql_captures.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _sql_captures.remove(self)
+        return False
+
+
+def capture_sql(empty_results=False):
+    return SqlCapture(empty_results=empty_results)
+
+
 class MockMap:
     def __init__(self, original):
         """ Wrap a mock mapping around the original one-to-many relation. """
@@ -110,9 +222,33 @@ class MockMap:
         self.original = original
 
     def __set__(self, instance, value):
-        """ Set a related object for an instance. """
+        """ Set a related object for an instance.
+
+        The entry is evicted as soon as the instance is garbage collected.
+        Instances are keyed by id, because unsaved model instances can't be hashed.
+        """
+        instance_id = id(instance)
+
+        def evict(instance_ref):
+            entry = self.map.get(instance_id)
+            if entry is not None and entry[0] is instance_ref:
+                del self.map[instance_id]
 
-        self.map[id(instance)] = (weakref.ref(instance), value)
+        self.map[instance_id] = (weakref.ref(instance, evict), value)
+
+    def __len__(self):
+        """ Number of live instances with a related entry. """
+
+        return len(self.map)
+
+    def _lookup(self, instance):
+        """ Find the related entry of an instance, or raise KeyError. """
+
+        instance_ref, value = self.map[id(instance)]
+        if instance_ref() is not instance:
+            # Stale entry of a dead instance whose id was reused
+            raise KeyError(id(instance))
+        return value
 
     def __getattr__(self, name):
         """ Delegate all other calls to the original. """
@@ -131,17 +267,23 @@ class MockOneToManyMap(MockMap):
             # Call was to the class, not an object.
             return self
 
-        instance_id = id(instance)
-        entry = self.map.get(instance_id)
-        old_instance = related_objects = None
-        if entry is not None:
-            old_instance_weak, related_objects = entry
-            old_instance = old_instance_weak()
-        if entry is None or old_instance is None:
+        name = get_accessor_name(self.original)
+        prefetched = get_prefetched(instance, name)
+        if prefetched is not None:
+            return prefetched
+
+        try:
+            related_objects = self._lookup(instance)
+        except KeyError:
             related = getattr(self.original, 'related', self.original)
             related_objects = MockSet(model=related.field.model)
             self.__set__(instance, related_objects)
 
+        if isinstance(related_objects, MockSet) and related_objects.label is None:
+            # The related manager queries again on every evaluation
+            related_objects.label = '{}.{}'.format(owner.__name__, name)
+            related_objects._manager = True
+
         return related_objects
 
 
@@ -156,19 +298,17 @@ class MockOneToOneMap(MockMap):
             # Call was to the class, not an object.
             return self
 
-        entry = self.map.get(id(instance))
-        old_instance = related_object = None
-        if entry is not None:
-            old_instance_weak, related_object = entry
-            old_instance = old_instance_weak()
-        if entry is None or old_instance is None:
+        record_query('{}.{}'.format(owner.__name__, self.original.related.get_accessor_name()), 'get')
+
+        try:
+            return self._lookup(instance)
+        except KeyError:
             raise self.original.RelatedObjectDoesNotExist(
                 "Mock {} has no {}.".format(
                     owner.__name__,
                     self.original.related.get_accessor_name()
                 )
             )
-        return related_object
 
 
 def find_all_models(models):
@@ -180,7 +320,10 @@ def find_all_models(models):
             yield from find_all_models((parent,))
 
 
-def _patch_save(model, name):
+def _patch_save(model, name, database=None):
+    if database is not None:
+        return patch_object(model, 'save', autospec=True, side_effect=database.save)
+
     return patch_object(
         model,
         'save',
@@ -188,17 +331,33 @@ def _patch_save(model, name):
     )
 
 
-def _patch_objects(model, name):
+def _patch_delete(model, database):
+    return patch_object(model, 'delete', autospec=True, side_effect=database.delete)
+
+
+def _patch_objects(model, name, database=None):
+    if database is not None:
+        return patch_object(
+            model, 'objects',
+            new_callable=partial(database.table, model, mock_name=name + '.objects', label=name + '.objects')
+        )
+
     return patch_object(
         model, 'objects',
-        new_callable=partial(MockSet, mock_name=name + '.objects', model=model)
+        new_callable=partial(MockSet, mock_name=name + '.objects', model=model, label=name + '.objects')
     )
 
 
-def _patch_relation(model, name, related_object):
+def _patch_relation(model, name, related_object, database=None):
     relation = getattr(model, name)
 
-    if related_object.one_to_one:
+    if database is not None and related_object.many_to_many:
+        new_callable = partial(MockManyToManyRelation, database, relation)
+    elif database is not None and related_object.one_to_one:
+        new_callable = partial(MockReverseOneToOneRelation, database, relation)
+    elif database is not None and related_object.one_to_many:
+        new_callable = partial(MockReverseRelation, database, relation)
+    elif related_object.one_to_one:
         new_callable = partial(MockOneToOneMap, relation)
     else:
         new_callable = partial(MockOneToManyMap, relation)
@@ -206,8 +365,17 @@ def _patch_relation(model, name, related_object):
     return patch_object(model, name, new_callable=new_callable)
 
 
+def _patch_forward_relation(model, field, database):
+    relation = getattr(model, field.name)
+    return patch_object(model, field.name, new_callable=partial(MockForwardRelation, database, relation))
+
+
+def _is_mocked(method):
+    return isinstance(method, Mock) or isinstance(getattr(method, 'mock', None), Mock)
+
+
 # noinspection PyProtectedMember
-def mocked_relations(*models):
+def mocked_relations(*models, database=None):
     """ Mock all related field managers to make pure unit tests possible.
 
     The resulting patcher can be used just like one from the mock module:
@@ -218,34 +386,46 @@ def mocked_relations(*models):
     def test_dataset(self):
         dataset = Dataset()
         check = dataset.content_checks.create()  # returns a ContentCheck object
+
+    Pass a MockDatabase to back `objects`, `save()`, `delete()` and the foreign
+    key and many-to-many relations of all the models with its shared, indexed tables.
     """
     patchers = []
 
     for model in find_all_models(models):
-        if isinstance(model.save, Mock):
+        if _is_mocked(model.save):
             # already mocked, so skip it
             continue
 
         model_name = model._meta.object_name
-        patchers.append(_patch_save(model, model_name))
+        patchers.append(_patch_save(model, model_name, database))
 
         if hasattr(model, 'objects'):
-            patchers.append(_patch_objects(model, model_name))
+            patchers.append(_patch_objects(model, model_name, database))
 
         for related_object in chain(model._meta.related_objects,
                                     model._meta.many_to_many):
             name = related_object.name
 
-            if name not in model.__dict__ and related_object.one_to_many:
+            if name not in model.__dict__ and (related_object.one_to_many or related_object.many_to_many):
                 name += '_set'
 
             if name in model.__dict__:
                 # Only mock direct relations, not inherited ones.
                 if getattr(model, name, None):
                     patchers.append(_patch_relation(
-                        model, name, related_object
+                        model, name, related_object, database
                     ))
 
+        if database is not None:
+            patchers.append(_patch_delete(model, database))
+
+            for field in model._meta.fields:
+                is_forward_relation = field.many_to_one or (field.one_to_one and not field.remote_field.parent_link)
+
+                if is_forward_relation and field.name in model.__dict__:
+                    patchers.append(_patch_forward_relation(model, field, database))
+
     return PatcherChain(patchers, pass_mocks=False)
 
 
@@ -430,6 +610,9 @@ class ModelMocker(Mocker):
 
         self.objects = MockSet(model=self.cls)
         self.objects.on('added', self._on_added)
+        self.objects.on('updated', self._remember)
+        # Field values of the rows as of their last write, which fields set on an instance before save() have changed
+        self._saved = {}
 
     def __enter__(self):
         result = super().__enter__()
@@ -441,6 +624,10 @@ class ModelMocker(Mocker):
     def _on_added(self, obj):
         pk = max([self._obj_pk(x) or 0 for x in self.objects] + [0]) + 1
         setattr(obj, self.cls._meta.pk.attname, pk)
+        self._remember(obj)
+
+    def _remember(self, obj):
+        self._saved[id(obj)] = {field.attname: getattr(obj, field.attname) for field in self.cls._meta.concrete_fields}
 
     def _meta_base_manager__insert(self, objects, *_, **__):
         obj = objects[0]
@@ -463,6 +650,9 @@ class ModelMocker(Mocker):
 
         if objects.exists():
             attrs = {field.attname: value for field, _, value in values if value is not None}
+            if is_journaling():
+                for obj in objects:
+                    journal(self.objects._undo_update, obj, dict(self._saved.get(id(obj), {})))
             self.objects.update(**attrs)
             return True
         else:
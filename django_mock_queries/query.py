@@ -1,20 +1,159 @@
+import copy
 import datetime
+import json
 import random
 from collections import OrderedDict, defaultdict, namedtuple
+from functools import wraps
 from unittest.mock import Mock, MagicMock, PropertyMock
 
 from .constants import *
 from .exceptions import *
+from .instrumentation import is_recording, query_boundary, record_query
+from . import stats
+from .cache import ResultCache
+from .fixtures import build_rows, collection_paused, csv_records, fixture_records
+from .indexes import AutoIndex, CompositeIndexes
+from .transactions import is_journaling, journal, not_journaled
 from .utils import (
-    matches, get_attribute, validate_mock_set, is_list_like_iter, flatten_list, truncate,
-    hash_dict, filter_results, get_nested_attr
+    matches, first_matches, get_attribute, validate_mock_set, is_list_like_iter, flatten_list, get_truncator,
+    hash_dict, filter_rows, get_nested_attr, is_subquery,
+    SubqueryResolver, prefetch_related_objects, select_related_objects, written
 )
 
+# Lookups of a MockSet that reference an outer query through OuterRef, and the
+# operations chained after them, which are replayed for every outer row.
+Correlation = namedtuple('Correlation', ('outer_refs', 'operations'))
+
+# One operation that derived a MockSet from another one, as shown by explain(). Its arguments are kept as given
+# and only formatted by explain().
+PlanStep = namedtuple('PlanStep', ('operation', 'args', 'kwargs', 'access', 'rows_scanned', 'rows_returned'))
+
+
+class CopyOnWrite:
+    """ What a root MockSet shares with its forks: its list of rows until it adds or deletes one, and each row
+    until the set updates it. """
+
+    def __init__(self):
+        self.shared_items = True
+        # Rows that only this set holds, because it added or copied them since it was forked
+        self.owned = set()
+        # Shared rows and their copies by the id of the shared row, to redirect writes through older derived sets
+        self.copies = {}
+        self.positions = None
+
+    def position(self, items, row):
+        """ The position of `row` in `items`, the list of the set, or None if it isn't one of them. """
+        if self.positions is None:
+            self.positions = {id(item): position for position, item in enumerate(items)}
+        return self.positions.get(id(row))
+
+
+class MockQuery:
+    """ Stand-in for `QuerySet.query` that lets a MockSet be wrapped in Subquery or Exists. """
+
+    def __init__(self, mock_set):
+        self.mock_set = mock_set
+        self.subquery = False
+
+    def clone(self):
+        return MockQuery(self.mock_set)
+
+    def exists(self, *_, **__):
+        return self.clone()
+
+
+def deferred_when_correlated(method):
+    """ Record `method` instead of running it when the MockSet is correlated to an outer query. """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._correlation is not None:
+            return self._defer(method.__name__, *args, **kwargs)
+        return method(self, *args, **kwargs)
+
+    return wrapper
+
+
+def _describe(args, kwargs):
+    return ', '.join([str(arg) for arg in args] + ['{}={!r}'.format(k, v) for k, v in kwargs.items()])
+
+
+def _planned(mock_set, method, args, kwargs, result):
+    """ Add the step that derived `result` from `mock_set` to the plan of `result`, unless a nested call did. """
+    if isinstance(result, MockSet) and result is not mock_set and result._plan is mock_set._plan:
+        result._plan = mock_set._plan + (PlanStep(
+            method.__name__.lstrip('_'), args, kwargs, mock_set._access,
+            len(mock_set.items), len(result.items)
+        ),)
+    return result
+
+
+def recorded(operation=None, uses_cache=False, fills_cache=False):
+    """ Record the would-be query of a MockSet method, and none of the ones it makes itself.
+
+    Methods that don't hit the database in Django, like filter(), pass no
+    operation but still keep the MockSets they walk through from being recorded.
+    Like the result cache of a QuerySet, once a set is fetched by a method that
+    `fills_cache`, the methods that `uses_cache` don't query it again.
+    """
+
+    def decorator(method):
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cached = uses_cache and self._fetched
+
+            if fills_cache and not self._fetched and not self._manager:
+                self._fetched = True
+
+            if not is_recording() and not stats.is_collecting():
+                return _planned(self, method, args, kwargs, method(self, *args, **kwargs))
+            elif operation is not None and not cached:
+                record_query(self.label, operation, rows=self._scanned_rows())
+
+            with query_boundary():
+                if query_boundary.depth > 1 or not stats.is_collecting():
+                    return _planned(self, method, args, kwargs, method(self, *args, **kwargs))
+
+                return _planned(self, method, args, kwargs, stats.measure(
+                    get_nested_attr(self.model, '_meta.label', default='MockSet'), method.__name__.lstrip('_'),
+                    args, kwargs, len(self.items), lambda: method(self, *args, **kwargs)
+                ))
+
+        return wrapper
+
+    return decorator
+
+
+def aggregate_aliases(args, kwargs):
+    """ The aggregates of an aggregate() call by alias, named like `speed__sum` when given without one. """
+    for expr in set(args):
+        kwargs['{}__{}'.format(expr.source_expressions[0].name, expr.function).lower()] = expr
+    return kwargs
+
+
+def cached(method):
+    """ Serve the result of a read-only method of a root set from its ResultCache, while its rows are unchanged. """
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        cache = self._result_cache
+        key = cache.key(method.__name__, args, kwargs) if cache is not None and cache.owner is self else None
+
+        if key is None:
+            return method(self, *args, **kwargs)
+        elif key in cache:
+            return cache.get(key)
+
+        return cache.put(key, method(self, *args, **kwargs))
+
+    return wrapper
+
 
 class MockSetMeta(type):
     def __call__(cls, *initial_items, **kwargs):
         obj = super().__call__(**kwargs)
-        obj.add(*initial_items)
+        with not_journaled():
+            obj.add(*initial_items)
         return obj
 
 
@@ -29,8 +168,6 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         'only',
         'defer',
         'using',
-        'select_related',
-        'prefetch_related',
         'select_for_update',
         'iterator'
     ]
@@ -38,6 +175,11 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
     def __init__(self, *initial_items, **kwargs):
         clone = kwargs.pop('clone', None)
         model = kwargs.pop('model', None)
+        label = kwargs.pop('label', None)
+        auto_index = kwargs.pop('auto_index', None)
+        indexes = kwargs.pop('indexes', None)
+        constraints = kwargs.pop('constraints', False)
+        cache = kwargs.pop('cache', None)
 
         for x in self.RETURN_SELF_METHODS:
             kwargs.update({x: self._return_self})
@@ -45,31 +187,119 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         super().__init__(spec=DjangoQuerySet, **kwargs)
 
         self.items = list()
-        self.clone = clone
+        # Not set through Mock.__setattr__, which would make `clone` a child mock of this set and keep the set alive
+        self.__dict__['clone'] = clone
         self.model = getattr(clone, 'model', model)
         self.events = {}
+        self.query = MockQuery(self)
+        self._correlation = None
+        # Name of the manager or relation that the set was reached through, like `Car.objects`
+        self.label = label if label is not None else getattr(clone, 'label', None)
+        # Labeled root sets stand for managers, which query again on every evaluation
+        self._manager = clone is None and label is not None
+        self._fetched = False
+        # The operations that derived this set from its root set, and how they read their rows
+        self._plan = clone._plan if isinstance(clone, MockSet) else ()
+        self._access = 'full scan'
+        # Indexes and live views of the root set, notified of the writes of every set derived from it
+        self._observers = clone._observers if isinstance(clone, MockSet) else []
+        self._auto_index = clone._auto_index if isinstance(clone, MockSet) else None
+        if auto_index:
+            self._auto_index = AutoIndex() if auto_index is True else auto_index
+            self._auto_index.bind(self)
+            self._observers.append(self._auto_index)
+        self._composite_indexes = clone._composite_indexes if isinstance(clone, MockSet) else None
+        if indexes or constraints:
+            self._composite_indexes = CompositeIndexes(indexes or (), self.model, constraints)
+            self._composite_indexes.bind(self)
+            self._observers.append(self._composite_indexes)
+        self._result_cache = None
+        if cache:
+            self._result_cache = ResultCache() if cache is True else cache
+            self._result_cache.bind(self)
+            self._observers.append(self._result_cache)
+        # Set by fork(), snapshot() and restore() on a root set whose rows are shared with another one
+        self._cow = None
+        # Lookups of prefetch_related(), applied to the rows when the set is evaluated
+        self._prefetch_lookups = clone._prefetch_lookups if isinstance(clone, MockSet) else ()
+        self._prefetch_done = False
 
         self.add(*initial_items)
 
-        self.__len__ = lambda s: len(s.items)
-        self.__iter__ = lambda s: iter(s.items)
-        self.__getitem__ = lambda s, k: self.items[k]
-        self.__bool__ = self.__nonzero__ = lambda s: len(s.items) > 0
+        self.__len__ = lambda s: self._len()
+        self.__iter__ = lambda s: self._iter()
+        self.__getitem__ = lambda s, k: self._getitem(k)
+        self.__bool__ = self.__nonzero__ = lambda s: self._bool()
 
     def _return_self(self, *_, **__):
+        if self._manager:
+            # Like Manager.all(), a set that is evaluated once instead of the manager that queries on every evaluation
+            return self._mockset_class()(*self.items, clone=self)
         return self
 
+    @recorded('len', uses_cache=True, fills_cache=True)
+    def _len(self):
+        return len(self._evaluated_items())
+
+    @recorded('iterate', uses_cache=True, fills_cache=True)
+    def _iter(self):
+        return iter(self._evaluated_items())
+
+    @recorded('bool', uses_cache=True, fills_cache=True)
+    def _bool(self):
+        return len(self._evaluated_items()) > 0
+
+    @recorded('getitem', uses_cache=True)
+    @deferred_when_correlated
+    def _getitem(self, k):
+        return self._evaluated_items()[k]
+
+    def _evaluated_items(self):
+        """ The rows of the set, with the relations of its prefetch_related() lookups cached on the first read. """
+        if self._prefetch_lookups and not self._prefetch_done:
+            self._prefetch_done = True
+            self._prefetch(self.items)
+
+        return self.items
+
+    def _prefetch(self, rows):
+        if self._prefetch_lookups and self._has_django_model():
+            prefetch_related_objects(rows, *self._prefetch_lookups)
+
+        return rows
+
+    def _defer(self, name, *args, **kwargs):
+        correlation = self._correlation
+        deferred = self._mockset_class()(*self.items, clone=self)
+        deferred._correlation = correlation._replace(operations=correlation.operations + ((name, args, kwargs),))
+        return deferred
+
     def _mockset_class(self):
         return type(self)
 
+    def _scanned_rows(self):
+        """ The rows of the set that this one was derived from, which a query without index reads. """
+        root = self
+        while isinstance(root.clone, MockSet):
+            root = root.clone
+        return len(root.items)
+
+    @recorded('count', uses_cache=True)
     def count(self):
         return len(self.items)
 
     def fire(self, obj, *events):
+        if self.clone is None or self.EVENT_ADDED not in events:
+            # Rows added to a derived set are only the rows it is made of
+            written(self.model)
+
         for name in events:
             for handler in self.events.get(name, []):
                 handler(obj)
 
+        for observer in self._observers:
+            observer.notify(self, obj, events)
+
     def on(self, event, handler):
         assert event in self.SUPPORTED_EVENTS, event
         self.events[event] = self.events.get(event, []) + [handler]
@@ -83,34 +313,104 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
                 setattr(obj, f.name, None)
 
     def add(self, *models):
+        if self._composite_indexes is not None and self._composite_indexes.owner is self:
+            self._composite_indexes.check(models)
+
         if self.model:
             # Initialize MockModel default fields from MockSet model fields if defined
             for obj in models:
                 self._register_fields(obj)
 
+        if not self._observers and not self.events and self._cow is None and not is_journaling():
+            # Nothing follows the writes of the set, so the rows are only stored
+            self.items.extend(models)
+            if models and self.clone is None:
+                written(self.model)
+            return
+
         for model in models:
-            self.items.append(model)
+            self._own_items().append(model)
+            if self._cow is not None:
+                self._cow.owned.add(id(model))
+                if self._cow.positions is not None:
+                    self._cow.positions[id(model)] = len(self.items) - 1
+            if is_journaling():
+                journal(self._undo_add, model)
             self.fire(model, self.EVENT_ADDED, self.EVENT_SAVED)
 
+    @recorded()
+    def _filter(self, *args, **attrs):
+        if self._composite_indexes is not None and self._composite_indexes.owner is self and self._correlation is None:
+            candidates, index = self._composite_indexes.candidates(attrs)
+
+            if candidates is not None:
+                found = self._mockset_class()(*candidates, clone=self)
+                found._access = 'composite index {}'.format(index.name)
+                return found._filter(*args, **attrs)
+
+        if self._auto_index is not None and self._auto_index.owner is self and self._correlation is None:
+            candidates, used = self._auto_index.candidates(attrs)
+
+            if candidates is not None:
+                # Rows found in the indexes are still checked against every lookup
+                found = self._mockset_class()(*candidates, clone=self)
+                found._access = 'auto index on {}'.format(', '.join(used))
+                return found._filter(*args, **attrs)
+
+        return self._mockset_class()(*filter_rows(self.items, args, attrs), clone=self)
+
+    @cached
     def filter(self, *args, **attrs):
-        results = list(self.items)
-        for x in args:
-            if not isinstance(x, DjangoQ):
-                raise ArgumentNotSupported()
+        outer_refs = {k: v for k, v in attrs.items() if isinstance(v, DjangoOuterRef)}
+        correlation = self._correlation
+
+        if correlation is not None and not outer_refs:
+            return self._defer('filter', *args, **attrs)
+        elif correlation is not None and correlation.operations:
+            # Outer references can only be decorrelated before any other operation is chained
+            raise ArgumentNotSupported()
+        elif not outer_refs:
+            return self._filter(*args, **attrs)
 
-            if len(x) > 0:
-                results = filter_results(results, x)
+        results = self._filter(*args, **{k: v for k, v in attrs.items() if k not in outer_refs})
+        results._correlation = Correlation({**getattr(correlation, 'outer_refs', {}), **outer_refs}, ())
 
-        return self._mockset_class()(*matches(*results, **attrs), clone=self)
+        return results
 
+    @recorded()
+    @deferred_when_correlated
+    @cached
     def exclude(self, *args, **attrs):
+        if any(isinstance(v, DjangoOuterRef) for v in attrs.values()):
+            raise ArgumentNotSupported()
+
         excluded = set(self.filter(*args, **attrs))
         results = [item for item in self.items if item not in excluded]
         return self._mockset_class()(*results, clone=self)
 
+    @recorded('exists', uses_cache=True)
     def exists(self):
         return len(self.items) > 0
 
+    def _has_django_model(self):
+        return isinstance(self.model, type) and issubclass(self.model, DjangoModel)
+
+    @recorded()
+    def select_related(self, *fields):
+        """ Cache the single related objects of all rows, resolved once per related table. """
+        if fields != (None,) and self._has_django_model():
+            select_related_objects(self.items, *fields)
+        return self
+
+    @recorded()
+    def prefetch_related(self, *lookups):
+        """ A set that caches the related rows of its rows when it is evaluated, like the `_prefetched_objects_cache`
+        of Django. `None` clears the lookups. """
+        prefetching = self._mockset_class()(*self.items, clone=self)
+        prefetching._prefetch_lookups = () if lookups == (None,) else self._prefetch_lookups + lookups
+        return prefetching
+
+    @recorded('in_bulk')
     def in_bulk(self, id_list=None, *, field_name='pk'):
         result = {}
         for model in self.items:
@@ -118,9 +418,15 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
                 result[getattr(model, field_name)] = model
         return result
 
+    @recorded()
+    @deferred_when_correlated
     def annotate(self, **kwargs):
         results = list(self.items)
         for key, value in kwargs.items():
+            if is_subquery(value):
+                # Decorrelate once for all rows instead of evaluating the subquery per row
+                value = SubqueryResolver(value)
+
             for row in results:
                 if not (hasattr(row, '_annotated_fields') and isinstance(row._annotated_fields, list)):
                     row._annotated_fields = []
@@ -129,13 +435,12 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return self._mockset_class()(*results, clone=self)
 
+    @recorded('aggregate')
+    @cached
     def aggregate(self, *args, **kwargs):
         result = {}
 
-        for expr in set(args):
-            kwargs['{}__{}'.format(expr.source_expressions[0].name, expr.function).lower()] = expr
-
-        for alias, expr in kwargs.items():
+        for alias, expr in aggregate_aliases(args, kwargs).items():
             values = []
             expr_result = None
 
@@ -162,8 +467,10 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return result
 
+    @recorded()
+    @deferred_when_correlated
     def order_by(self, *fields):
-        results = self.items
+        results = list(self.items)
         for field in reversed(fields):
             if field == '?':
                 random.shuffle(results)
@@ -175,6 +482,8 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
                              reverse=is_reversed)
         return self._mockset_class()(*results, clone=self, ordered=True)
 
+    @recorded()
+    @deferred_when_correlated
     def distinct(self, *fields):
         results = OrderedDict()
         for item in self.items:
@@ -187,6 +496,211 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         self.delete(**attrs)
         self.add(*objs)
 
+    @classmethod
+    def from_records(cls, records, model=None, coerce=False, **kwargs):
+        """ A set of the rows made from `records`, dicts of field values, in bulk.
+
+        With a model, rows are instances built without Model.__init__ and its
+        signals, with the defaults of missing fields and, with `coerce`, values
+        converted by their field. Other keyword arguments are those of MockSet.
+
+        cars = MockSet.from_records([{'id': 1, 'make_id': 1, 'speed': 100}], model=Car)
+        """
+        with collection_paused():
+            if model is None:
+                rows = [MockModel(**values) for values in records]
+            else:
+                rows = build_rows(records, model, coerce)
+
+            return cls(*rows, model=model, **kwargs)
+
+    @classmethod
+    def from_fixture(cls, path, model=None, coerce=True, **kwargs):
+        """ A set of the objects of `model` in a `dumpdata` fixture in JSON or JSON lines, read as a stream.
+
+        Without a model, it is the model of the first object of the fixture.
+        Dates, times and decimals are coerced from their JSON strings unless
+        `coerce` is False.
+        """
+        model, records = fixture_records(path, model)
+        return cls.from_records(records, model, coerce, **kwargs)
+
+    @classmethod
+    def from_csv(cls, path, model=None, coerce=True, delimiter=',', **kwargs):
+        """ A set of the rows of a CSV file whose header has the names or columns of the fields of `model`.
+
+        Values are coerced from strings by their field, and empty ones are None
+        for fields that don't allow empty strings, unless `coerce` is False.
+        """
+        return cls.from_records(csv_records(path, delimiter), model, coerce, **kwargs)
+
+    def fork(self):
+        """ A new root set of the same rows, which this set and the fork share until either of them writes a row.
+
+        Adding or deleting a row first copies the list of rows of the set, and
+        updating a row through the set or the sets derived from it first copies
+        that row, so forking a large fixture is cheap and tests writing to their
+        forks don't see each other's writes. Indexes are shared the same way and
+        copied on their first write, caches start empty and live views stay with
+        this set. Attributes set directly on a shared row
+        change it for every set.
+
+        cars = fixture.fork()
+        """
+        if isinstance(self.clone, MockSet):
+            raise ArgumentNotSupported()
+
+        fork = MockSet(model=self.model, label=self.label)
+        fork._share_rows(self)
+        return fork
+
+    def snapshot(self):
+        """ A fork that restore() brings this set back to, which is never written itself. """
+        return self.fork()
+
+    def restore(self, snapshot):
+        """ Go back to the rows of `snapshot`, sharing them again, whatever was written since it was taken.
+
+        Rows written since then were copies, so restoring takes the list of rows of
+        the snapshot back as it is. Indexes are copied from the snapshot and live
+        views of this set reload their rows.
+        """
+        if isinstance(self.clone, MockSet):
+            raise ArgumentNotSupported()
+
+        self._share_rows(snapshot)
+
+        for observer in list(self._observers):
+            reload = getattr(observer, 'reload', None)
+            if reload is not None:
+                reload()
+
+    def _share_rows(self, source):
+        self.items = source.items
+        self._cow, source._cow = CopyOnWrite(), CopyOnWrite()
+
+        for name in ('_auto_index', '_composite_indexes', '_result_cache'):
+            current, shared = getattr(self, name), getattr(source, name)
+            if current is not None:
+                self._observers.remove(current)
+
+            copied = shared.fork(self) if shared is not None else None
+            setattr(self, name, copied)
+            if copied is not None:
+                self._observers.append(copied)
+
+    def _undo_add(self, row):
+        items = self._own_items()
+        position = next(position for position in reversed(range(len(items))) if items[position] is row)
+        del items[position]
+        if self._cow is not None:
+            self._cow.owned.discard(id(row))
+            self._cow.positions = None
+
+        self.fire(row, self.EVENT_DELETED)
+
+    def _sequences(self, row):
+        """ Where `row` is in the order of each observer, to put it back there if its delete is undone. """
+        return [(observer, getattr(observer, 'sequence', {}).get(id(row))) for observer in self._observers]
+
+    def _undo_delete(self, row, position, sequences):
+        self._own_items().insert(position, row)
+        if self._cow is not None:
+            self._cow.positions = None
+
+        # Not an add, whose event handlers could change the row, like assigning it a new primary key
+        for observer, sequence in sequences:
+            observer.undelete(row, sequence)
+
+    def _undo_update(self, row, values):
+        for k, v in values.items():
+            setattr(row, k, v)
+
+        self.fire(row, self.EVENT_UPDATED)
+
+    def _own_items(self):
+        """ The list of rows of the set, copied first if it is still shared with a fork. """
+        if self._cow is not None and self._cow.shared_items:
+            self.items = list(self.items)
+            self._cow.shared_items = False
+
+        return self.items
+
+    def _own_row(self, row, position=None):
+        """ `row`, or a copy of it if its root set shares it with a fork, replacing it in this set and the ones it
+        was derived from. `position` is where the row is in this set, if known. """
+        root = self
+        while isinstance(root.clone, MockSet):
+            root = root.clone
+
+        cow = root._cow
+        if cow is None or id(row) in cow.owned:
+            return row
+
+        if id(row) in cow.copies:
+            copied = cow.copies[id(row)][1]
+        else:
+            items = root._own_items()
+            root_position = cow.position(items, row)
+            if root_position is None:
+                # Created through a derived set, never shared
+                return row
+
+            copied = copy.copy(row)
+            items[root_position] = copied
+            cow.positions[id(copied)] = cow.positions.pop(id(row))
+            cow.owned.add(id(copied))
+            cow.copies[id(row)] = row, copied
+
+            for observer in self._observers:
+                observer.replace(row, copied)
+
+        mock_set = self
+        while mock_set is not root:
+            if mock_set is self and position is not None:
+                mock_set.items[position] = copied
+            else:
+                mock_set.items = [copied if item is row else item for item in mock_set.items]
+            mock_set = mock_set.clone
+
+        return copied
+
+    def explain(self, *, format=None, **options):
+        """ Describe how the set was evaluated, like the query plan of QuerySet.explain().
+
+        Every operation since the root set is listed with its arguments, whether
+        it scanned all rows or looked them up in an index, the rows it scanned and
+        returned, and their ratio as its selectivity.
+        """
+        source = get_nested_attr(self.model, '_meta.label', default=None) or self.label or 'MockSet'
+        root = self
+        while isinstance(root.clone, MockSet):
+            root = root.clone
+
+        steps = [dict(
+            operation=step.operation,
+            arguments=_describe(step.args, step.kwargs),
+            access=step.access,
+            rows_scanned=step.rows_scanned,
+            rows_returned=step.rows_returned,
+            selectivity=round(step.rows_returned / step.rows_scanned, 4) if step.rows_scanned else None
+        ) for step in self._plan]
+
+        if format is not None and format.lower() == 'json':
+            return json.dumps({'source': source, 'rows': len(root.items), 'steps': steps}, default=str)
+        elif format is not None and format.lower() != 'text':
+            raise ValueError('{} is not a recognized format.'.format(format))
+
+        lines = ['SCAN {} ({} rows)'.format(source, len(root.items))]
+        for step in steps:
+            lines.append('{}--{}({}) using {}: {} rows scanned, {} returned{}'.format(
+                '  ' * len(lines), step['operation'], step['arguments'], step['access'], step['rows_scanned'],
+                step['rows_returned'],
+                '' if step['selectivity'] is None else ', selectivity {:.2f}'.format(step['selectivity'])
+            ))
+
+        return '\n'.join(lines)
+
     def _raise_does_not_exist(self):
         does_not_exist = getattr(self.model, 'DoesNotExist', ObjectDoesNotExist)
         raise does_not_exist()
@@ -231,21 +745,26 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         if len(results) == 0:
             self._raise_does_not_exist()
 
-        return results[0]
+        return self._prefetch(results[:1])[0]
 
+    @recorded('earliest')
     def earliest(self, *fields, **field_kwargs):
         return self._earliest_or_latest(*fields, **field_kwargs)
 
+    @recorded('latest')
     def latest(self, *fields, **field_kwargs):
         return self._earliest_or_latest(*fields, reverse=True, **field_kwargs)
 
+    @recorded('first', uses_cache=True)
     def first(self):
-        for item in self.items:
+        for item in self._prefetch(self.items[:1]):
             return item
 
+    @recorded('last', uses_cache=True)
     def last(self):
-        return self.items and self.items[-1] or None
+        return self.items and self._prefetch(self.items[-1:])[0] or None
 
+    @recorded('create')
     def create(self, **attrs):
         validate_mock_set(self, **attrs)
 
@@ -254,12 +773,30 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return obj
 
+    @recorded('create')
+    def bulk_create(self, objs, batch_size=None, ignore_conflicts=False):
+        objs = list(objs)
+        indexes = self._composite_indexes
+
+        if ignore_conflicts and indexes is not None and indexes.owner is self:
+            self.add(*indexes.without_conflicts(objs))
+        else:
+            self.add(*objs)
+
+        return objs
+
+    @recorded('update')
     def update(self, **attrs):
         validate_mock_set(self, for_update=True, **attrs)
+        if self._composite_indexes is not None:
+            self._composite_indexes.check_update(self.items, attrs)
 
         count = 0
-        for item in self.items:
+        for position, item in enumerate(list(self.items)):
             count += 1
+            item = self._own_row(item, position)
+            if is_journaling():
+                journal(self._undo_update, item, {k: getattr(item, k) for k in attrs})
             for k, v in attrs.items():
                 setattr(item, k, v)
                 self.fire(item, self.EVENT_UPDATED, self.EVENT_SAVED)
@@ -270,7 +807,17 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         removed_items = defaultdict(int)
 
         for item in matches(*items_to_remove, **attrs):
-            self.items.remove(item)
+            if self._cow is not None:
+                # A derived set made before a row was copied still holds the shared row
+                item = self._cow.copies.get(id(item), (None, item))[1]
+                self._cow.owned.discard(id(item))
+                self._cow.positions = None
+
+            items = self._own_items()
+            position = items.index(item)
+            del items[position]
+            if is_journaling():
+                journal(self._undo_delete, item, position, self._sequences(item))
             self.fire(item, self.EVENT_DELETED)
 
             # Support returning detailed information about removed items
@@ -283,6 +830,7 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return sum(removed_items.values()), removed_items
 
+    @recorded('delete')
     def delete(self, **attrs):
         # Delete normally doesn't take **attrs - they're only needed for remove
         return self._delete_recursive(*self.items, **attrs)
@@ -295,42 +843,61 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
     def remove(self, **attrs):
         return self.delete(**attrs)
 
+    def _matching(self, limit, *args, **attrs):
+        """ The first `limit` rows filter() would return, found without building the filtered set when possible. """
+        if args or self._correlation is not None or self._composite_indexes is not None \
+                or self._auto_index is not None or any(is_subquery(value) for value in attrs.values()):
+            return self.filter(*args, **attrs).items[:limit]
+
+        return first_matches(self.items, limit, **attrs)
+
+    @recorded('get')
     def get(self, *args, **attrs):
-        results = self.filter(*args, **attrs)
-        if not results.exists():
+        # A second match is enough to know that the lookup isn't unique
+        results = self._matching(2, *args, **attrs)
+        if not results:
             self._raise_does_not_exist()
-        elif results.count() > 1:
+        elif len(results) > 1:
             raise MultipleObjectsReturned()
         else:
-            return results[0]
+            return self._prefetch(results)[0]
 
+    @recorded('get')
     def get_or_create(self, defaults=None, **attrs):
         if defaults is not None:
             validate_mock_set(self)
         defaults = defaults or {}
         lookup = attrs.copy()
         attrs.update(defaults)
-        results = self.filter(**lookup)
-        if not results.exists():
+        results = self._matching(2, **lookup)
+        if not results:
+            record_query(self.label, 'create', internal=True)
             return self.create(**attrs), True
-        elif results.count() > 1:
+        elif len(results) > 1:
             raise MultipleObjectsReturned()
         else:
             return results[0], False
 
+    @recorded('get')
     def update_or_create(self, defaults=None, **attrs):
         if defaults is not None:
             validate_mock_set(self)
         defaults = defaults or {}
         lookup = attrs.copy()
         attrs.update(defaults)
-        results = self.filter(**lookup)
-        if not results.exists():
+        results = self._matching(2, **lookup)
+        if not results:
+            record_query(self.label, 'create', internal=True)
             return self.create(**attrs), True
-        elif results.count() > 1:
+        elif len(results) > 1:
             raise MultipleObjectsReturned()
         else:
-            obj = results[0]
+            record_query(self.label, 'update', internal=True)
+            if self._composite_indexes is not None:
+                self._composite_indexes.check_update(results, attrs)
+            obj = self._own_row(results[0])
+            if is_journaling():
+                journal(self._undo_update, obj, {k: getattr(obj, k) for k in attrs})
             for k, v in attrs.items():
                 setattr(obj, k, v)
                 self.fire(obj, self.EVENT_UPDATED, self.EVENT_SAVED)
@@ -366,6 +933,9 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return item_values
 
+    @deferred_when_correlated
+    @recorded()
+    @cached
     def values(self, *fields):
         result = []
 
@@ -403,6 +973,9 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return row
 
+    @deferred_when_correlated
+    @recorded()
+    @cached
     def values_list(self, *fields, **kwargs):
         # Django doesn't complain about this:
         # https://github.com/django/django/blob/a4e6030904df63b3f10aa0729b86dc6942b0458e/django/db/models/query.py#L845
@@ -417,11 +990,17 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
 
         return self._mockset_class()(*result, clone=self)
 
+    @recorded()
     def _date_values(self, field, kind, order, key_func):
-        initial_values = list(self.values_list(field, flat=True))
+        truncated = {}
+
+        for value in self.values_list(field, flat=True):
+            if value is None or value in truncated:
+                continue
+            truncated[value] = get_truncator(value, kind)(value)
 
         return self._mockset_class()(*sorted(
-            {truncate(x, kind) for x in initial_values},
+            set(truncated.values()),
             key=key_func,
             reverse=True if order == 'DESC' else False
         ), clone=self)
@@ -441,6 +1020,29 @@ class MockSet(MagicMock, metaclass=MockSetMeta):
         return self._date_values(field, kind, order, lambda y: datetime.datetime.timetuple(y)[:6])
 
 
+class PrefetchedMockSet(MockSet):
+    """ The related rows of an instance cached by prefetch_related(), read without querying the relation again.
+
+    Like the related manager of a prefetched instance, writes go to the relation
+    the rows were read from, which drops the cache.
+    """
+
+    def _mockset_class(self):
+        return MockSet
+
+
+def _relation_write(name):
+    def write(self, *args, **kwargs):
+        return getattr(self.clone, name)(*args, **kwargs)
+
+    write.__name__ = name
+    return write
+
+
+for _name in ('add', 'create', 'remove', 'set', 'clear', 'bulk_create', 'get_or_create', 'update_or_create'):
+    setattr(PrefetchedMockSet, _name, _relation_write(_name))
+
+
 class MockModel(dict):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
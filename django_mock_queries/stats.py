@@ -0,0 +1,109 @@
+from collections import namedtuple
+from operator import length_hint
+from time import perf_counter
+
+from django.db.models import Q
+
+StatsKey = namedtuple('StatsKey', 'model operation signature')
+OperationStats = namedtuple('OperationStats', 'calls total_time max_time rows_scanned rows_returned')
+Measurement = namedtuple('Measurement', 'model operation signature time rows_scanned rows_returned')
+
+_enabled = [False]
+_hooks = []
+_stats = {}
+
+
+def enable():
+    """ Collect stats of MockSet operations until disable() is called. """
+    _enabled[0] = True
+
+
+def disable():
+    _enabled[0] = False
+
+
+def is_collecting():
+    return _enabled[0] or len(_hooks) > 0
+
+
+def add_hook(hook):
+    """ Call `hook` with the Measurement of every MockSet operation, even when stats are disabled. """
+    _hooks.append(hook)
+
+
+def remove_hook(hook):
+    _hooks.remove(hook)
+
+
+def reset():
+    _stats.clear()
+
+
+def snapshot():
+    """ The OperationStats collected so far, by StatsKey. """
+    return {key: OperationStats(*values) for key, values in _stats.items()}
+
+
+def report(limit=20):
+    """ The operations that took the most time, slowest first. """
+    rows = sorted(snapshot().items(), key=lambda item: -item[1].total_time)[:limit]
+
+    return '\n'.join(
+        '{:.2f} ms in {} calls (max {:.2f} ms, {} rows scanned, {} returned): {}.{}({})'.format(
+            stats.total_time * 1000, stats.calls, stats.max_time * 1000, stats.rows_scanned,
+            stats.rows_returned, key.model, key.operation, key.signature
+        )
+        for key, stats in rows
+    )
+
+
+def _signature(value):
+    if isinstance(value, Q):
+        children = [
+            '{}={}'.format(child[0], '?') if isinstance(child, tuple) else _signature(child)
+            for child in value.children
+        ]
+        signature = '({})'.format(' {} '.format(value.connector).join(children))
+        return 'NOT ' + signature if value.negated else signature
+    elif isinstance(value, str):
+        return value
+
+    return type(value).__name__
+
+
+def lookup_signature(args, kwargs):
+    """ The shape of the arguments of an operation, like `make__name=?, speed__gt=?`, without their values. """
+    return ', '.join([_signature(arg) for arg in args] + ['{}=?'.format(name) for name in sorted(kwargs)])
+
+
+def _count(result):
+    if hasattr(result, 'items') and isinstance(result.items, list):
+        return len(result.items)
+    elif isinstance(result, (list, tuple, dict)):
+        return len(result)
+    elif hasattr(result, '__length_hint__'):
+        return length_hint(result)
+
+    return 0 if result is None else 1
+
+
+def measure(model, operation, args, kwargs, rows_scanned, call):
+    """ Run `call` and add its time and row counts to the stats of the operation. """
+    start = perf_counter()
+    result = call()
+    elapsed = perf_counter() - start
+
+    measurement = Measurement(model, operation, lookup_signature(args, kwargs), elapsed, rows_scanned, _count(result))
+
+    if _enabled[0]:
+        values = _stats.setdefault(StatsKey(model, operation, measurement.signature), [0, 0.0, 0.0, 0, 0])
+        values[0] += 1
+        values[1] += elapsed
+        values[2] = max(values[2], elapsed)
+        values[3] += rows_scanned
+        values[4] += measurement.rows_returned
+
+    for hook in list(_hooks):
+        hook(measurement)
+
+    return result
@@ -0,0 +1,155 @@
+from contextlib import ContextDecorator, contextmanager
+from itertools import count
+
+_journals = []
+
+
+def is_journaling():
+    return len(_journals) > 0 and _journals[-1] is not None
+
+
+def journal(undo, *args):
+    """ Record that calling `undo(*args)` reverts a write to a MockSet, on the innermost active journal. """
+    if is_journaling():
+        _journals[-1].record(undo, *args)
+
+
+@contextmanager
+def not_journaled():
+    """ Writes that nobody can roll back, like the rows a new MockSet is made of. """
+    _journals.append(None)
+    try:
+        yield
+    finally:
+        _journals.pop()
+
+
+class Journal(ContextDecorator):
+    """ Undo log of the writes made to MockSets while active.
+
+    Every add, delete, create and update records its inverse, so rolling back
+    to a savepoint takes time in the number of writes made since, not in the
+    number of rows. Fields set directly on a row are rolled back for the rows
+    of a ModelMocker or a MockDatabase, which remember their values as of
+    their last save(), and so are the links of many-to-many relations.
+
+    with Journal() as journal:
+        sid = journal.savepoint()
+        Car.objects.filter(speed=0).delete()
+        journal.savepoint_rollback(sid)
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.savepoints = {}
+        self.counter = count(1)
+
+    def __enter__(self):
+        _journals.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        _journals.remove(self)
+        return False
+
+    def record(self, undo, *args):
+        self.entries.append((undo, args))
+
+    def savepoint(self):
+        sid = 's{}'.format(next(self.counter))
+        self.savepoints[sid] = len(self.entries)
+        return sid
+
+    def savepoint_commit(self, sid):
+        # The writes since the savepoint now belong to the enclosing one
+        self.savepoints.pop(sid, None)
+
+    def savepoint_rollback(self, sid):
+        self._undo(self.savepoints[sid])
+
+    def commit(self):
+        # Writes committed inside an enclosing journal can still be rolled back by it
+        position = next((i for i, journal in enumerate(_journals) if journal is self), 0)
+        if position > 0 and _journals[position - 1] is not None:
+            _journals[position - 1].entries.extend(self.entries)
+
+        self.entries = []
+        self.savepoints = {}
+
+    def rollback(self):
+        self._undo(0)
+        self.savepoints = {}
+
+    def _undo(self, length):
+        # Undo functions write to the sets themselves, which mustn't be recorded again
+        with not_journaled():
+            while len(self.entries) > length:
+                undo, args = self.entries.pop()
+                undo(*args)
+
+        self.savepoints = {sid: position for sid, position in self.savepoints.items() if position <= length}
+
+
+class MockTransactions:
+    """ Transaction management of a mocked connection, which rolls MockSets back from a Journal.
+
+    It gives `transaction.atomic()`, savepoints and manual commit and rollback
+    their usual behavior, nested atomic blocks included, for the writes to
+    mocked sets. mock_django_connection() binds one to the mocked connection.
+    """
+
+    def __init__(self):
+        self.connection = None
+        self.autocommit = True
+        self.journal = None
+
+    def bind(self, connection):
+        self.connection = connection
+        connection.in_atomic_block = False
+        connection.savepoint_ids = []
+        connection.atomic_blocks = []
+        connection.needs_rollback = False
+        connection.commit_on_exit = True
+        connection.closed_in_transaction = False
+
+        for name in ('get_autocommit', 'set_autocommit', 'commit', 'rollback', 'savepoint', 'savepoint_commit',
+                     'savepoint_rollback', 'get_rollback', 'set_rollback'):
+            setattr(connection, name, getattr(self, name))
+
+    def get_autocommit(self):
+        return self.autocommit
+
+    def set_autocommit(self, autocommit, force_begin_transaction_with_broken_autocommit=False):
+        if not autocommit and self.journal is None:
+            self.journal = Journal().__enter__()
+        elif autocommit and self.journal is not None:
+            self.journal.__exit__(None, None, None)
+            self.journal = None
+
+        self.autocommit = autocommit
+
+    def commit(self):
+        if self.journal is not None:
+            self.journal.commit()
+
+    def rollback(self):
+        if self.journal is not None:
+            self.journal.rollback()
+        self.connection.needs_rollback = False
+
+    def savepoint(self):
+        return self.journal.savepoint() if self.journal is not None else None
+
+    def savepoint_commit(self, sid):
+        if self.journal is not None:
+            self.journal.savepoint_commit(sid)
+
+    def savepoint_rollback(self, sid):
+        if self.journal is not None:
+            self.journal.savepoint_rollback(sid)
+
+    def get_rollback(self):
+        return self.connection.needs_rollback
+
+    def set_rollback(self, rollback):
+        self.connection.needs_rollback = rollback
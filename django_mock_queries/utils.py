@@ -1,3 +1,4 @@
+from collections import defaultdict, namedtuple
 from datetime import datetime, date
 from django.core.exceptions import FieldError
 from django.db.models import F, Value, Case
@@ -7,6 +8,7 @@ from unittest.mock import Mock
 from .comparisons import *
 from .constants import *
 from .exceptions import *
+from .instrumentation import record_query
 
 import django_mock_queries.query
 
@@ -95,9 +97,15 @@ def validate_field(field_name, model_fields, for_update=False):
         raise FieldError(message)
 
 
+class RelatedValues(list):
+    """ Values reached through a multi-valued relation, a lookup matches if any of them does. """
+
+
 def get_field_value(obj, field_name, default=None):
     if type(obj) is dict:
         return obj.get(field_name, default)
+    elif isinstance(obj, django_mock_queries.query.MockSet):
+        return RelatedValues(get_attribute(x, field_name, default)[0] for x in obj)
     elif is_list_like_iter(obj):
         return [get_attribute(x, field_name, default)[0] for x in obj]
     elif is_like_date_or_datetime(obj):
@@ -109,7 +117,11 @@ def get_field_value(obj, field_name, default=None):
 def get_attribute(obj, attr, default=None):
     result = obj
     comparison = None
-    if isinstance(attr, F):
+    if isinstance(attr, SubqueryResolver):
+        return attr.value(obj), None
+    elif is_subquery(attr):
+        return SubqueryResolver(attr).value(obj), None
+    elif isinstance(attr, F):
         attr = attr.deconstruct()[1][0]
     elif isinstance(attr, Value):
         return attr.value, None
@@ -147,9 +159,109 @@ def get_attribute(obj, attr, default=None):
     return result, comparison
 
 
+COMPARISON_FUNCTIONS = {
+    COMPARISON_EXACT: exact_comparison,
+    COMPARISON_IEXACT: iexact_comparison,
+    COMPARISON_CONTAINS: contains_comparison,
+    COMPARISON_ICONTAINS: icontains_comparison,
+    COMPARISON_GT: gt_comparison,
+    COMPARISON_GTE: gte_comparison,
+    COMPARISON_LT: lt_comparison,
+    COMPARISON_LTE: lte_comparison,
+    COMPARISON_IN: in_comparison,
+    COMPARISON_STARTSWITH: startswith_comparison,
+    COMPARISON_ISTARTSWITH: istartswith_comparison,
+    COMPARISON_ENDSWITH: endswith_comparison,
+    COMPARISON_IENDSWITH: iendswith_comparison,
+    COMPARISON_ISNULL: isnull_comparison,
+    COMPARISON_REGEX: regex_comparison,
+    COMPARISON_IREGEX: iregex_comparison,
+    COMPARISON_RANGE: range_comparison,
+    COMPARISON_OVERLAP: overlap_comparison,
+}
+
+OPERAND_PREPARERS = {
+    COMPARISON_IEXACT: prepare_lower_operand,
+    COMPARISON_ICONTAINS: prepare_lower_operand,
+    COMPARISON_ISTARTSWITH: prepare_lower_operand,
+    COMPARISON_IENDSWITH: prepare_lower_operand,
+    COMPARISON_REGEX: prepare_regex_operand,
+    COMPARISON_IREGEX: prepare_iregex_operand,
+    COMPARISON_IN: prepare_in_operand,
+    COMPARISON_OVERLAP: prepare_overlap_operand,
+}
+
+# A filter value normalized once per query for the comparison it is used with.
+Operand = namedtuple('Operand', ('comparison', 'raw', 'value'))
+
+# The hashed keys of a MockSet `__in` operand, evaluated once for a semi-join.
+SemiJoin = namedtuple('SemiJoin', ('pks', 'items'))
+
+
+def lookup_comparison(attr):
+    """ Guess the comparison of a lookup like `name__iexact` or `created__year__gt` from its name alone. """
+    parts = attr.split('__')
+    last = parts[-1]
+
+    if len(parts) > 1 and last in COMPARISONS:
+        if len(parts) > 2 and parts[-2] in DATETIME_COMPARISONS:
+            return parts[-2], last
+        return last
+    elif len(parts) > 1 and last in DATETIME_COMPARISONS:
+        return last, COMPARISON_EXACT
+
+    return None
+
+
+def _prepare_value(comparison, value):
+    preparer = OPERAND_PREPARERS.get(comparison)
+    if preparer is None or isinstance(value, django_mock_queries.query.MockSet):
+        return value
+    return preparer(value)
+
+
+def prepare_semi_join(mock_set):
+    items = list(mock_set)
+    return SemiJoin(prepare_in_operand(convert_to_pks(items)), prepare_in_operand(items))
+
+
+def prepare_operand(attr, value):
+    """ Normalize the filter value of lookup `attr` before scanning any rows. """
+    comparison = lookup_comparison(attr)
+    inner = comparison[1] if isinstance(comparison, tuple) else comparison
+
+    if inner not in OPERAND_PREPARERS or isinstance(value, Operand):
+        return value
+
+    try:
+        if inner == COMPARISON_IN and isinstance(value, django_mock_queries.query.MockSet):
+            prepared = prepare_semi_join(value)
+        else:
+            prepared = _prepare_value(inner, value)
+    except Exception:
+        # Leave it to the per row comparison to raise the error, if any row is compared
+        return value
+
+    return value if prepared is value else Operand(comparison, value, prepared)
+
+
 def is_match(first, second, comparison=None):
     if isinstance(first, django_mock_queries.query.MockSet):
         return is_match_in_children(comparison, first, second)
+    if isinstance(first, RelatedValues):
+        # No related rows compare like the NULL of an outer join
+        return is_match_in_children(comparison, first or [None], second)
+
+    prepared = False
+    if isinstance(second, Operand):
+        prepared = second.comparison == comparison
+        second = second.value if prepared else second.raw
+    if isinstance(second, SemiJoin) and isinstance(first, DjangoModel):
+        # Related instances are compared by key, which matches both rows and `values_list('pk', flat=True)`
+        first, second = first.pk, second.pks
+    elif isinstance(second, SemiJoin):
+        second = second.pks if isinstance(first, (int, str)) else second.items
+
     if (isinstance(first, (int, str)) and isinstance(second, django_mock_queries.query.MockSet)):
         second = convert_to_pks(second)
     if (isinstance(first, date) or isinstance(first, datetime)) \
@@ -158,50 +270,31 @@ def is_match(first, second, comparison=None):
         comparison = comparison[1]
     if not comparison:
         return first == second
-    return {
-        COMPARISON_EXACT: exact_comparison,
-        COMPARISON_IEXACT: iexact_comparison,
-        COMPARISON_CONTAINS: contains_comparison,
-        COMPARISON_ICONTAINS: icontains_comparison,
-        COMPARISON_GT: gt_comparison,
-        COMPARISON_GTE: gte_comparison,
-        COMPARISON_LT: lt_comparison,
-        COMPARISON_LTE: lte_comparison,
-        COMPARISON_IN: in_comparison,
-        COMPARISON_STARTSWITH: startswith_comparison,
-        COMPARISON_ISTARTSWITH: istartswith_comparison,
-        COMPARISON_ENDSWITH: endswith_comparison,
-        COMPARISON_IENDSWITH: iendswith_comparison,
-        COMPARISON_ISNULL: isnull_comparison,
-        COMPARISON_REGEX: regex_comparison,
-        COMPARISON_IREGEX: iregex_comparison,
-        COMPARISON_RANGE: range_comparison,
-        COMPARISON_OVERLAP: overlap_comparison,
-    }[comparison](first, second)
+    if not prepared:
+        second = _prepare_value(comparison, second)
+
+    return COMPARISON_FUNCTIONS[comparison](first, second)
+
+
+DATE_PART_EXTRACTORS = {
+    COMPARISON_DATE: lambda obj: obj.date() if isinstance(obj, datetime) else obj,
+    COMPARISON_YEAR: lambda obj: obj.year,
+    COMPARISON_ISO_YEAR: lambda obj: obj.isocalendar()[0],
+    COMPARISON_QUARTER: lambda obj: (obj.month - 1) // 3 + 1,
+    COMPARISON_MONTH: lambda obj: obj.month,
+    COMPARISON_WEEK: lambda obj: obj.isocalendar()[1],
+    COMPARISON_DAY: lambda obj: obj.day,
+    COMPARISON_WEEK_DAY: lambda obj: obj.isoweekday() % 7 + 1,
+    COMPARISON_ISO_WEEK_DAY: lambda obj: obj.isoweekday(),
+    COMPARISON_TIME: lambda obj: obj.time(),
+    COMPARISON_HOUR: lambda obj: obj.hour,
+    COMPARISON_MINUTE: lambda obj: obj.minute,
+    COMPARISON_SECOND: lambda obj: obj.second,
+}
 
 
 def extract(obj, comparison):
-    result_dict = None
-    if isinstance(obj, date):
-        result_dict = {
-            COMPARISON_DATE: obj,
-            COMPARISON_YEAR: obj.year,
-            COMPARISON_MONTH: obj.month,
-            COMPARISON_DAY: obj.day,
-            COMPARISON_WEEK_DAY: (obj.weekday() + 1) % 7 + 1,
-        }
-    if isinstance(obj, datetime):
-        result_dict = {
-            COMPARISON_DATE: obj.date(),
-            COMPARISON_YEAR: obj.year,
-            COMPARISON_MONTH: obj.month,
-            COMPARISON_DAY: obj.day,
-            COMPARISON_WEEK_DAY: (obj.weekday() + 1) % 7 + 1,
-            COMPARISON_HOUR: obj.hour,
-            COMPARISON_MINUTE: obj.minute,
-            COMPARISON_SECOND: obj.second,
-        }
-    return result_dict[comparison]
+    return DATE_PART_EXTRACTORS[comparison](obj)
 
 
 def convert_to_pks(query):
@@ -227,11 +320,95 @@ def is_disqualified(obj, attrs, negated):
     return False
 
 
+def predicate_cost(attr):
+    """ The relative cost of checking lookup `attr` on one row, higher for slow comparisons and relation hops. """
+    parts = attr.split('__')
+    comparison = lookup_comparison(attr)
+
+    if comparison is None:
+        fields, cost = len(parts), COMPARISON_COSTS[COMPARISON_EXACT]
+    elif isinstance(comparison, tuple):
+        fields = len(parts) - (1 if parts[-1] == comparison[0] else 2)
+        cost = COMPARISON_COSTS.get(comparison[1], 1) + DATETIME_COMPARISON_COST
+    else:
+        fields, cost = len(parts) - 1, COMPARISON_COSTS.get(comparison, 1)
+
+    return cost * RELATION_HOP_COST ** max(fields - 1, 0)
+
+
+def order_predicates(source, predicates, negated=False):
+    """ The (lookup, value) pairs of a conjunction in the order that rejects rows soonest for the least work.
+
+    The share of rows each lookup keeps is measured on a sample of `source`, and lookups are ranked
+    by cost / (1 - kept share). Small sources and lookups that can't be sampled keep their order.
+    """
+    if len(predicates) < 2 or len(source) < PREDICATE_SAMPLE_SIZE * 4:
+        return predicates
+
+    sample = source[::len(source) // PREDICATE_SAMPLE_SIZE][:PREDICATE_SAMPLE_SIZE]
+    ranks = []
+
+    try:
+        for attr, value in predicates:
+            kept = 0
+            for row in sample:
+                attr_value, comparison = get_attribute(row, attr)
+                kept += bool(is_match(attr_value, value, comparison)) != negated
+
+            ranks.append(predicate_cost(attr) * (len(sample) + 2) / (len(sample) + 1 - kept))
+    except Exception:
+        # Leave it to the scan to raise the error in the order the lookups were given
+        return predicates
+
+    return [predicate for _, predicate in sorted(zip(ranks, predicates), key=lambda pair: pair[0])]
+
+
+def _in_order(scan, source, predicates, negated=False):
+    """ `scan(predicates)` with the predicates in the order of order_predicates().
+
+    The order comes from a sample, so a reordered lookup can raise on a row
+    that a lookup before it in the given order would have rejected. The scan
+    is then repeated in the given order, which gives the results of the
+    original order or its error.
+    """
+    ordered = order_predicates(source, predicates, negated)
+
+    try:
+        return scan(ordered)
+    except Exception:
+        if [attr for attr, _ in ordered] == [attr for attr, _ in predicates]:
+            raise
+        return scan(predicates)
+
+
 def matches(*source, **attrs):
     negated = attrs.pop('negated', False)
-    disqualified = [x for x in source if is_disqualified(x, attrs, negated)]
+    predicates = [(k, prepare_operand(k, v)) for k, v in attrs.items()]
+
+    def scan(ordered):
+        lookups = dict(ordered)
+        return [x for x in source if not is_disqualified(x, lookups, negated)]
+
+    return _in_order(scan, source, predicates, negated)
+
+
+def first_matches(source, limit, **attrs):
+    """ The first `limit` rows of `source` that match `attrs`, without checking the rows after them. """
+    predicates = [(k, prepare_operand(k, v)) for k, v in attrs.items()]
+
+    def scan(ordered):
+        lookups = dict(ordered)
+        found = []
+
+        for row in source:
+            if not is_disqualified(row, lookups, False):
+                found.append(row)
+                if len(found) == limit:
+                    break
 
-    return [x for x in source if x not in disqualified]
+        return found
+
+    return _in_order(scan, source, predicates)
 
 
 def validate_mock_set(mock_set, for_update=False, **fields):
@@ -247,9 +424,13 @@ def validate_mock_set(mock_set, for_update=False, **fields):
 def validate_date_or_datetime(value, comparison):
     mapping = {
         COMPARISON_YEAR: lambda: True,
+        COMPARISON_ISO_YEAR: lambda: True,
+        COMPARISON_QUARTER: lambda: QUARTER_BOUNDS[0] <= value <= QUARTER_BOUNDS[1],
         COMPARISON_MONTH: lambda: MONTH_BOUNDS[0] <= value <= MONTH_BOUNDS[1],
+        COMPARISON_WEEK: lambda: WEEK_BOUNDS[0] <= value <= WEEK_BOUNDS[1],
         COMPARISON_DAY: lambda: DAY_BOUNDS[0] <= value <= DAY_BOUNDS[1],
         COMPARISON_WEEK_DAY: lambda: WEEK_DAY_BOUNDS[0] <= value <= WEEK_DAY_BOUNDS[1],
+        COMPARISON_ISO_WEEK_DAY: lambda: WEEK_DAY_BOUNDS[0] <= value <= WEEK_DAY_BOUNDS[1],
         COMPARISON_HOUR: lambda: HOUR_BOUNDS[0] <= value <= HOUR_BOUNDS[1],
         COMPARISON_MINUTE: lambda: MINUTE_BOUNDS[0] <= value <= MINUTE_BOUNDS[1],
         COMPARISON_SECOND: lambda: SECOND_BOUNDS[0] <= value <= SECOND_BOUNDS[1],
@@ -283,24 +464,29 @@ def flatten_list(source):
     return target
 
 
+DATE_TRUNCATORS = {
+    'year': lambda obj: obj.replace(month=1, day=1),
+    'month': lambda obj: obj.replace(day=1),
+    'day': lambda obj: obj,
+}
+
+DATETIME_TRUNCATORS = {
+    'year': lambda obj: obj.replace(month=1, day=1, hour=0, minute=0, second=0),
+    'month': lambda obj: obj.replace(day=1, hour=0, minute=0, second=0),
+    'day': lambda obj: obj.replace(hour=0, minute=0, second=0),
+    'hour': lambda obj: obj.replace(minute=0, second=0),
+    'minute': lambda obj: obj.replace(second=0),
+    'second': lambda obj: obj,
+}
+
+
+def get_truncator(obj, kind):
+    truncators = DATETIME_TRUNCATORS if isinstance(obj, datetime) else DATE_TRUNCATORS
+    return truncators[kind]
+
+
 def truncate(obj, kind):
-    trunc_mapping = None
-    if isinstance(obj, date):
-        trunc_mapping = {
-            'year': obj.replace(month=1, day=1),
-            'month': obj.replace(day=1),
-            'day': obj
-        }
-    if isinstance(obj, datetime):
-        trunc_mapping = {
-            'year': obj.replace(month=1, day=1, hour=0, minute=0, second=0),
-            'month': obj.replace(day=1, hour=0, minute=0, second=0),
-            'day': obj.replace(hour=0, minute=0, second=0),
-            'hour': obj.replace(minute=0, second=0),
-            'minute': obj.replace(second=0),
-            'second': obj
-        }
-    return trunc_mapping[kind]
+    return get_truncator(obj, kind)(obj)
 
 
 def hash_dict(obj, *fields):
@@ -311,18 +497,30 @@ def hash_dict(obj, *fields):
 
 
 def filter_results(source, query):
+    if query.connector == CONNECTORS_AND and query.children:
+        # Each lookup of a conjunction only checks the rows the ones before it kept
+        lookups = [(child[0], prepare_operand(*child)) for child in query.children if isinstance(child, tuple)]
+        others = [child for child in query.children if not isinstance(child, tuple)]
+
+        def scan(ordered):
+            results = list(source)
+
+            for child in ordered + others:
+                results = _filter_single_q(results, child, query.negated)
+                if not results:
+                    break
+
+            return results
+
+        return _in_order(scan, source, lookups, query.negated)
+
     results = []
 
     for child in query.children:
         filtered = _filter_single_q(source, child, query.negated)
 
         if filtered:
-            if not results or query.connector == CONNECTORS_OR:
-                results = merge(results, filtered)
-            else:
-                results = intersect(results, filtered)
-        elif query.connector == CONNECTORS_AND:
-            return []
+            results = merge(results, filtered)
 
     return results
 
@@ -330,10 +528,367 @@ def filter_results(source, query):
 def _filter_single_q(source, q_obj, negated):
     if isinstance(q_obj, DjangoQ):
         return filter_results(source, q_obj)
+    elif not isinstance(q_obj, tuple):
+        return filter_expression(source, q_obj, negated)
     else:
         return matches(negated=negated, *source, **{q_obj[0]: q_obj[1]})
 
 
+def is_subquery(value):
+    if DjangoNegatedExpression is not None and isinstance(value, DjangoNegatedExpression):
+        value = value.expression
+    return isinstance(value, DjangoSubquery)
+
+
+def join_key(value):
+    return value.pk if isinstance(value, DjangoModel) else value
+
+
+def subquery_value(row):
+    if type(row) is dict:
+        return join_key(next(iter(row.values()), None))
+    elif isinstance(row, tuple):
+        return join_key(row[0])
+    elif hasattr(row, '_meta'):
+        return row.pk
+    return join_key(row)
+
+
+class SubqueryResolver:
+    """ Evaluate a Subquery or Exists wrapping a MockSet for outer rows.
+
+    Lookups correlated with OuterRef are decorrelated into a hash join: the inner
+    rows are grouped once by the values of the equality lookups, and the chained
+    operations are replayed once per distinct outer key instead of once per row.
+    """
+
+    def __init__(self, expression):
+        self.negated = getattr(expression, 'negated', False)
+
+        if DjangoNegatedExpression is not None and isinstance(expression, DjangoNegatedExpression):
+            expression = expression.expression
+            self.negated = not self.negated
+
+        mock_set = getattr(expression.query, 'mock_set', None)
+        if mock_set is None:
+            raise ArgumentNotSupported()
+
+        correlation = mock_set._correlation
+        self.mock_set = mock_set
+        self.exists = isinstance(expression, DjangoExists)
+        self.outer_refs = correlation.outer_refs if correlation else {}
+        self.operations = correlation.operations if correlation else ()
+        self.equi_lookups = [k for k in self.outer_refs if lookup_comparison(k) in (None, COMPARISON_EXACT)]
+        self.groups = None
+        self.cache = {}
+        self.memo = {}
+
+        if any(not isinstance(ref.name, str) for ref in self.outer_refs.values()):
+            # Nested OuterRef(OuterRef(...)) references
+            raise ArgumentNotSupported()
+
+    @property
+    def correlated(self):
+        return len(self.outer_refs) > 0
+
+    def _group_rows(self):
+        groups = defaultdict(list)
+        for row in self.mock_set.items:
+            key = tuple(join_key(get_attribute(row, lookup)[0]) for lookup in self.equi_lookups)
+            groups[key].append(row)
+        return groups
+
+    def _evaluate(self, rows, outer_values):
+        if outer_values:
+            rows = matches(*rows, **outer_values)
+
+        result = self.mock_set._mockset_class()(*rows, model=self.mock_set.model)
+        for name, args, kwargs in self.operations:
+            result = getattr(result, name)(*args, **kwargs)
+
+        return result
+
+    def _resolve(self, obj):
+        outer_values = {lookup: get_attribute(obj, ref.name)[0] for lookup, ref in self.outer_refs.items()}
+        key = tuple(join_key(outer_values[lookup]) for lookup in self.equi_lookups)
+        remaining = {k: v for k, v in outer_values.items() if k not in self.equi_lookups}
+
+        try:
+            cache_key = key + tuple(remaining.items())
+            if cache_key in self.cache:
+                return cache_key, self.cache[cache_key]
+            if self.groups is None:
+                self.groups = self._group_rows()
+            rows = self.groups.get(key, [])
+        except TypeError:
+            # Unhashable join keys, fall back to a nested loop for this row
+            return None, self._evaluate(self.mock_set.items, outer_values)
+
+        result = self.cache[cache_key] = self._evaluate(rows, remaining)
+        return cache_key, result
+
+    def _memoized(self, obj, kind, compute):
+        cache_key, result = self._resolve(obj)
+        if cache_key is None:
+            return compute(result)
+
+        memo_key = (kind, cache_key)
+        if memo_key not in self.memo:
+            self.memo[memo_key] = compute(result)
+        return self.memo[memo_key]
+
+    def _first_value(self, result):
+        if self.exists:
+            return (len(result) > 0) != self.negated
+
+        for row in result:
+            return subquery_value(row)
+
+        return None
+
+    def resolve(self, obj):
+        return self._resolve(obj)[1]
+
+    def value(self, obj):
+        return self._memoized(obj, 'value', self._first_value)
+
+    def values(self, obj):
+        return self._memoized(obj, 'values', lambda result: [subquery_value(row) for row in result])
+
+    def operand(self, obj, attr):
+        """ The subquery result for `obj` as a prepared filter value for lookup `attr`. """
+        comparison = lookup_comparison(attr)
+        many = (comparison[1] if isinstance(comparison, tuple) else comparison) == COMPARISON_IN
+        compute = self.values if many else self.value
+
+        return self._memoized(obj, attr, lambda _: prepare_operand(attr, compute(obj)))
+
+
+def filter_expression(source, expression, negated=False):
+    if not is_subquery(expression):
+        raise ArgumentNotSupported()
+
+    resolver = SubqueryResolver(expression)
+    return [obj for obj in source if bool(resolver.value(obj)) != negated]
+
+
+def filter_subqueries(source, attrs):
+    for attr_name, expression in attrs.items():
+        resolver = SubqueryResolver(expression)
+        results = []
+
+        for obj in source:
+            attr_value, comparison = get_attribute(obj, attr_name)
+            filter_value = resolver.operand(obj, attr_name)
+
+            # Like SQL, comparing against an empty (NULL) subquery never matches
+            if filter_value is not None and is_match(join_key(attr_value), filter_value, comparison):
+                results.append(obj)
+
+        source = results
+
+    return source
+
+
+def filter_rows(source, args, attrs):
+    """ The rows of `source` that match the Q objects, subquery expressions and lookups of a filter() call. """
+    results = list(source)
+
+    for x in args:
+        if is_subquery(x):
+            results = filter_expression(results, x)
+            continue
+
+        if not isinstance(x, DjangoQ):
+            raise ArgumentNotSupported()
+
+        if len(x) > 0:
+            results = filter_results(results, x)
+
+    subqueries = {k: v for k, v in attrs.items() if is_subquery(v)}
+    results = filter_subqueries(results, subqueries)
+
+    return matches(*results, **{k: v for k, v in attrs.items() if k not in subqueries})
+
+
+def find_relation(model, name, method):
+    """ The field or reverse relation that `model` exposes as the attribute `name`, like `make` or `car_set`. """
+    for field in model._meta.get_fields():
+        accessor = field.get_accessor_name() if field.auto_created and not field.concrete else field.name
+
+        if field.is_relation and accessor == name:
+            return field
+
+    raise FieldError(
+        "Invalid field name '{}' given in {}() for {} object.".format(name, method, model._meta.object_name)
+    )
+
+
+def get_accessor_name(descriptor):
+    """ The attribute name of a related manager descriptor, like `car_set`. """
+    if getattr(descriptor, 'reverse', True):
+        return descriptor.rel.get_accessor_name()
+
+    return descriptor.field.name
+
+
+# The number of writes to the rows of each model, of which the rows cached by prefetch_related() were read at one
+_writes = defaultdict(int)
+
+
+def written(model):
+    """ Count a write to the rows of `model`, which drops the rows of that model cached by prefetch_related(). """
+    _writes[model] += 1
+
+
+def get_prefetched(instance, name):
+    """ The related rows of `instance` cached by prefetch_related(), or None once rows of their model were written. """
+    cached = instance.__dict__.get('_prefetched_objects_cache', {}).get(name)
+
+    if isinstance(cached, django_mock_queries.query.PrefetchedMockSet) and cached.written != _writes[cached.model]:
+        # Other queries of the instance would read the rows written since
+        forget_prefetched(instance, name)
+        return None
+
+    return cached
+
+
+def forget_prefetched(instance, name):
+    return instance.__dict__.get('_prefetched_objects_cache', {}).pop(name, None)
+
+
+def _prefetched_set(rows, related_objects):
+    prefetched = django_mock_queries.query.PrefetchedMockSet(clone=related_objects)
+    prefetched.items.extend(rows)
+    prefetched.written = _writes[prefetched.model]
+    # Like a QuerySet with a filled result cache, it doesn't query again
+    prefetched._fetched = True
+
+    return prefetched
+
+
+def _cache_related_rows(instance, name, positions, to_attr):
+    cached = get_prefetched(instance, name)
+    if cached is not None and positions is None and to_attr is None:
+        return list(cached)
+
+    # Bypass a previous prefetch of the same relation
+    forget_prefetched(instance, name)
+    related_objects = getattr(instance, name)
+    rows = list(related_objects.all())
+
+    if positions is not None:
+        rows = sorted([row for row in rows if id(row) in positions], key=lambda row: positions[id(row)])
+
+    if to_attr is not None:
+        setattr(instance, to_attr, rows)
+
+    if to_attr is None or cached is not None:
+        cache = instance.__dict__.setdefault('_prefetched_objects_cache', {})
+        cache[name] = cached if to_attr is not None else _prefetched_set(rows, related_objects)
+
+    return rows
+
+
+def _cache_related_object(instance, field, name, positions, to_attr, lookup_table):
+    key = getattr(instance, field.attname) if field.concrete else None
+
+    if field.concrete and positions is None and field.is_cached(instance):
+        row = field.get_cached_value(instance)
+    elif field.concrete and key is None:
+        row = None
+    elif field.concrete and lookup_table is not None and key in lookup_table:
+        row = lookup_table[key]
+    else:
+        try:
+            row = getattr(instance, name)
+        except ObjectDoesNotExist:
+            row = None
+
+    if positions is not None and id(row) not in positions:
+        row = None
+
+    if to_attr is not None:
+        setattr(instance, to_attr, row)
+    else:
+        field.set_cached_value(instance, row)
+
+    return [row] if row is not None else []
+
+
+def prefetch_one_level(instances, name, method, queryset=None, to_attr=None):
+    """ Cache the relation `name` on all `instances` and return the related rows.
+
+    Lookup tables are built once for all instances: the position of each row
+    of the optional queryset, which restricts and orders the related rows, and
+    a primary key map of the related table for single related objects.
+    """
+    relations = {}
+    lookup_tables = {}
+    related = {}
+    positions = {id(row): i for i, row in enumerate(queryset)} if queryset is not None else None
+
+    for instance in instances:
+        model = type(instance)
+        if model not in relations:
+            relations[model] = find_relation(model, name, method)
+
+            if method == 'prefetch_related':
+                # Like Django, each level of a prefetch is one query for all instances
+                record_query('{}.{}'.format(model.__name__, name), 'prefetch', internal=True)
+        field = relations[model]
+
+        if method == 'select_related' and (field.one_to_many or field.many_to_many):
+            raise FieldError(
+                "Invalid field name '{}' given in select_related(), it is not a single related object.".format(name)
+            )
+        elif field.one_to_many or field.many_to_many:
+            rows = _cache_related_rows(instance, name, positions, to_attr)
+        else:
+            if field.concrete and field not in lookup_tables:
+                table = queryset if queryset is not None else getattr(field.related_model, 'objects', None)
+                lookup_tables[field] = {
+                    getattr(row, field.target_field.attname): row for row in table
+                } if isinstance(table, django_mock_queries.query.MockSet) else None
+
+            rows = _cache_related_object(instance, field, name, positions, to_attr, lookup_tables.get(field))
+
+        related.update((id(row), row) for row in rows)
+
+    return list(related.values())
+
+
+def prefetch_related_objects(instances, *lookups):
+    """ Load every relation in `lookups` for all `instances` at once, and cache it on each instance. """
+    for lookup in lookups:
+        if not isinstance(lookup, DjangoPrefetch):
+            lookup = DjangoPrefetch(lookup)
+
+        level = list(instances)
+        parts = lookup.prefetch_through.split('__')
+
+        for i, name in enumerate(parts):
+            is_last = i == len(parts) - 1
+            level = prefetch_one_level(
+                level, name, 'prefetch_related',
+                queryset=lookup.queryset if is_last else None,
+                to_attr=lookup.to_attr if is_last else None,
+            )
+
+
+def select_related_objects(instances, *fields):
+    """ Cache the single related objects of `fields` on all `instances`, or every non-null one without fields. """
+    if not fields and instances:
+        meta = type(instances[0])._meta
+        fields = [f.name for f in meta.concrete_fields if f.is_relation and not f.null]
+
+    for lookup in fields:
+        level = list(instances)
+
+        for name in lookup.split('__'):
+            level = prefetch_one_level(level, name, 'select_related')
+
+
 def get_nested_attr(obj, attr_path, default=None):
     attrs = attr_path.split('.')
     try:
@@ -42,6 +42,25 @@ class Passenger(models.Model):
     name = models.CharField(max_length=25)
 
 
+class Driver(models.Model):
+    name = models.CharField(max_length=25)
+
+
+class Team(models.Model):
+    name = models.CharField(max_length=25)
+    drivers = models.ManyToManyField(Driver, related_name='teams')
+
+
+class Track(models.Model):
+    country = models.CharField(max_length=2)
+    name = models.CharField(max_length=25)
+    length = models.IntegerField(null=True)
+
+    class Meta:
+        unique_together = ('country', 'name')
+        constraints = [models.UniqueConstraint(fields=['name', 'length'], name='unique_track_layout')]
+
+
 class CarSerializer(serializers.ModelSerializer):
     make = ManufacturerSerializer()
     speed = serializers.SerializerMethodField()
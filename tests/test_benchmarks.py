@@ -0,0 +1,17 @@
+from unittest import TestCase
+
+from benchmarks.mockset import CASES, compare, run
+
+
+class BenchmarksTest(TestCase):
+    def test_every_case_runs(self):
+        results = run(sizes=[20], repeat=1)
+
+        assert set(results) == {'{}[20]'.format(name) for name in CASES}
+        assert all(seconds >= 0 for seconds in results.values())
+
+    def test_compare_reports_slower_cases(self):
+        results = {'filter[gt][1000]': 0.4, 'exclude[1000]': 0.1, 'order_by[1000]': 0.1}
+        baseline = {'filter[gt][1000]': 0.2, 'exclude[1000]': 0.1}
+
+        assert compare(results, baseline, threshold=1.25) == {'filter[gt][1000]': 2.0}
@@ -0,0 +1,70 @@
+from unittest import TestCase
+
+from django.db.models import Q, Sum
+
+from django_mock_queries.cache import ResultCache
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car
+
+
+class ResultCacheTest(TestCase):
+    def setUp(self):
+        self.cache = ResultCache(maxsize=4)
+        self.cars = MockSet(*[Car(id=i, speed=i % 4) for i in range(12)], model=Car, cache=self.cache)
+
+    def test_repeated_reads_are_served_from_the_cache(self):
+        fast = self.cars.filter(speed__gte=2)
+
+        assert list(self.cars.filter(speed__gte=2)) == list(fast)
+        assert list(self.cars.filter(Q(speed__gte=2))) == list(fast)
+        assert list(self.cars.exclude(speed=0)) == list(self.cars.exclude(speed=0))
+        assert list(self.cars.values_list('id', flat=True)) == list(self.cars.values_list('id', flat=True))
+        assert self.cache.hits == 3
+
+    def test_every_read_gets_its_own_set(self):
+        fast = self.cars.filter(speed__gte=2)
+        list(fast)
+        again = self.cars.filter(speed__gte=2).order_by('-id')
+
+        assert again is not fast and again.clone is not fast
+        assert not self.cars.filter(speed__gte=2)._fetched
+        assert fast.explain().count('--') == 1
+        assert again.explain().count('--') == 2
+        assert list(self.cars.filter(speed__gte=2)) == list(fast)
+
+    def test_writes_start_a_new_version(self):
+        total = self.cars.aggregate(Sum('speed'))
+        total['speed__sum'] = 0
+        assert self.cars.aggregate(Sum('speed')) == {'speed__sum': 18}
+
+        self.cars.create(id=12, speed=3)
+        assert self.cars.aggregate(Sum('speed')) == {'speed__sum': 21}
+
+        self.cars.filter(id=12).update(speed=1)
+        assert self.cars.aggregate(Sum('speed')) == {'speed__sum': 19}
+
+        self.cars.filter(speed=1).delete()
+        assert self.cars.aggregate(Sum('speed')) == {'speed__sum': 15}
+        assert self.cache.hits == 1
+
+    def test_writes_to_cached_results_start_a_new_version(self):
+        slow = self.cars.filter(speed=0)
+        slow.add(Car(id=13, speed=0))
+
+        assert self.cars.filter(speed=0) is not slow
+        assert self.cars.filter(speed=0).count() == 3
+
+    def test_lookups_on_other_sets_are_not_cached(self):
+        others = MockSet(*[Car(id=i) for i in range(3)], model=Car)
+
+        assert self.cars.filter(id__in=others).count() == 3
+        others.add(Car(id=3))
+        assert self.cars.filter(id__in=others).count() == 4
+        assert self.cache.results == {}
+
+    def test_least_recently_used_results_are_evicted(self):
+        for speed in range(5):
+            self.cars.filter(speed=speed)
+
+        assert len(self.cache.results) == 4
+        assert [key[3] for key in self.cache.results] == [(('speed', speed),) for speed in range(1, 5)]
@@ -0,0 +1,241 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from django.db.models import Prefetch
+
+from django_mock_queries.database import ForeignKeyIndex, MockDatabase, MockTable
+from django_mock_queries.mocks import mocked_relations
+from django_mock_queries.utils import get_attribute
+from tests.mock_models import Car, CarVariation, Driver, Manufacturer, Passenger, Team
+
+
+class MockDatabaseTest(TestCase):
+    def setUp(self):
+        self.database = MockDatabase()
+        patcher = mocked_relations(
+            Manufacturer, Car, CarVariation, Passenger, Driver, Team, database=self.database
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_objects_are_backed_by_tables(self):
+        assert isinstance(Car.objects, MockTable)
+        assert Car.objects is self.database.table(Car)
+
+    def test_create_assigns_primary_keys(self):
+        make_1 = Manufacturer.objects.create(name='vw')
+        make_2 = Manufacturer(name='bmw')
+        make_2.save()
+
+        assert (make_1.pk, make_2.pk) == (1, 2)
+        assert list(Manufacturer.objects.all()) == [make_1, make_2]
+
+    def test_create_stores_related_instances(self):
+        make = Manufacturer(name='vw')
+        car = Car.objects.create(make=make, speed=1)
+
+        assert make.pk is not None
+        assert car.make_id == make.pk
+        assert list(Manufacturer.objects.all()) == [make]
+
+    def test_reverse_relation_and_objects_share_rows(self):
+        make = Manufacturer.objects.create(name='vw')
+        car_1 = make.car_set.create(speed=1)
+        car_2 = Car.objects.create(make=make, speed=2)
+        Car.objects.create(make=Manufacturer.objects.create(name='bmw'), speed=3)
+
+        assert list(make.car_set.all()) == [car_1, car_2]
+        assert list(Car.objects.filter(make=make)) == [car_1, car_2]
+        assert car_1.make is make
+
+    def test_reverse_relation_add_sets_foreign_key(self):
+        make = Manufacturer.objects.create(name='vw')
+        car = Car(speed=1)
+
+        make.car_set.add(car)
+
+        assert car.make is make
+        assert list(Car.objects.all()) == [car]
+
+    def test_reverse_relation_requires_primary_key(self):
+        with self.assertRaises(ValueError):
+            Manufacturer().car_set.all()
+
+    def test_reverse_relation_follows_reassigned_foreign_key(self):
+        vw = Manufacturer.objects.create(name='vw')
+        bmw = Manufacturer.objects.create(name='bmw')
+        car = Car.objects.create(make=vw, speed=1)
+
+        car.make = bmw
+
+        assert list(vw.car_set.all()) == []
+        assert list(bmw.car_set.all()) == [car]
+
+    def test_forward_relation_is_resolved_from_table(self):
+        make = Manufacturer.objects.create(name='vw')
+        car = Car(make_id=make.pk, speed=1)
+
+        assert car.make is make
+
+    def test_delete_removes_rows_from_indexes(self):
+        make = Manufacturer.objects.create(name='vw')
+        car_1 = make.car_set.create(speed=1)
+        car_2 = make.car_set.create(speed=2)
+
+        car_1.delete()
+        make.car_set.filter(speed=2).delete()
+
+        assert list(make.car_set.all()) == []
+        assert car_2 not in Car.objects.all()
+
+    def test_filter_uses_indexes(self):
+        vw = Manufacturer.objects.create(name='vw')
+        bmw = Manufacturer.objects.create(name='bmw')
+        cars = [Car.objects.create(make=vw if i % 2 else bmw, speed=i) for i in range(10)]
+
+        with patch('django_mock_queries.utils.get_attribute', wraps=get_attribute) as get_attribute_mock:
+            by_pk = Car.objects.get(pk=cars[3].pk)
+
+        by_join = Car.objects.filter(make__name='vw', speed__gt=4)
+        by_in = Car.objects.filter(make__in=[bmw])
+
+        # Only the row found in the primary key index is checked
+        assert get_attribute_mock.call_count == 1
+        assert by_pk is cars[3]
+        assert list(by_join) == [cars[5], cars[7], cars[9]]
+        assert list(by_in) == cars[::2]
+
+    def test_explain_shows_index_lookups(self):
+        make = Manufacturer.objects.create(name='vw')
+        for speed in range(4):
+            Car.objects.create(make=make if speed % 2 else Manufacturer.objects.create(name='bmw'), speed=speed)
+
+        assert Car.objects.filter(make=make, speed__gt=1).explain().splitlines()[1] == (
+            '  --filter(make=<Manufacturer: Manufacturer object (1)>, speed__gt=1) '
+            'using index lookup on make: 2 rows scanned, 1 returned, selectivity 0.50'
+        )
+
+    def test_index_candidates_are_checked_against_all_lookups(self):
+        make = Manufacturer.objects.create(name='vw')
+        car = Car.objects.create(make=make, speed=1)
+
+        assert list(Car.objects.filter(make=make, speed=2)) == []
+        assert list(Car.objects.filter(pk=car.pk, speed=1)) == [car]
+
+    def test_many_to_many_is_shared_by_both_sides(self):
+        team = Team.objects.create(name='red')
+        driver_1 = Driver.objects.create(name='ann')
+        driver_2 = team.drivers.create(name='bob')
+
+        team.drivers.add(driver_1, driver_1)
+
+        assert list(team.drivers.all()) == [driver_2, driver_1]
+        assert list(driver_1.teams.all()) == [team]
+        assert len(self.database.through(Team.drivers.field).rows) == 2
+
+    def test_many_to_many_remove_set_and_clear(self):
+        red, blue = Team.objects.create(name='red'), Team.objects.create(name='blue')
+        ann, bob, cid = [Driver.objects.create(name=name) for name in ('ann', 'bob', 'cid')]
+        red.drivers.add(ann, bob)
+        blue.drivers.add(bob)
+
+        ann.teams.remove(red)
+        assert list(red.drivers.all()) == [bob]
+
+        red.drivers.set([cid.pk, bob])
+        assert list(red.drivers.all()) == [bob, cid]
+
+        red.drivers.clear()
+        assert list(red.drivers.all()) == []
+        assert list(bob.teams.all()) == [blue]
+
+    def test_many_to_many_requires_primary_key(self):
+        with self.assertRaises(ValueError):
+            Team().drivers.all()
+
+    def test_many_to_many_filter_uses_through_table(self):
+        red, blue = Team.objects.create(name='red'), Team.objects.create(name='blue')
+        ann, bob = Driver.objects.create(name='ann'), Driver.objects.create(name='bob')
+        red.drivers.add(ann, bob)
+        blue.drivers.add(bob)
+
+        assert list(Driver.objects.filter(teams__name='blue')) == [bob]
+        assert list(Driver.objects.filter(teams=red)) == [ann, bob]
+        assert list(Team.objects.filter(drivers__in=[ann])) == [red]
+        assert list(Team.objects.filter(drivers__name='bob', name='blue')) == [blue]
+
+    def test_deleted_rows_are_unlinked(self):
+        team = Team.objects.create(name='red')
+        driver = team.drivers.create(name='ann')
+
+        driver.delete()
+
+        assert list(team.drivers.all()) == []
+        assert self.database.through(Team.drivers.field).rows == {}
+
+    def test_prefetch_related_caches_related_rows(self):
+        vw, bmw = Manufacturer.objects.create(name='vw'), Manufacturer.objects.create(name='bmw')
+        golf = vw.car_set.create(speed=1)
+        golf.variations.create(color='red')
+        bmw.car_set.create(speed=2)
+
+        makes = list(Manufacturer.objects.all().prefetch_related('car_set__variations'))
+
+        with patch.object(ForeignKeyIndex, 'lookup', wraps=ForeignKeyIndex.lookup) as lookup_mock:
+            colors = [v.color for make in makes for car in make.car_set.all() for v in car.variations.all()]
+
+        assert lookup_mock.call_count == 0
+        assert colors == ['red']
+        assert list(vw._prefetched_objects_cache['car_set']) == [golf]
+
+    def test_prefetch_object_restricts_and_orders_rows(self):
+        make = Manufacturer.objects.create(name='vw')
+        cars = [make.car_set.create(speed=speed) for speed in (1, 3, 2)]
+
+        list(Manufacturer.objects.prefetch_related(
+            Prefetch('car_set', queryset=Car.objects.filter(speed__gt=1).order_by('-speed'), to_attr='fast_cars')
+        ))
+
+        assert make.fast_cars == [cars[1], cars[2]]
+        assert list(make.car_set.all()) == cars
+
+    def test_prefetch_related_many_to_many(self):
+        team = Team.objects.create(name='red')
+        driver = team.drivers.create(name='ann')
+
+        list(Team.objects.prefetch_related('drivers'))
+        Driver.objects.prefetch_related('teams').get(pk=driver.pk)
+
+        assert list(team._prefetched_objects_cache['drivers']) == [driver]
+        assert list(driver.teams.all()) == [team]
+
+    def test_prefetch_related_reads_rows_when_evaluated(self):
+        make = Manufacturer.objects.create(name='vw')
+        makes = Manufacturer.objects.prefetch_related('car_set')
+        Car.objects.create(make=make, speed=1)
+
+        assert [make.car_set.count() for make in makes] == [1]
+
+        Car.objects.create(make=make, speed=2)
+
+        assert Manufacturer.objects.get(pk=make.pk).car_set.count() == 2
+        assert Car.objects.filter(make=make).count() == 2
+
+    def test_changing_relation_drops_prefetched_rows(self):
+        make = Manufacturer.objects.create(name='vw')
+        list(Manufacturer.objects.prefetch_related('car_set'))
+
+        car = make.car_set.create(speed=1)
+
+        assert 'car_set' not in make._prefetched_objects_cache
+        assert list(make.car_set.all()) == [car]
+
+    def test_select_related_caches_foreign_keys(self):
+        make = Manufacturer.objects.create(name='vw')
+        car = Car.objects.create(make=make, speed=1)
+        Car.make.field.delete_cached_value(car)
+
+        Car.objects.select_related('make')
+
+        assert Car.make.field.is_cached(car)
+        assert car.make is make
@@ -0,0 +1,104 @@
+from unittest import TestCase
+
+from django.db import transaction
+from django.db.models import Count, F, Max, Q, Sum
+from django.db.utils import NotSupportedError
+
+from django_mock_queries.engine import QueryEngine
+from django_mock_queries.instrumentation import QueryRecorder
+from tests.mock_models import Car, Driver, Manufacturer, Team
+
+
+class QueryEngineTest(TestCase):
+    def setUp(self):
+        self.vw, self.bmw = Manufacturer(name='vw'), Manufacturer(name='bmw')
+        self.engine = QueryEngine({
+            Manufacturer: [self.vw, self.bmw],
+            Car: [Car(make=self.vw, speed=1), Car(make=self.bmw, speed=3), Car(make=self.vw, speed=2)],
+        })
+        self.engine.__enter__()
+        self.addCleanup(self.engine.__exit__, None, None, None)
+
+    def test_register_assigns_primary_keys_and_copies_rows(self):
+        car = Car.objects.get(speed=3)
+
+        assert (self.vw.pk, self.bmw.pk) == (1, 2)
+        assert car.make_id == self.bmw.pk
+        assert all(row is not car for row in self.engine.table(Car).items)
+
+    def test_filter_order_and_slice(self):
+        speeds = Car.objects.filter(make__name='vw').order_by('-speed').values_list('speed', flat=True)
+
+        assert list(speeds) == [2, 1]
+        assert list(Car.objects.order_by('speed').values_list('speed', flat=True)[1:]) == [2, 3]
+        assert Car.objects.filter(Q(speed=1) | Q(make__name='bmw')).count() == 2
+        assert Car.objects.exclude(speed=1).count() == 2
+
+    def test_exists_count_and_aggregate(self):
+        assert Car.objects.count() == 3
+        assert Car.objects.filter(speed__gt=2).exists()
+        assert not Car.objects.filter(speed__gt=3).exists()
+        assert Car.objects.aggregate(Sum('speed'), Max('speed')) == {'speed__sum': 6, 'speed__max': 3}
+        assert Car.objects.order_by('speed')[:2].aggregate(total=Count('id')) == {'total': 2}
+
+    def test_reverse_joins_and_subqueries(self):
+        makes = Manufacturer.objects.filter(car__speed__gte=2).distinct().values_list('name', flat=True)
+        vw_cars = Car.objects.filter(make__in=Manufacturer.objects.filter(name='vw'))
+
+        assert list(makes) == ['vw', 'bmw']
+        assert vw_cars.count() == 2
+        assert list(Manufacturer.objects.filter(car__isnull=True)) == []
+
+    def test_related_objects(self):
+        car = Car.objects.select_related('make').get(speed=3)
+        makes = Manufacturer.objects.prefetch_related('car_set').order_by('name')
+
+        assert car.make.name == 'bmw'
+        assert [(make.name, [c.speed for c in make.car_set.all()]) for make in makes] == [('bmw', [3]), ('vw', [1, 2])]
+
+    def test_create_update_and_delete(self):
+        audi = Manufacturer.objects.create(name='audi')
+        audi.name = 'audi 2'
+        audi.save()
+
+        assert audi.pk == 3
+        assert Manufacturer.objects.get(pk=3).name == 'audi 2'
+        assert Car.objects.filter(make__name='vw').update(speed=F('speed') + 10) == 2
+        assert list(Car.objects.order_by('pk').values_list('speed', flat=True)) == [11, 3, 12]
+        assert Manufacturer.objects.filter(name='vw').delete() == (3, {'tests.Car': 2, 'tests.Manufacturer': 1})
+        assert Car.objects.count() == 1
+
+    def test_updates_and_deletes_are_rolled_back(self):
+        with transaction.atomic():
+            Car.objects.filter(make__name='vw').update(speed=F('speed') + 10)
+            Car.objects.filter(speed__gt=10).delete()
+            transaction.set_rollback(True)
+
+        assert list(Car.objects.order_by('pk').values_list('speed', flat=True)) == [1, 3, 2]
+
+    def test_primary_keys_follow_the_largest_one_stored(self):
+        self.engine.register(Car, Car(id=10, make=self.vw, speed=4))
+        self.engine.table(Car).add(Car(id=20, make_id=self.vw.pk, speed=5))
+
+        assert Car.objects.create(make=self.vw, speed=6).pk == 21
+        assert [car.pk for car in Car.objects.bulk_create([Car(make=self.vw), Car(make=self.vw)])] == [22, 23]
+
+    def test_many_to_many(self):
+        team = Team.objects.create(name='red')
+        driver = Driver.objects.create(name='ann')
+
+        team.drivers.add(driver)
+
+        assert list(driver.teams.all()) == [team]
+        assert Team.objects.filter(drivers__name='ann').count() == 1
+
+    def test_queries_are_recorded(self):
+        with QueryRecorder() as recorder:
+            list(Car.objects.all())
+            Car.objects.filter(speed=1).update(speed=2)
+
+        assert [(q.label, q.operation) for q in recorder.queries] == [('Car', 'select'), ('Car', 'update')]
+
+    def test_unsupported_query_raises(self):
+        with self.assertRaises(NotSupportedError):
+            list(Manufacturer.objects.annotate(cars=Count('car')))
@@ -0,0 +1,92 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+from unittest.mock import patch
+
+from django.db.models.signals import post_init
+
+from django_mock_queries.fixtures import RowBuilder, read_fixture
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car, Manufacturer, Team, Track
+
+
+class FixtureTest(TestCase):
+    def setUp(self):
+        directory = TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as stream:
+            stream.write(content)
+        return path
+
+    def test_rows_are_built_without_model_init(self):
+        vw = Manufacturer(id=1, name='vw')
+        handler = patch.object(post_init, 'send').start()
+        self.addCleanup(patch.stopall)
+
+        cars = MockSet.from_records([
+            {'id': 1, 'make': vw, 'speed': 100},
+            {'id': 2, 'make_id': 2, 'model': 'golf', 'speed': 50, 'colour': 'red'},
+        ], model=Car)
+
+        handler.assert_not_called()
+        assert [(car.id, car.make_id, car.model, car.speed) for car in cars] == [(1, 1, '', 100), (2, 2, 'golf', 50)]
+        assert cars[0].make is vw
+        assert cars[1].colour == 'red'
+        assert not cars[0]._state.adding
+        assert cars.filter(speed__gt=60).get().id == 1
+
+    def test_values_are_coerced_by_their_field(self):
+        builder = RowBuilder(Track, coerce=True)
+        track = builder.build({'id': '3', 'country': 'it', 'name': '', 'length': ''})
+
+        assert (track.id, track.name, track.length) == (3, '', None)
+
+    def test_records_without_model_are_mock_models(self):
+        rows = MockSet.from_records([{'id': 1, 'name': 'a'}, {'id': 2, 'name': 'b'}])
+
+        assert rows.get(name='b').id == 2
+
+    def test_from_fixture(self):
+        path = self.write('fixture.json', json.dumps([
+            {'model': 'tests.manufacturer', 'pk': 1, 'fields': {'name': 'vw'}},
+            {'model': 'tests.car', 'pk': 1, 'fields': {'make': 1, 'model': 'golf', 'speed': '100'}},
+            {'model': 'tests.car', 'pk': 2, 'fields': {'make': 1, 'model': None, 'speed': 50}},
+            {'model': 'tests.team', 'pk': 1, 'fields': {'drivers': [1, 2]}},
+        ], indent=2))
+
+        with patch('django_mock_queries.fixtures.FIXTURE_CHUNK_SIZE', 16):
+            cars = MockSet.from_fixture(path, model=Car)
+            makes = MockSet.from_fixture(path)
+            teams = MockSet.from_fixture(path, model=Team)
+
+        assert [(car.pk, car.make_id, car.speed) for car in cars] == [(1, 1, 100), (2, 1, 50)]
+        assert (makes.model, makes.get().name) == (Manufacturer, 'vw')
+        assert 'drivers' not in vars(teams.get())
+
+    def test_json_lines_fixture(self):
+        path = self.write('fixture.jsonl', '\n'.join(json.dumps(
+            {'model': 'tests.track', 'pk': i, 'fields': {'country': 'it', 'name': str(i), 'length': None}}
+        ) for i in range(3)) + '\n')
+
+        assert [track.name for track in MockSet.from_fixture(path)] == ['0', '1', '2']
+        assert len(list(read_fixture(path))) == 3
+
+    def test_broken_fixture_raises(self):
+        path = self.write('fixture.json', '[{"model": "tests.car", "pk": 1,')
+
+        with self.assertRaises(json.JSONDecodeError):
+            MockSet.from_fixture(path)
+
+    def test_from_csv(self):
+        path = self.write('tracks.csv', 'id;country;name;length\n1;it;Monza;5793\n2;it;Imola;\n')
+
+        tracks = MockSet.from_csv(path, model=Track, delimiter=';', constraints=True)
+
+        assert [(track.id, track.length) for track in tracks] == [(1, 5793), (2, None)]
+        assert tracks.get(country='it', name='Imola').id == 2
+        assert MockSet.from_csv(path, delimiter=';', coerce=False)[0].length == '5793'
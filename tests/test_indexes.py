@@ -0,0 +1,162 @@
+from unittest import TestCase
+
+from django.db import IntegrityError
+
+from django_mock_queries.indexes import AutoIndex, CompositeIndex
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car, Manufacturer, Track
+
+
+class AutoIndexTest(TestCase):
+    def setUp(self):
+        self.rows = [Car(id=i, speed=i % 5, model='model {}'.format(i % 3)) for i in range(20)]
+        self.cars = MockSet(*self.rows, model=Car, auto_index=AutoIndex(after=2))
+        self.scans = MockSet(*self.rows, model=Car)
+
+    def test_index_is_built_after_repeated_scans(self):
+        self.cars.filter(speed=1)
+        assert self.cars._auto_index.indexes == {}
+
+        self.cars.filter(speed=2)
+        assert list(self.cars._auto_index.indexes) == [('speed', 'hash')]
+        assert 'auto index on speed' in self.cars.filter(speed=3).explain()
+
+    def test_indexed_lookups_match_full_scans(self):
+        lookups = [
+            {'speed': 3},
+            {'speed__in': [1, 4]},
+            {'speed__gt': 2},
+            {'speed__lte': 1, 'model': 'model 1'},
+            {'speed__range': (1, 3)},
+        ]
+
+        for _ in range(3):
+            for lookup in lookups:
+                assert list(self.cars.filter(**lookup)) == list(self.scans.filter(**lookup)), lookup
+
+        assert set(self.cars._auto_index.indexes) == {('speed', 'hash'), ('speed', 'sorted'), ('model', 'hash')}
+
+    def test_indexes_follow_writes(self):
+        for _ in range(2):
+            self.cars.filter(speed=1)
+
+        new_car = Car(id=20, speed=1)
+        self.cars.add(new_car)
+        self.cars.filter(id=3).update(speed=1)
+        self.cars.filter(id=1).delete()
+
+        assert [car.id for car in self.cars.filter(speed=1)] == [3, 6, 11, 16, 20]
+
+    def test_attributes_set_directly_are_seen_once_the_row_is_updated(self):
+        for _ in range(2):
+            self.cars.filter(speed=1)
+
+        self.rows[3].speed = 1
+        assert [car.id for car in self.cars.filter(speed=3)] == [8, 13, 18]
+        assert [car.id for car in self.cars.filter(speed=1)] == [1, 6, 11, 16]
+
+        self.cars.fire(self.rows[3], MockSet.EVENT_UPDATED)
+        assert [car.id for car in self.cars.filter(speed=1)] == [1, 3, 6, 11, 16]
+
+    def test_index_is_dropped_when_writes_dominate(self):
+        for _ in range(2):
+            self.cars.filter(speed=1)
+
+        for car in self.rows[:10]:
+            self.cars.filter(id=car.id).update(speed=4)
+
+        assert ('speed', 'hash') not in self.cars._auto_index.indexes
+        assert [car.id for car in self.cars.filter(speed=4)] == list(range(10)) + [14, 19]
+
+    def test_least_used_index_is_evicted(self):
+        self.cars._auto_index.max_entries = 30
+
+        for _ in range(3):
+            self.cars.filter(speed=1)
+        for _ in range(2):
+            self.cars.filter(model='model 1')
+
+        assert list(self.cars._auto_index.indexes) == [('model', 'hash')]
+
+
+class CompositeIndexTest(TestCase):
+    def setUp(self):
+        self.tracks = MockSet(
+            Track(id=1, country='it', name='Monza', length=5793),
+            Track(id=2, country='be', name='Spa', length=7004),
+            Track(id=3, country='it', name='Imola', length=None),
+            model=Track, constraints=True
+        )
+
+    def test_indexes_are_derived_from_unique_together_and_constraints(self):
+        indexes = self.tracks._composite_indexes.indexes
+
+        assert [(index.name, index.fields, index.unique) for index in indexes] == [
+            ('country_name', ('country', 'name'), True),
+            ('unique_track_layout', ('name', 'length'), True),
+        ]
+
+    def test_lookups_on_all_fields_use_the_index(self):
+        assert self.tracks.get(country='it', name__exact='Imola').id == 3
+        assert list(self.tracks.filter(name='Spa', country='it')) == []
+        assert 'composite index country_name' in self.tracks.filter(country='it', name='Monza').explain()
+        assert 'full scan' in self.tracks.filter(country='it').explain()
+
+    def test_duplicate_keys_raise_integrity_error(self):
+        with self.assertRaises(IntegrityError):
+            self.tracks.create(id=4, country='it', name='Monza')
+        with self.assertRaises(IntegrityError):
+            self.tracks.add(Track(id=4, country='fr', name='Spa', length=7004))
+        with self.assertRaises(IntegrityError):
+            self.tracks.bulk_create([Track(id=4, country='fr', name='Magny'), Track(id=5, country='fr', name='Magny')])
+
+        assert self.tracks.count() == 3
+
+    def test_updates_to_duplicate_keys_raise_integrity_error(self):
+        with self.assertRaises(IntegrityError):
+            self.tracks.filter(id=3).update(name='Monza')
+        with self.assertRaises(IntegrityError):
+            self.tracks.update_or_create(id=2, defaults={'country': 'it', 'name': 'Imola'})
+        with self.assertRaises(IntegrityError):
+            self.tracks.filter(country='it').update(country='be', name='Spa')
+
+        assert [track.name for track in self.tracks.filter(country='it')] == ['Monza', 'Imola']
+
+        self.tracks.filter(id=1).update(name='Monza', length=5793)
+        self.tracks.filter(country='it').update(country='fr')
+        assert self.tracks.get(country='fr', name='Imola').id == 3
+
+    def test_null_keys_never_conflict(self):
+        self.tracks.add(Track(id=4, country='jp', name='Imola', length=None))
+
+        assert self.tracks.count() == 4
+
+    def test_get_or_create_and_bulk_create_ignoring_conflicts(self):
+        track, created = self.tracks.get_or_create(country='be', name='Spa', defaults={'length': 1})
+        assert (track.id, created) == (2, False)
+
+        created = self.tracks.bulk_create(
+            [Track(id=4, country='it', name='Monza'), Track(id=5, country='fr', name='Magny')], ignore_conflicts=True
+        )
+        assert len(created) == 2
+        assert [track.id for track in self.tracks] == [1, 2, 3, 5]
+
+    def test_index_follows_updates_and_deletes(self):
+        self.tracks.filter(id=1).update(name='Mugello')
+        self.tracks.filter(id=2).delete()
+
+        assert self.tracks.get(country='it', name='Mugello').id == 1
+        assert not self.tracks.filter(country='it', name='Monza').exists()
+        self.tracks.create(id=6, country='be', name='Spa')
+
+    def test_manual_index_on_a_relation(self):
+        vw, bmw = Manufacturer(id=1, name='vw'), Manufacturer(id=2, name='bmw')
+        cars = MockSet(
+            Car(id=1, make=vw, model='golf'), Car(id=2, make=bmw, model='golf'),
+            model=Car, indexes=[CompositeIndex('make', 'model', unique=True)]
+        )
+
+        assert cars.get(make=bmw, model='golf').id == 2
+        assert cars.get(make_id=1, model='golf').id == 1
+        with self.assertRaises(IntegrityError):
+            cars.create(make=vw, model='golf')
@@ -0,0 +1,231 @@
+from unittest import TestCase
+from unittest.mock import patch
+
+from django_mock_queries.database import MockDatabase
+from django_mock_queries.exceptions import NPlusOneQueries, TooManyQueries
+from django_mock_queries.instrumentation import QueryRecorder, assert_max_queries, detect_n_plus_one, simulate_latency
+from django_mock_queries.mocks import mocked_relations
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car, Manufacturer
+
+
+class QueryRecorderTest(TestCase):
+    def test_records_queries_with_label_and_call_site(self):
+        with mocked_relations(Car):
+            Car.objects.add(Car(speed=1), Car(speed=2))
+
+            with QueryRecorder() as recorder:
+                cars = list(Car.objects.filter(speed__gt=1))
+                Car.objects.count()
+
+        assert len(cars) == 1
+        assert [(q.label, q.operation) for q in recorder.queries] == [
+            ('Car.objects', 'iterate'),
+            ('Car.objects', 'count'),
+        ]
+        assert recorder.queries[0].call_site.filename == __file__
+        assert recorder.queries[0].call_site.function == 'test_records_queries_with_label_and_call_site'
+
+    def test_queries_made_by_other_queries_are_not_recorded(self):
+        with mocked_relations(Manufacturer):
+            make = Manufacturer()
+            make.car_set = MockSet(Car(speed=1))
+            makes = MockSet(make, model=Manufacturer)
+
+            with QueryRecorder() as recorder:
+                makes.get(car__speed=1)
+
+        assert [q.operation for q in recorder.queries] == ['get']
+
+    def test_nothing_is_recorded_without_recorder(self):
+        recorder = QueryRecorder()
+        MockSet(1, 2).count()
+
+        assert recorder.queries == []
+
+
+class QueryBudgetTest(TestCase):
+    def setUp(self):
+        patcher = mocked_relations(Manufacturer, Car)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        Car.objects.add(Car(speed=1), Car(speed=2))
+
+    def test_evaluated_sets_answer_from_result_cache(self):
+        with assert_max_queries(1) as budget:
+            cars = Car.objects.filter(speed__gt=0)
+            list(cars)
+            len(cars)
+            cars.count()
+            cars.exists()
+            cars.first()
+            cars[1]
+
+        assert [q.operation for q in budget.queries] == ['iterate']
+
+    def test_all_of_a_manager_is_evaluated_once(self):
+        with assert_max_queries(1) as budget:
+            list(Manufacturer.objects.all())
+
+        with assert_max_queries(1):
+            cars = Car.objects.all().only('speed')
+            list(cars)
+            cars.count()
+            bool(cars)
+
+        assert [q.operation for q in budget.queries] == ['iterate']
+        assert Car.objects.all() is not Car.objects.all()
+
+    def test_managers_and_chained_sets_query_again(self):
+        with assert_max_queries(5) as budget:
+            Car.objects.count()
+            Car.objects.count()
+            cars = Car.objects.filter(speed=1)
+            list(cars)
+            list(cars.filter(speed=1))
+            cars.get(speed=1)
+
+        assert [q.operation for q in budget.queries] == ['count', 'count', 'iterate', 'iterate', 'get']
+
+    def test_writes_are_queries(self):
+        with assert_max_queries(5) as budget:
+            Car.objects.create(speed=3)
+            Car.objects.filter(speed=3).update(speed=4)
+            Car.objects.filter(speed=4).delete()
+            Car.objects.get_or_create(speed=5)
+
+        assert [q.operation for q in budget.queries] == ['create', 'update', 'delete', 'get', 'create']
+
+    def test_too_many_queries_fails(self):
+        with self.assertRaises(TooManyQueries) as error:
+            with assert_max_queries(1):
+                Car.objects.count()
+                Car.objects.exists()
+
+        assert '2 queries executed, at most 1 expected.' in str(error.exception)
+        assert '2. Car.objects exists at {}'.format(__file__) in str(error.exception)
+
+    def test_works_as_decorator(self):
+        @assert_max_queries(0)
+        def render():
+            Car.objects.count()
+
+        with self.assertRaises(TooManyQueries):
+            render()
+
+
+class NPlusOneDetectorTest(TestCase):
+    def setUp(self):
+        patcher = mocked_relations(Manufacturer, Car)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.makes = MockSet(model=Manufacturer)
+        for i in range(3):
+            make = Manufacturer(id=i + 1)
+            make.car_set.add(Car(speed=i))
+            self.makes.add(make)
+
+    def test_relation_queried_per_row_fails(self):
+        with self.assertRaises(NPlusOneQueries) as error:
+            with detect_n_plus_one():
+                for make in self.makes:
+                    make.car_set.count()
+
+        assert 'Manufacturer.car_set queried 3 times' in str(error.exception)
+
+    def test_report_counts_one_query_per_evaluated_set(self):
+        with detect_n_plus_one(raise_errors=False) as detector:
+            for make in self.makes:
+                list(make.car_set.all())
+
+        assert [(p.label, p.count) for p in detector.patterns] == [('Manufacturer.car_set', 3)]
+        assert 'Manufacturer.car_set queried 3 times' in detector.report()
+
+    def test_prefetched_relation_passes(self):
+        with detect_n_plus_one() as detector:
+            for make in self.makes.prefetch_related('car_set'):
+                make.car_set.count()
+
+        assert detector.patterns == []
+
+    def test_threshold_and_report_only_mode(self):
+        with detect_n_plus_one(threshold=4, raise_errors=False) as detector:
+            for make in self.makes:
+                Car.objects.filter(make=make).exists()
+
+        assert detector.patterns == []
+
+        with detect_n_plus_one(raise_errors=False) as detector:
+            for make in self.makes:
+                Car.objects.filter(make=make).exists()
+
+        assert [(p.label, p.count) for p in detector.patterns] == [('Car.objects', 3)]
+
+
+class NPlusOneDetectorDatabaseTest(TestCase):
+    def setUp(self):
+        patcher = mocked_relations(Manufacturer, Car, database=MockDatabase())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        make = Manufacturer.objects.create(name='vw')
+        for i in range(3):
+            Car.objects.create(make_id=make.pk, speed=i)
+
+    def test_foreign_key_per_row_fails(self):
+        with self.assertRaises(NPlusOneQueries):
+            with detect_n_plus_one():
+                for car in Car.objects.all():
+                    car.make.name
+
+    def test_select_related_passes(self):
+        with detect_n_plus_one() as detector:
+            for car in Car.objects.all().select_related('make'):
+                car.make.name
+
+        assert [q.operation for q in detector.queries] == ['iterate']
+
+    def test_save_and_related_writes_are_queries(self):
+        make = Manufacturer.objects.get(name='vw')
+
+        with assert_max_queries(3) as budget:
+            make.name = 'bmw'
+            make.save()
+            make.car_set.add(Car(speed=4))
+            make.car_set.count()
+
+        assert [(q.label, q.operation) for q in budget.queries] == [
+            ('Manufacturer.objects', 'save'),
+            ('Manufacturer.car_set', 'add'),
+            ('Manufacturer.car_set', 'count'),
+        ]
+
+
+class SimulatedLatencyTest(TestCase):
+    def setUp(self):
+        patcher = mocked_relations(Manufacturer, Car)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        Car.objects.add(*[Car(speed=i) for i in range(10)])
+
+    def test_costs_per_query_and_scanned_row(self):
+        with simulate_latency(per_query=0.001, per_row=0.0001, per_operation={'create': 0.005}) as latency:
+            list(Car.objects.filter(speed__gt=5))
+            Car.objects.create(speed=10)
+
+        assert [q.rows for q in latency.queries] == [10, 10]
+        assert round(latency.total, 6) == 0.008
+        assert latency.report() == (
+            'Estimated database time: 8.00 ms for 2 queries\n'
+            '  Car.objects: 8.00 ms for 2 queries'
+        )
+
+    @patch('django_mock_queries.instrumentation.time.sleep')
+    def test_sleep_spends_the_time(self, sleep_mock):
+        with simulate_latency(per_query=0.002, sleep=True):
+            Car.objects.count()
+
+        sleep_mock.assert_called_once_with(0.002)
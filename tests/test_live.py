@@ -0,0 +1,95 @@
+import gc
+from unittest import TestCase
+
+from django.db.models import Avg, Count, Max, Q, Sum
+
+from django_mock_queries.exceptions import ArgumentNotSupported
+from django_mock_queries.live import ViewObserver, live_view
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car
+
+
+class LiveViewTest(TestCase):
+    def setUp(self):
+        self.rows = [Car(id=i, speed=i * 10 % 70, model='model {}'.format(i % 3)) for i in range(10)]
+        self.cars = MockSet(*self.rows, model=Car)
+
+    def assert_matches_filter(self, view, *args, **attrs):
+        matching = self.cars.filter(*args, **attrs)
+        expected = [car for car in self.cars if car in matching]
+        if view.ordering:
+            expected = matching.order_by(*[('-' if reverse else '') + field for field, reverse in view.ordering])
+
+        assert [car.id for car in view] == [car.id for car in expected]
+
+    def test_view_follows_adds_updates_and_deletes(self):
+        fast = live_view(self.cars, Q(model='model 1') | Q(speed__gte=50))
+        assert [car.id for car in fast] == [1, 4, 5, 6, 7]
+
+        self.cars.add(Car(id=10, speed=60), Car(id=11, speed=0))
+        self.cars.filter(id=2).update(speed=55)
+        self.cars.filter(id=5).update(speed=0)
+        self.cars.filter(id=4).delete()
+
+        assert [car.id for car in fast] == [1, 2, 6, 7, 10]
+        self.assert_matches_filter(fast, Q(model='model 1') | Q(speed__gte=50))
+
+    def test_ordered_view_keeps_its_order(self):
+        by_speed = live_view(self.cars, speed__gt=0).order_by('-speed', 'model')
+        self.assert_matches_filter(by_speed, speed__gt=0)
+
+        self.cars.create(id=12, speed=25, model='model 0')
+        self.cars.filter(id=3).update(speed=65)
+        self.cars.filter(speed=20).update(speed=0)
+        self.cars.filter(id=6).delete()
+
+        self.assert_matches_filter(by_speed, speed__gt=0)
+        assert by_speed[0].id == 3
+
+    def test_writes_through_the_view(self):
+        slow = live_view(self.cars, speed__lt=30)
+
+        slow.filter(id=1).update(speed=40)
+        slow.create(id=13, speed=5)
+        slow.create(id=14, speed=35)
+        slow.filter(id=0).delete()
+
+        assert [car.id for car in slow] == [2, 7, 8, 9, 13]
+        assert self.cars.count() == 11
+
+    def test_running_aggregates(self):
+        view = live_view(self.cars, model='model 0')
+        assert view.aggregate(Count('id'), Sum('speed'), average=Avg('speed')) == {
+            'id__count': 4, 'speed__sum': 110, 'average': 27.5
+        }
+
+        self.cars.create(id=15, speed=100, model='model 0')
+        self.cars.filter(id=0).update(model='model 2')
+        self.cars.filter(id=3).update(speed=1)
+
+        assert [view.running[field][:2] for field in ('id', 'speed')] == [[4, 33], [4, 181]]
+        assert view.aggregate(Count('id'), Sum('speed'), Max('speed')) == {
+            'id__count': 4, 'speed__sum': 181, 'speed__max': 100
+        }
+
+    def test_closed_view_stops_following(self):
+        view = live_view(self.cars, speed=0)
+        view.close()
+        self.cars.add(Car(id=16, speed=0))
+
+        assert [car.id for car in view] == [0, 7]
+
+    def test_views_that_are_gone_stop_following(self):
+        by_speed = live_view(self.cars, speed__gt=0).order_by('-speed')
+        gc.collect()
+        live_view(self.cars, speed=0).close()
+
+        assert [observer.view() for observer in self.cars._observers] == [by_speed]
+        assert all(isinstance(observer, ViewObserver) for observer in self.cars._observers)
+
+        self.cars.create(id=17, speed=100)
+        assert by_speed[0].id == 17
+
+    def test_random_order_is_not_supported(self):
+        with self.assertRaises(ArgumentNotSupported):
+            live_view(self.cars).order_by('?')
@@ -1,3 +1,4 @@
+import gc
 from unittest import TestCase
 from unittest.mock import patch, MagicMock, PropertyMock
 
@@ -7,8 +8,9 @@ from django.db.utils import NotSupportedError
 from django.db.backends.base.creation import BaseDatabaseCreation
 
 from django_mock_queries import mocks
+from django_mock_queries.instrumentation import QueryRecorder
 from django_mock_queries.mocks import monkey_patch_test_db, mock_django_connection, \
-    MockOneToOneMap, MockOneToManyMap, PatcherChain, mocked_relations, ModelMocker, Mocker
+    MockOneToOneMap, MockOneToManyMap, PatcherChain, mocked_relations, ModelMocker, Mocker, capture_sql
 from django_mock_queries.query import MockSet
 from tests.mock_models import Car, Sedan, Manufacturer, CarVariation
 
@@ -59,6 +61,46 @@ class TestMocks(TestCase):
         self.assertFalse(is_foo_after)
 
 
+class CaptureSqlTest(TestCase):
+    def test_capture_sql_logs_query_before_raising(self):
+        with self.assertRaisesRegex(NotSupportedError, 'SELECT COUNT'):
+            with capture_sql() as captured:
+                Car.objects.filter(speed__gt=5).count()
+
+        assert len(captured) == 1
+        assert captured[0]['sql'] == 'SELECT COUNT(*) AS "__count" FROM "tests_car" WHERE "tests_car"."speed" > %s'
+        assert captured[0]['params'] == (5,)
+
+    def test_capture_sql_with_empty_results(self):
+        with capture_sql(empty_results=True) as captured:
+            assert Car.objects.count() == 0
+            assert not Car.objects.exists()
+            assert list(Car.objects.filter(make__name='vw')) == []
+            assert Car.objects.filter(speed=1).update(speed=2) == 0
+            assert list(Car.objects.filter(id__in=[])) == []
+
+        assert len(captured) == 4
+        assert 'INNER JOIN "tests_manufacturer"' in captured[2]['sql']
+        assert captured[3]['sql'].startswith('UPDATE "tests_car"')
+
+    def test_capture_sql_is_recorded_as_query(self):
+        with QueryRecorder() as recorder, capture_sql(empty_results=True):
+            Car.objects.exists()
+
+        assert [(q.label, q.operation) for q in recorder.queries] == [('Car', 'sql')]
+
+    def test_capture_sql_decorator(self):
+        capture = capture_sql(empty_results=True)
+
+        @capture
+        def count_cars():
+            return Car.objects.count()
+
+        assert count_cars() == 0
+        assert count_cars() == 0
+        assert len(capture) == 1
+
+
 # noinspection PyUnresolvedReferences,PyStatementEffect
 class MockOneToOneTests(TestCase):
     def test_not_mocked(self):
@@ -91,6 +133,18 @@ class MockOneToOneTests(TestCase):
         with self.assertRaises(Car.sedan.RelatedObjectDoesNotExist):
             car2.sedan
 
+    @patch.object(Car, 'sedan', MockOneToOneMap(Car.sedan))
+    def test_entries_are_evicted_with_instances(self):
+        car = Car()
+        car.sedan = Sedan()
+
+        assert len(Car.sedan) == 1
+
+        del car
+        gc.collect()
+
+        assert len(Car.sedan) == 0
+
     @patch.object(Car, 'sedan', MockOneToOneMap(Car.sedan))
     def test_delegation(self):
         if django.VERSION[0] < 2:
@@ -179,6 +233,20 @@ class MockOneToManyTests(TestCase):
         with self.assertRaises(Car.DoesNotExist):
             m.car_set.get(speed=0)
 
+    @patch.object(Manufacturer, 'car_set', MockOneToManyMap(Manufacturer.car_set))
+    def test_entries_are_evicted_with_instances(self):
+        m1, m2 = Manufacturer(), Manufacturer()
+        m1.car_set.add(Car(speed=1))
+        m2.car_set.add(Car(speed=2))
+
+        assert len(Manufacturer.car_set) == 2
+
+        del m1
+        gc.collect()
+
+        assert len(Manufacturer.car_set) == 1
+        assert m2.car_set.get().speed == 2
+
 
 # noinspection PyUnusedLocal
 def zero_sum(items):
@@ -1,19 +1,23 @@
 import datetime
+import json
 import warnings
 from unittest import TestCase
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 from django.core.exceptions import FieldError
 from django.core.paginator import Paginator
 from django.db import models
-from django.db.models import Q, Avg
+from django.db.models import Q, Avg, Exists, OuterRef, Prefetch, Subquery
 from django.db.models.functions import Coalesce
 
 from django_mock_queries.constants import *
 from django_mock_queries.exceptions import ModelNotSpecified, ArgumentNotSupported
+from django_mock_queries.indexes import AutoIndex
+from django_mock_queries.live import live_view
 from django_mock_queries.query import MockSet, MockModel, create_model
 from django_mock_queries.mocks import mocked_relations
-from tests.mock_models import Car, CarVariation, Sedan, Manufacturer
+from django_mock_queries.utils import SubqueryResolver
+from tests.mock_models import Car, CarVariation, Sedan, Manufacturer, Track
 
 
 class TestQuery(TestCase):
@@ -111,6 +115,28 @@ class TestQuery(TestCase):
 
         assert item_3 not in results
 
+    def test_query_filters_items_by_q_object_and_with_many_lookups(self):
+        items = [MockModel(mock_name='#{}'.format(i), foo=i % 3, bar='b{}'.format(i % 5)) for i in range(200)]
+
+        self.mock_set.add(*items)
+        results = list(self.mock_set.filter(Q(bar__iregex=r'^B[12]$') & Q(foo=1) & Q(Q(foo=1) | Q(bar='b0'))))
+
+        expected = [item for item in items if item.foo == 1 and item.bar in ('b1', 'b2')]
+        assert len(results) == len(expected)
+        assert set(results) == set(expected)
+
+    def test_query_filters_items_with_lookups_that_fail_on_rows_rejected_by_earlier_ones(self):
+        items = [MockModel(mock_name='#{}'.format(i), name='x', tag='zzz') for i in range(200)]
+        items.insert(5, MockModel(mock_name='none', name='y', tag=None))
+
+        self.mock_set.add(*items)
+
+        assert self.mock_set.filter(name='x', tag__icontains='b').count() == 0
+        assert self.mock_set.filter(Q(name='x') & Q(tag__icontains='b')).count() == 0
+        assert self.mock_set.filter(name='x', tag__icontains='z').first() is items[0]
+        with self.assertRaises(AttributeError):
+            self.mock_set.filter(tag__icontains='b', name='x').count()
+
     def test_query_filters_items_by_unsupported_object(self):
         bogus_filter = 'This is not a filter.'
 
@@ -185,6 +211,85 @@ class TestQuery(TestCase):
 
         self.assertEqual(list(old_cars), list(matches))
 
+    def test_query_filters_by_mock_set_compares_related_instances_by_key(self):
+        makes = [Manufacturer(id=i, name='make {}'.format(i)) for i in range(1, 5)]
+        cars = [Car(id=100 + i, make=makes[i % 4], make_id=makes[i % 4].id) for i in range(8)] + [Car(id=200)]
+
+        # A copy of make 2, make 3 twice and an unsaved make, which matches no car, not even one without a make
+        inner = MockSet(makes[1], Manufacturer(id=2, name='copy'), makes[2], makes[2], Manufacturer(name='unsaved'))
+        all_cars = MockSet(*cars)
+        expected = [101, 102, 105, 106]
+
+        assert [car.id for car in all_cars.filter(make_id__in=inner)] == expected
+        assert [car.id for car in all_cars.filter(make__in=inner)] == expected
+        assert [car.id for car in all_cars.filter(make__in=list(inner))] == expected
+        assert [car.id for car in all_cars.filter(make_id__in=inner.values_list('pk', flat=True))] == expected
+        assert [car.id for car in all_cars.filter(make__in=inner.values_list('pk', flat=True))] == expected
+        assert [car.id for car in all_cars.exclude(make__in=inner)] == [100, 103, 104, 107, 200]
+
+    def _cars_with_variations(self):
+        cars = [Car(id=i, speed=i * 10) for i in range(1, 5)]
+        variations = MockSet(
+            *[CarVariation(id=i, car=cars[i % 3], color='color {}'.format(i)) for i in range(1, 8)],
+            model=CarVariation
+        )
+        return cars, variations
+
+    def test_query_annotates_correlated_subquery(self):
+        cars, variations = self._cars_with_variations()
+        latest = variations.filter(car=OuterRef('pk')).order_by('-id').values('color')[:1]
+
+        results = MockSet(*cars, model=Car).annotate(latest_color=Subquery(latest))
+
+        assert [x.latest_color for x in results] == ['color 6', 'color 7', 'color 5', None]
+
+    def test_query_correlated_subquery_is_evaluated_once_per_outer_key(self):
+        cars, variations = self._cars_with_variations()
+        outer = MockSet(*(cars * 50), model=Car)
+
+        with patch.object(SubqueryResolver, '_evaluate', autospec=True,
+                          side_effect=SubqueryResolver._evaluate) as evaluate_mock:
+            outer.annotate(colors=Subquery(variations.filter(car=OuterRef('pk')).values('color')[:1]))
+
+        assert evaluate_mock.call_count == len(cars)
+
+    def test_query_filters_by_exists(self):
+        cars, variations = self._cars_with_variations()
+        qs = MockSet(*cars, model=Car)
+
+        with_variations = qs.filter(Exists(variations.filter(car=OuterRef('pk'))))
+        without_variations = qs.filter(~Exists(variations.filter(car=OuterRef('pk'))))
+        in_q = qs.filter(Q(Exists(variations.filter(car=OuterRef('pk'), color='color 1'))) | Q(speed=40))
+
+        assert list(with_variations) == cars[:3]
+        assert list(without_variations) == cars[3:]
+        assert list(in_q) == [cars[1], cars[3]]
+
+    def test_query_annotates_exists(self):
+        cars, variations = self._cars_with_variations()
+
+        results = MockSet(*cars, model=Car).annotate(
+            has_variations=Exists(variations.filter(car_id=OuterRef('id')))
+        )
+
+        assert [x.has_variations for x in results] == [True, True, True, False]
+
+    def test_query_filters_by_subquery_values(self):
+        cars, variations = self._cars_with_variations()
+        qs = MockSet(*cars, model=Car)
+
+        uncorrelated = qs.filter(id__in=Subquery(variations.filter(color__in=['color 1', 'color 2']).values('car')))
+        correlated = qs.filter(speed__gt=Subquery(variations.filter(car=OuterRef('pk')).values('id')[:1]))
+
+        assert list(uncorrelated) == [cars[1], cars[2]]
+        assert list(correlated) == cars[:3]
+
+    def test_query_filters_by_outer_ref_after_other_operations_not_supported(self):
+        _, variations = self._cars_with_variations()
+
+        with self.assertRaises(ArgumentNotSupported):
+            variations.filter(car=OuterRef('pk')).values('color').filter(car=OuterRef('pk'))
+
     def test_query_filters_model_objects_by_bad_field(self):
         item_1 = Car(speed=1)
         item_2 = Sedan(speed=2)
@@ -211,6 +316,61 @@ class TestQuery(TestCase):
             result = self.mock_set.filter(car__speed__in=[1, 2])
             assert result.count() == 1
 
+    def test_query_filters_reverse_relationship_by_any_related_row(self):
+        with mocked_relations(Manufacturer):
+            make_1, make_2 = Manufacturer(), Manufacturer()
+            make_1.car_set = MockSet(Car(speed=1), Car(speed=2))
+
+            self.mock_set.add(make_1, make_2)
+
+            assert list(self.mock_set.filter(car__speed=2)) == [make_1]
+            assert list(self.mock_set.filter(car__speed__isnull=True)) == [make_2]
+
+    def test_query_prefetch_related_caches_mocked_relations(self):
+        with mocked_relations(Manufacturer):
+            make = Manufacturer(id=1)
+            make.car_set = MockSet(Car(speed=1), Car(speed=2))
+            fast_cars = MockSet(make.car_set[1])
+
+            qs = MockSet(make, model=Manufacturer)
+            prefetching = qs.prefetch_related('car_set', Prefetch('car_set', queryset=fast_cars, to_attr='fast'))
+            assert 'car_set' not in make.__dict__.get('_prefetched_objects_cache', {})
+            assert list(prefetching) == [make]
+
+            assert list(make.car_set.all()) == list(make._prefetched_objects_cache['car_set'])
+            assert make.fast == [fast_cars[0]]
+
+    def test_query_prefetched_relation_writes_go_to_the_relation(self):
+        with mocked_relations(Manufacturer):
+            make = Manufacturer(id=1)
+            make.car_set = MockSet(Car(speed=1), model=Car)
+            list(MockSet(make, model=Manufacturer).prefetch_related('car_set'))
+
+            make.car_set.add(Car(speed=2))
+
+            assert make.car_set.count() == 2
+            del make._prefetched_objects_cache
+            assert make.car_set.count() == 2
+
+    def test_query_select_related_resolves_foreign_keys_once(self):
+        with mocked_relations(Manufacturer):
+            make = Manufacturer(id=1)
+            Manufacturer.objects.add(make)
+            cars = MockSet(Car(make_id=1, speed=1), Car(make_id=1, speed=2), model=Car)
+
+            cars.select_related('make')
+
+            assert [car.make for car in cars] == [make, make]
+
+    def test_query_select_related_rejects_multi_valued_relations(self):
+        qs = MockSet(Manufacturer(id=1), model=Manufacturer)
+
+        with self.assertRaises(FieldError):
+            qs.select_related('car_set')
+
+        with self.assertRaises(FieldError):
+            list(qs.prefetch_related('bogus'))
+
     def test_query_exclude(self):
         item_1 = MockModel(foo=1, bar='a')
         item_2 = MockModel(foo=1, bar='b')
@@ -751,6 +911,15 @@ class TestQuery(TestCase):
         self.mock_set.add(item_1, item_2, item_3)
         assert self.mock_set.get(Q(foo=1)) == item_1
 
+    def test_query_get_stops_at_the_second_match(self):
+        self.mock_set.add(*[MockModel(mock_name='#{}'.format(i), foo=i % 2) for i in range(1000)])
+
+        with patch('django_mock_queries.utils.is_disqualified', return_value=False) as is_disqualified:
+            self.assertRaises(MultipleObjectsReturned, self.mock_set.get, foo=1)
+            self.assertRaises(MultipleObjectsReturned, self.mock_set.get_or_create, foo=1)
+
+        assert is_disqualified.call_count == 4
+
     def test_query_get_raises_does_not_exist_when_no_match(self):
         item_1 = MockModel(foo=1)
         item_2 = MockModel(foo=2)
@@ -975,7 +1144,7 @@ class TestQuery(TestCase):
         assert qs == qs.defer('f2', 'f3')
         assert qs == qs.using('default')
         assert qs == qs.select_related('t1', 't2')
-        assert qs == qs.prefetch_related('t3', 't4')
+        assert list(qs.prefetch_related('t3', 't4')) == list(qs)
         assert qs == qs.select_for_update()
 
     def test_query_values_list_raises_type_error_when_kwargs_other_than_flat_specified(self):
@@ -1377,6 +1546,43 @@ class TestQuery(TestCase):
         assert result[0] == datetime.datetime(2017, 1, 10, 1, 2, 9)
         assert result[1] == datetime.datetime(2017, 1, 10, 1, 2, 3)
 
+    def test_query_dates_skips_null_values(self):
+        qs = MockSet(model=create_model('date_begin'))
+
+        item1 = MockModel(date_begin=datetime.date(2017, 1, 2))
+        item2 = MockModel(date_begin=None)
+        item3 = MockModel(date_begin=datetime.date(2017, 1, 2))
+
+        qs.add(item1, item2, item3)
+
+        result = qs.dates('date_begin', 'month')
+
+        assert list(result) == [datetime.date(2017, 1, 1)]
+
+    def test_query_filters_by_iso_date_parts(self):
+        item1 = MockModel(mock_name='#1', created=datetime.datetime(2021, 1, 3, 10, 30))
+        item2 = MockModel(mock_name='#2', created=datetime.datetime(2021, 5, 4, 12, 0))
+        item3 = MockModel(mock_name='#3', created=datetime.date(2021, 12, 31))
+
+        self.mock_set.add(item1, item2, item3)
+
+        assert list(self.mock_set.filter(created__iso_year=2020)) == [item1]
+        assert list(self.mock_set.filter(created__week=53)) == [item1]
+        assert list(self.mock_set.filter(created__week__lt=53)) == [item2, item3]
+        assert list(self.mock_set.filter(created__iso_week_day=7)) == [item1]
+        assert list(self.mock_set.filter(created__week_day=1)) == [item1]
+        assert list(self.mock_set.filter(created__quarter=2)) == [item2]
+        assert list(self.mock_set.filter(created__quarter__in=[1, 4])) == [item1, item3]
+
+    def test_query_filters_by_time(self):
+        item1 = MockModel(mock_name='#1', created=datetime.datetime(2021, 1, 3, 10, 30))
+        item2 = MockModel(mock_name='#2', created=datetime.datetime(2021, 5, 4, 12, 0))
+
+        self.mock_set.add(item1, item2)
+
+        assert list(self.mock_set.filter(created__time=datetime.time(12, 0))) == [item2]
+        assert list(self.mock_set.filter(created__time__lt=datetime.time(11, 0))) == [item1]
+
     def test_empty_queryset_bool_converts_to_false(self):
         qs = MockSet()
         assert not bool(qs)
@@ -1405,3 +1611,123 @@ class TestQuery(TestCase):
 
         assert len(mockset) == 1
         assert mockset[0].id == 3
+
+    def test_explain_describes_each_step(self):
+        cars = MockSet(*[Car(id=i, speed=i) for i in range(10)], model=Car)
+        qs = cars.filter(speed__gt=4).exclude(id=9).order_by('-speed')
+
+        assert qs.explain() == (
+            'SCAN tests.Car (10 rows)\n'
+            '  --filter(speed__gt=4) using full scan: 10 rows scanned, 5 returned, selectivity 0.50\n'
+            '    --exclude(id=9) using full scan: 5 rows scanned, 4 returned, selectivity 0.80\n'
+            '      --order_by(-speed) using full scan: 4 rows scanned, 4 returned, selectivity 1.00'
+        )
+        assert cars.explain() == 'SCAN tests.Car (10 rows)'
+
+    def test_explain_formats(self):
+        qs = MockSet(MockModel(foo=1), MockModel(foo=2)).filter(foo=1)
+
+        assert json.loads(qs.explain(format='json')) == {'source': 'MockSet', 'rows': 2, 'steps': [{
+            'operation': 'filter', 'arguments': 'foo=1', 'access': 'full scan',
+            'rows_scanned': 2, 'rows_returned': 1, 'selectivity': 0.5,
+        }]}
+        with self.assertRaises(ValueError):
+            qs.explain(format='yaml')
+
+    def test_explain_formats_arguments_only_when_called(self):
+        operand = MagicMock(__repr__=MagicMock(return_value='<operand>'))
+        qs = MockSet(MockModel(foo=1), MockModel(foo=2)).filter(foo__in=[1, operand])
+
+        operand.__repr__.assert_not_called()
+        assert qs.explain().endswith("--filter(foo__in=[1, <operand>]) using full scan: 2 rows scanned, 1 returned, "
+                                     "selectivity 0.50")
+
+
+class TestFork(TestCase):
+    def setUp(self):
+        self.rows = [Car(id=i, speed=i % 4) for i in range(8)]
+        self.fixture = MockSet(*self.rows, model=Car)
+
+    def test_fork_shares_rows_until_written(self):
+        fork = self.fixture.fork()
+        assert fork.items is self.fixture.items
+
+        fork.filter(id=1).update(speed=3)
+        fork.create(id=8, speed=0)
+        fork.filter(id=2).delete()
+
+        assert [(car.id, car.speed) for car in fork.filter(speed=3)] == [(1, 3), (3, 3), (7, 3)]
+        assert fork.count() == 8
+        assert [(car.id, car.speed) for car in self.fixture.filter(speed=3)] == [(3, 3), (7, 3)]
+        assert self.fixture.count() == 8
+        assert self.rows[1].speed == 1
+        assert fork.items[2] is self.rows[3]
+
+    def test_writes_to_the_parent_are_not_seen_by_forks(self):
+        fork = self.fixture.fork()
+        fast = self.fixture.filter(speed__gt=1)
+
+        fast.update(speed=0)
+        self.fixture.update_or_create(id=0, defaults={'speed': 2})
+
+        assert [car.speed for car in fork] == [0, 1, 2, 3, 0, 1, 2, 3]
+        assert [car.speed for car in self.fixture] == [2, 1, 0, 0, 0, 1, 0, 0]
+        assert [car.speed for car in fast] == [0, 0, 0, 0]
+
+    def test_restore_goes_back_to_the_snapshot(self):
+        snapshot = self.fixture.snapshot()
+        view = live_view(self.fixture, speed=0)
+
+        for _ in range(2):
+            self.fixture.filter(speed=0).update(speed=1)
+            self.fixture.filter(id=5).delete()
+            self.fixture.add(Car(id=9, speed=0))
+            assert [car.id for car in view] == [9]
+
+            self.fixture.restore(snapshot)
+            assert [(car.id, car.speed) for car in self.fixture] == [(row.id, row.speed) for row in self.rows]
+            assert [car.id for car in view] == [0, 4]
+
+    def test_indexes_are_copied(self):
+        cars = MockSet(*self.rows, model=Car, auto_index=AutoIndex(after=1))
+        cars.filter(speed=1)
+        fork = cars.fork()
+
+        fork.filter(id=5).update(speed=2)
+        cars.filter(id=1).update(speed=2)
+
+        assert [car.id for car in fork.filter(speed=1)] == [1]
+        assert [car.id for car in cars.filter(speed=1)] == [5]
+        assert fork._auto_index.owner is fork
+
+    def test_indexes_are_shared_with_forks_until_written(self):
+        cars = MockSet(*self.rows, model=Car, auto_index=AutoIndex(after=1), indexes=[('speed', 'model')])
+        cars.filter(speed=1)
+        fork = cars.fork()
+        auto_index, composite_index = cars._auto_index.indexes['speed', 'hash'], cars._composite_indexes.indexes[0]
+
+        assert fork._auto_index.indexes['speed', 'hash'].buckets is auto_index.buckets
+        assert fork._composite_indexes.indexes[0].buckets is composite_index.buckets
+        assert fork._auto_index.sequence is cars._auto_index.sequence
+
+        fork.filter(id=5).update(speed=2)
+
+        assert fork._auto_index.indexes['speed', 'hash'].buckets is not auto_index.buckets
+        assert fork._composite_indexes.indexes[0].buckets is not composite_index.buckets
+        assert [car.id for car in cars.filter(speed=1)] == [1, 5]
+        assert [car.id for car in fork.filter(speed=1)] == [1]
+
+    def test_unique_indexes_of_forks(self):
+        tracks = MockSet(Track(id=1, country='it', name='Monza'), model=Track, constraints=True)
+        fork = tracks.fork()
+
+        fork.filter(id=1).update(name='Imola')
+        fork.create(id=2, country='it', name='Monza')
+        tracks.create(id=2, country='it', name='Imola')
+
+        assert tracks.get(country='it', name='Monza').id == 1
+        assert fork.get(country='it', name='Monza').id == 2
+
+    def test_derived_sets_cannot_be_forked(self):
+        with self.assertRaises(ArgumentNotSupported):
+            self.fixture.filter(speed=1).fork()
@@ -0,0 +1,63 @@
+from unittest import TestCase
+
+from django.db.models import Q, Sum
+
+from django_mock_queries import stats
+from django_mock_queries.query import MockSet
+from tests.mock_models import Car
+
+
+class StatsTest(TestCase):
+    def setUp(self):
+        self.cars = MockSet(*[Car(id=i, speed=i) for i in range(10)], model=Car)
+        stats.reset()
+        stats.enable()
+        self.addCleanup(stats.disable)
+        self.addCleanup(stats.reset)
+
+    def test_operations_are_keyed_by_model_and_lookup_signature(self):
+        self.cars.filter(speed__gt=4, id__lt=8)
+        self.cars.filter(speed__gt=1, id__lt=3)
+        self.cars.filter(Q(speed=1) | ~Q(id=2))
+        self.cars.aggregate(Sum('speed'))
+
+        snapshot = stats.snapshot()
+
+        assert set(snapshot) == {
+            stats.StatsKey('tests.Car', 'filter', 'id__lt=?, speed__gt=?'),
+            stats.StatsKey('tests.Car', 'filter', '(speed=? OR NOT (id=?))'),
+            stats.StatsKey('tests.Car', 'aggregate', 'Sum'),
+        }
+        by_lookup = snapshot[stats.StatsKey('tests.Car', 'filter', 'id__lt=?, speed__gt=?')]
+        assert (by_lookup.calls, by_lookup.rows_scanned, by_lookup.rows_returned) == (2, 20, 4)
+        assert 0 < by_lookup.max_time <= by_lookup.total_time
+
+    def test_nested_operations_count_once(self):
+        self.cars.get(speed=3)
+
+        assert [(key.operation, s.rows_returned) for key, s in stats.snapshot().items()] == [('get', 1)]
+
+    def test_reset_and_disable(self):
+        self.cars.count()
+        stats.reset()
+        stats.disable()
+        self.cars.count()
+
+        assert stats.snapshot() == {}
+        assert stats.report() == ''
+
+    def test_hooks_receive_measurements(self):
+        stats.disable()
+        measurements = []
+        stats.add_hook(measurements.append)
+        try:
+            list(self.cars.order_by('-speed'))
+        finally:
+            stats.remove_hook(measurements.append)
+
+        assert [(m.operation, m.signature, m.rows_returned) for m in measurements] == [
+            ('order_by', '-speed', 10),
+            ('iter', '', 10),
+            ('len', '', 1),
+        ]
+        assert stats.snapshot() == {}
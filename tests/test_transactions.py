@@ -0,0 +1,150 @@
+from unittest import TestCase
+
+from django.db import transaction
+
+from django_mock_queries.database import MockDatabase
+from django_mock_queries.indexes import AutoIndex
+from django_mock_queries.live import live_view
+from django_mock_queries.mocks import ModelMocker, mocked_relations
+from django_mock_queries.query import MockSet
+from django_mock_queries.transactions import Journal
+from tests.mock_models import Car, Driver, Manufacturer, Team
+
+
+class Rollback(Exception):
+    pass
+
+
+class AtomicTest(TestCase):
+    def setUp(self):
+        self.rows = [Car(id=i, speed=i % 3) for i in range(6)]
+        self.cars = MockSet(*self.rows, model=Car, auto_index=AutoIndex(after=1))
+
+    def assert_unchanged(self):
+        assert [(car.id, car.speed) for car in self.cars] == [(i, i % 3) for i in range(6)]
+        assert [car.id for car in self.cars.filter(speed=0)] == [0, 3]
+
+    def test_atomic_block_rolls_back_on_error(self):
+        slow = live_view(self.cars, speed=0)
+
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                self.cars.filter(speed=0).update(speed=2)
+                self.cars.create(id=6, speed=0)
+                self.cars.filter(id__in=[1, 4]).delete()
+                self.cars.update_or_create(id=5, defaults={'speed': 0})
+                raise Rollback()
+
+        self.assert_unchanged()
+        assert self.cars.filter(id=1).exists()
+        assert [car.id for car in slow] == [0, 3]
+
+    def test_atomic_block_commits(self):
+        with transaction.atomic():
+            self.cars.create(id=6, speed=0)
+
+        with self.assertRaises(Rollback):
+            with transaction.atomic():
+                raise Rollback()
+
+        assert self.cars.count() == 7
+
+    def test_nested_blocks_roll_back_to_their_savepoint(self):
+        with transaction.atomic():
+            self.cars.filter(id=0).update(speed=1)
+
+            with self.assertRaises(Rollback):
+                with transaction.atomic():
+                    self.cars.filter(id=1).delete()
+                    with transaction.atomic():
+                        self.cars.create(id=7, speed=0)
+                    raise Rollback()
+
+            assert [car.id for car in self.cars] == list(range(6))
+
+        assert self.cars.get(id=0).speed == 1
+        assert [car.id for car in self.cars.filter(speed=0)] == [3]
+
+    def test_set_rollback(self):
+        with transaction.atomic():
+            self.cars.filter(id=0).delete()
+            transaction.set_rollback(True)
+
+        self.assert_unchanged()
+
+    def test_journal_savepoints(self):
+        with Journal() as journal:
+            self.cars.filter(speed=1).update(speed=0)
+            sid = journal.savepoint()
+            self.cars.filter(speed=0).delete()
+
+            journal.savepoint_rollback(sid)
+            assert self.cars.count() == 6
+            journal.rollback()
+
+        self.assert_unchanged()
+        assert journal.entries == []
+
+    def test_journal_rolls_back_atomic_blocks_committed_in_it(self):
+        with Journal() as journal:
+            with transaction.atomic():
+                self.cars.filter(speed=0).delete()
+            journal.rollback()
+
+        self.assert_unchanged()
+
+    def test_sets_made_in_a_transaction_are_not_journaled(self):
+        with Journal() as journal:
+            self.cars.filter(speed__gt=0).exclude(id=1)
+
+        assert journal.entries == []
+
+
+class MockedTransactionTest(TestCase):
+    def test_fields_set_before_save_are_rolled_back(self):
+        with ModelMocker(Car):
+            car = Car.objects.create(speed=10)
+
+            with self.assertRaises(Rollback):
+                with transaction.atomic():
+                    car.speed = 20
+                    car.save()
+                    Car.objects.create(speed=30)
+                    raise Rollback()
+
+            assert [(car.id, car.speed) for car in Car.objects.all()] == [(1, 10)]
+
+    def test_database_tables_are_rolled_back(self):
+        database = MockDatabase()
+        with mocked_relations(Manufacturer, Car, Driver, Team, database=database):
+            make = Manufacturer.objects.create(name='vw')
+            other_make = Manufacturer.objects.create(name='audi')
+            car = Car.objects.create(make=make, speed=1)
+            team = Team.objects.create(name='red')
+            ann, bob = Driver.objects.create(name='ann'), Driver.objects.create(name='bob')
+            team.drivers.add(ann)
+
+            with self.assertRaises(Rollback):
+                with transaction.atomic():
+                    Car.objects.create(make=make, speed=2)
+                    car.speed = 99
+                    car.save()
+                    other_make.car_set.add(car)
+                    team.drivers.add(bob)
+                    team.drivers.remove(ann)
+                    Car.objects.filter(speed=99).delete()
+                    raise Rollback()
+
+            assert [car.speed for car in Car.objects.filter(make=make)] == [1]
+            assert [car.speed for car in make.car_set.all()] == [1]
+            assert list(other_make.car_set.all()) == []
+            assert (car.speed, car.make) == (1, make)
+            assert list(team.drivers.all()) == [ann]
+            assert list(ann.teams.all()) == [team]
+            assert list(bob.teams.all()) == []
+
+            with transaction.atomic():
+                car.speed = 5
+                car.save()
+
+            assert [car.speed for car in Car.objects.filter(speed=5)] == [5]
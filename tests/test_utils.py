@@ -393,3 +393,90 @@ class TestUtils(TestCase):
         date_obj = date(2019, 1, 2)
         result = utils.get_field_value(date_obj, 'date')
         assert result == date_obj
+
+    def test_lookup_comparison_from_lookup_name(self):
+        assert utils.lookup_comparison('foo') is None
+        assert utils.lookup_comparison('foo__in') == constants.COMPARISON_IN
+        assert utils.lookup_comparison('foo__year') == (constants.COMPARISON_YEAR, constants.COMPARISON_EXACT)
+        assert utils.lookup_comparison('foo__year__in') == (constants.COMPARISON_YEAR, constants.COMPARISON_IN)
+
+    def test_prepare_operand_normalizes_filter_value_once(self):
+        operand = utils.prepare_operand('foo__iexact', 'ABC')
+        assert operand.value == 'abc'
+
+        operand = utils.prepare_operand('foo__regex', r'\d+')
+        assert operand.value.search('a1') is not None
+
+        operand = utils.prepare_operand('foo__in', [1, 2, 2])
+        assert operand.value == frozenset([1, 2])
+
+        operand = utils.prepare_operand('foo__year__in', [2016, 2017])
+        assert operand.comparison == (constants.COMPARISON_YEAR, constants.COMPARISON_IN)
+        assert operand.value == frozenset([2016, 2017])
+
+    def test_prepare_operand_keeps_values_that_need_no_preparation(self):
+        assert utils.prepare_operand('foo', 'ABC') == 'ABC'
+        assert utils.prepare_operand('foo__gt', 1) == 1
+        assert utils.prepare_operand('foo__in', 'abc') == 'abc'
+        assert utils.prepare_operand('foo__iexact', None) is None
+
+    def test_is_match_in_value_check_with_unhashable_members(self):
+        operand = utils.prepare_operand('foo__in', [[1], [2]])
+        assert utils.is_match([1], operand, constants.COMPARISON_IN) is False
+        assert utils.is_match({'a': 1}, [{'a': 1}], constants.COMPARISON_IN) is True
+
+    def test_matches_with_prepared_operands(self):
+        source = [
+            MagicMock(foo='Monty', bar=1),
+            MagicMock(foo='Python', bar=2),
+            MagicMock(foo='Holy Grail', bar=3),
+        ]
+
+        results = utils.matches(*source, foo__iregex=r'^(monty|python)$', bar__in=(x for x in [2, 3]))
+        assert results == [source[1]]
+
+        results = utils.matches(*source, foo__istartswith='HOLY')
+        assert results == [source[2]]
+
+    def test_extract_returns_single_date_part(self):
+        obj = datetime(2021, 1, 3, 10, 30, 15)
+        assert utils.extract(obj, constants.COMPARISON_DATE) == date(2021, 1, 3)
+        assert utils.extract(obj, constants.COMPARISON_YEAR) == 2021
+        assert utils.extract(obj, constants.COMPARISON_ISO_YEAR) == 2020
+        assert utils.extract(obj, constants.COMPARISON_QUARTER) == 1
+        assert utils.extract(obj, constants.COMPARISON_WEEK) == 53
+        assert utils.extract(obj, constants.COMPARISON_WEEK_DAY) == 1
+        assert utils.extract(obj, constants.COMPARISON_ISO_WEEK_DAY) == 7
+        assert utils.extract(obj, constants.COMPARISON_SECOND) == 15
+        assert utils.extract(date(2021, 1, 3), constants.COMPARISON_DATE) == date(2021, 1, 3)
+
+    def test_truncate_date_and_datetime(self):
+        assert utils.truncate(date(2021, 5, 4), 'year') == date(2021, 1, 1)
+        assert utils.truncate(date(2021, 5, 4), 'month') == date(2021, 5, 1)
+        assert utils.truncate(datetime(2021, 5, 4, 10, 30, 15), 'day') == datetime(2021, 5, 4)
+        assert utils.truncate(datetime(2021, 5, 4, 10, 30, 15), 'minute') == datetime(2021, 5, 4, 10, 30)
+
+    def test_predicate_cost_grows_with_comparison_and_relation_hops(self):
+        assert utils.predicate_cost('foo') == utils.predicate_cost('foo__exact') == 1
+        assert utils.predicate_cost('foo__iregex') > utils.predicate_cost('foo__icontains') > 1
+        assert utils.predicate_cost('foo__bar__exact') == constants.RELATION_HOP_COST
+        assert utils.predicate_cost('foo__year__gt') == 1 + constants.DATETIME_COMPARISON_COST
+
+    def test_order_predicates_puts_cheap_selective_lookups_first(self):
+        source = [MagicMock(foo='value {}'.format(i), bar=i) for i in range(200)]
+        predicates = [('foo__iregex', r'^value'), ('bar', 5), ('foo__icontains', '1')]
+
+        assert utils.order_predicates(source, predicates) == [
+            ('bar', 5), ('foo__icontains', '1'), ('foo__iregex', r'^value'),
+        ]
+        assert utils.order_predicates(source[:10], predicates) == predicates
+
+    def test_matches_same_results_in_any_lookup_order(self):
+        source = [MagicMock(foo='value {}'.format(i), bar=i % 7) for i in range(200)]
+
+        with patch.object(utils, 'order_predicates', side_effect=lambda source, predicates, negated=False: predicates):
+            expected = utils.matches(*source, foo__iregex=r'1$', bar__in=(x for x in [1, 2]))
+            expected_negated = utils.matches(*source, foo__iregex=r'1$', bar=1, negated=True)
+
+        assert utils.matches(*source, foo__iregex=r'1$', bar__in=(x for x in [1, 2])) == expected
+        assert utils.matches(*source, foo__iregex=r'1$', bar=1, negated=True) == expected_negated